@@ -1,9 +1,17 @@
-"""Benchmark for task creation and execution."""
+"""Benchmark for task creation and execution.
+
+By default this profiles the benchmark.  With --switches it runs it
+without the profiler and reports tasklet switches (generator steps)
+per second instead, both with the ambient state saved and restored on
+every step and with it only compared by identity (the default; see
+tasklets._SNAPSHOT_STATE).
+"""
 
 import cProfile
 import os
 import pstats
 import sys
+import time
 
 from ndb import eventloop
 from ndb import tasklets
@@ -39,15 +47,54 @@ def bench(n):
     fut.check_success()
 
 
+def count_switches(n):
+  """Return the number of generator steps taken by bench(n)."""
+  steps = [1, 1]  # fibonacci(0) and fibonacci(1) take one step each.
+  for i in range(2, n):
+    steps.append(3 + steps[i-1] + steps[i-2])
+  return sum(steps[:n])
+
+
+def bench_switches(n, repeat=5):
+  """Run bench(n) a few times in each state switching mode.
+
+  This prints the best switches/sec with tasklets._SNAPSHOT_STATE off
+  (before) and on (after).
+  """
+  switches = count_switches(n)
+  save_snapshot = tasklets._SNAPSHOT_STATE
+  try:
+    for label, snapshot in [('before', False), ('after', True)]:
+      tasklets._SNAPSHOT_STATE = snapshot
+      best = None
+      for _ in range(repeat):
+        t0 = time.time()
+        bench(n)
+        t1 = time.time()
+        if best is None or t1 - t0 < best:
+          best = t1 - t0
+      print '%s: %d switches in %.3f sec: %.0f switches/sec' % (
+        label, switches, best, switches / best)
+  finally:
+    tasklets._SNAPSHOT_STATE = save_snapshot
+
+
 def main():
   utils.tweak_logging()  # Interpret -v and -q flags.
   n = 15  # Much larger and it takes forever.
+  switches = False
   for arg in sys.argv[1:]:
+    if arg == '--switches':
+      switches = True
+      continue
     try:
       n = int(arg)
       break
     except Exception:
       pass
+  if switches:
+    bench_switches(n)
+    return
   prof = cProfile.Profile()
   prof = prof.runctx('bench(%d)' % n, globals(), locals())
   stats = pstats.Stats(prof)
@@ -0,0 +1,108 @@
+"""Benchmark for the compiled per-model codec (see model._ModelCodec).
+
+Times Model._to_pb() and Model._from_pb(), and put_multi() and
+get_multi(), for a model with 50 properties, with the codec and with
+the generic per-property code it replaces.
+
+Run this using 'make codecbench', optionally passing an entity count,
+e.g. 'make codecbench FLAGS=2000'.
+"""
+
+import sys
+import time
+
+# Pay no attention to the testbed behind the curtain.
+from google.appengine.ext import testbed
+tb = testbed.Testbed()
+tb.activate()
+tb.init_datastore_v3_stub()
+tb.init_memcache_stub()
+
+import ndb
+
+N = 1000
+NPROPS = 50
+
+# A model with NPROPS properties of a few common types.
+_classdict = {}
+for _i in xrange(NPROPS):
+  if _i % 5 == 0:
+    _prop = ndb.IntegerProperty()
+  elif _i % 5 == 1:
+    _prop = ndb.FloatProperty(indexed=False)
+  elif _i % 5 == 2:
+    _prop = ndb.BooleanProperty()
+  elif _i % 5 == 3:
+    _prop = ndb.StringProperty(repeated=True)
+  else:
+    _prop = ndb.StringProperty()
+  _classdict['p%02d' % _i] = _prop
+Wide = ndb.MetaModel('Wide', (ndb.Model,), _classdict)
+
+
+def make_entity(i):
+  values = {}
+  for j in xrange(NPROPS):
+    if j % 5 == 0:
+      values['p%02d' % j] = i * j
+    elif j % 5 == 1:
+      values['p%02d' % j] = i / 3.0
+    elif j % 5 == 2:
+      values['p%02d' % j] = bool(i & 1)
+    elif j % 5 == 3:
+      values['p%02d' % j] = ['a%d' % i, 'b%d' % j]
+    else:
+      values['p%02d' % j] = 'value %d %d' % (i, j)
+  return Wide(**values)
+
+
+def timer(label, func, *args):
+  t0 = time.time()
+  result = func(*args)
+  t1 = time.time()
+  print '  %-10s %8.3f sec' % (label, t1 - t0)
+  return result
+
+
+def to_pb(ents):
+  return [ent._to_pb() for ent in ents]
+
+
+def from_pb(pbs):
+  return [Wide._from_pb(pb) for pb in pbs]
+
+
+def put(ents):
+  return ndb.put_multi(ents, use_cache=False, use_memcache=False)
+
+
+def get(keys):
+  return ndb.get_multi(keys, use_cache=False, use_memcache=False)
+
+
+def run(n):
+  pbs = timer('to_pb', to_pb, [make_entity(i) for i in xrange(n)])
+  ents = timer('from_pb', from_pb, pbs)
+  keys = timer('put', put, [make_entity(i) for i in xrange(n)])
+  timer('get', get, keys)
+  return [pb.Encode() for pb in pbs], ents
+
+
+def main():
+  try:
+    n = int(sys.argv[-1])
+  except Exception:
+    n = N
+  codec = Wide._codec
+  print '%d entities with %d properties, compiled codec:' % (n, NPROPS)
+  new_bytes, new_ents = run(n)
+  Wide._codec = None
+  print '%d entities with %d properties, generic code:' % (n, NPROPS)
+  old_bytes, old_ents = run(n)
+  Wide._codec = codec
+  assert new_bytes == old_bytes, 'Protobufs differ!'
+  assert new_ents == old_ents, 'Entities differ!'
+
+
+if __name__ == '__main__':
+  main()
@@ -138,7 +138,7 @@ IF /I "%TARGET%"=="serve" GOTO serve
 IF /I "%TARGET%"=="debug" GOTO debug
 IF /I "%TARGET%"=="deploy" GOTO deploy
 IF /I "%TARGET%"=="g" SET TARGET=gettaskletrace
-SET ONEOFF_TARGETS%=(bench, gettaskletrace, keybench, race, stress)
+SET ONEOFF_TARGETS%=(bench, codecbench, gettaskletrace, keybench, race, repeatedbench, stress, timerbench)
 FOR %%A IN %ONEOFF_TARGETS% DO IF /I "%TARGET%"=="%%A" GOTO oneoff
 IF /I "%TARGET%"=="python" GOTO python
 IF /I "%TARGET%"=="python_raw" GOTO pythonraw
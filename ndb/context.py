@@ -1,7 +1,18 @@
 """Context class."""
 
+from __future__ import with_statement
+del with_statement  # No need to export this.
+
+import collections
+import copy
+import hashlib
+import heapq
 import logging
+import math
+import struct
 import sys
+import threading
+import time
 
 from .google_imports import datastore  # For taskqueue coordination
 from .google_imports import datastore_errors
@@ -20,11 +31,16 @@ from . import eventloop
 from . import utils
 
 __all__ = ['Context', 'ContextOptions', 'TransactionOptions', 'AutoBatcher',
+           'ContextCache', 'LRUContextCache', 'L2EntityCache',
+           'get_l2_cache', 'set_l2_cache',
+           'NegativeCache', 'get_negative_cache', 'set_negative_cache',
            'EVENTUAL_CONSISTENCY',
            ]
 
 _LOCK_TIME = 32  # Time to lock out memcache.add() after datastore updates.
 _LOCKED = 0  # Special value to store in memcache indicating locked value.
+_NOT_CACHED = object()  # Sentinel for a key missing from the context cache.
+_MEMCACHE_DEADLINE = 5  # The memcache API's own default RPC deadline.
 
 
 # Constant for read_policy.
@@ -76,6 +92,98 @@ class ContextOptions(datastore_rpc.Configuration):
         'memcache_deadline should be an integer (%r)' % (value,))
     return value
 
+  @datastore_rpc.ConfigOption
+  def max_rpcs_in_flight(value):
+    if not isinstance(value, (int, long)) or value <= 0:
+      raise datastore_errors.BadArgumentError(
+        'max_rpcs_in_flight should be a positive integer (%r)' % (value,))
+    return value
+
+  @datastore_rpc.ConfigOption
+  def executor_decode_threshold(value):
+    if not isinstance(value, (int, long)) or value <= 0:
+      raise datastore_errors.BadArgumentError(
+        'executor_decode_threshold should be a positive integer (%r)' %
+        (value,))
+    return value
+
+  @datastore_rpc.ConfigOption
+  def lazy_decode(value):
+    if not isinstance(value, bool):
+      raise datastore_errors.BadArgumentError(
+        'lazy_decode should be a bool (%r)' % (value,))
+    return value
+
+  @datastore_rpc.ConfigOption
+  def strict_put_dedup(value):
+    if not isinstance(value, bool):
+      raise datastore_errors.BadArgumentError(
+        'strict_put_dedup should be a bool (%r)' % (value,))
+    return value
+
+  @datastore_rpc.ConfigOption
+  def batch_priority(value):
+    if not isinstance(value, (int, long)):
+      raise datastore_errors.BadArgumentError(
+        'batch_priority should be an integer (%r)' % (value,))
+    return value
+
+  @datastore_rpc.ConfigOption
+  def min_batch_size(value):
+    if not isinstance(value, (int, long)) or value <= 0:
+      raise datastore_errors.BadArgumentError(
+        'min_batch_size should be a positive integer (%r)' % (value,))
+    return value
+
+  @datastore_rpc.ConfigOption
+  def max_batch_linger_ms(value):
+    if not isinstance(value, (int, long, float)) or value < 0:
+      raise datastore_errors.BadArgumentError(
+        'max_batch_linger_ms should be a non-negative number (%r)' % (value,))
+    return value
+
+  @datastore_rpc.ConfigOption
+  def adaptive_batch_linger(value):
+    if not isinstance(value, bool):
+      raise datastore_errors.BadArgumentError(
+        'adaptive_batch_linger should be a bool (%r)' % (value,))
+    return value
+
+  @datastore_rpc.ConfigOption
+  def memcache_fused_lock(value):
+    if not isinstance(value, bool):
+      raise datastore_errors.BadArgumentError(
+        'memcache_fused_lock should be a bool (%r)' % (value,))
+    return value
+
+  @datastore_rpc.ConfigOption
+  def l2_cache_timeout(value):
+    if not isinstance(value, (int, long, float)):
+      raise datastore_errors.BadArgumentError(
+        'l2_cache_timeout should be a number (%r)' % (value,))
+    return value
+
+  @datastore_rpc.ConfigOption
+  def negative_cache_timeout(value):
+    if not isinstance(value, (int, long, float)):
+      raise datastore_errors.BadArgumentError(
+        'negative_cache_timeout should be a number (%r)' % (value,))
+    return value
+
+  @datastore_rpc.ConfigOption
+  def max_cache_items(value):
+    if not isinstance(value, (int, long)) or value <= 0:
+      raise datastore_errors.BadArgumentError(
+        'max_cache_items should be a positive integer (%r)' % (value,))
+    return value
+
+  @datastore_rpc.ConfigOption
+  def max_cache_bytes(value):
+    if not isinstance(value, (int, long)) or value <= 0:
+      raise datastore_errors.BadArgumentError(
+        'max_cache_bytes should be a positive integer (%r)' % (value,))
+    return value
+
 class TransactionOptions(ContextOptions, datastore_rpc.TransactionOptions):
   """Support both context options and transaction options."""
 
@@ -136,6 +244,9 @@ class AutoBatcher(object):
   *) After processing immediate callbacks, eventloop will run idlers.
      AutoBatcher._on_idle is an idler.
   *) _on_idle will run the "todo_tasklet" before the batch is full.
+  *) Batches that are not full are run in order of decreasing priority
+     (see add()), and in FIFO order of their first add() call within the
+     same priority.
 
   So the engine is todo_tasklet, which is a proxy tasklet that can combine
   arguments into batches and passes along results back to respective futures.
@@ -143,6 +254,11 @@ class AutoBatcher(object):
   arguments at the right time.
   """
 
+  # Defaults for set_flush_policy().
+  _DEFAULT_LINGER_MS = 10
+  _ADAPTIVE_FRACTION = 0.1  # Linger at most this fraction of RPC latency.
+  _LATENCY_WEIGHT = 0.2  # Weight of a new sample in the latency average.
+
   def __init__(self, todo_tasklet, limit):
     """Init.
 
@@ -157,43 +273,301 @@ class AutoBatcher(object):
     # A map from "options" to a list of (future, arg) tuple.
     # future is the future return from a single async operations.
     self._queues = {}
+    # A heap of (-priority, seq, options) giving the order to run queues.
+    # Entries that don't match self._ranks are stale and skipped.
+    self._order = []
+    self._ranks = {}  # Maps "options" to its current (-priority, seq).
+    self._seq = 0
     self._running = []  # A list of in-flight todo_tasklet futures.
     self._cache = {}  # Cache of in-flight todo_tasklet futures.
+    # Flush policy; see set_flush_policy().
+    self._min_batch_size = 1
+    self._max_linger = None  # In seconds; None means flush when idle.
+    self._adaptive = False
+    self._latency = None  # Moving average of batch latency in seconds.
+    self._started = {}  # Maps "options" to the time its queue was created.
+    self._timer = None  # Event loop handle of the pending linger timer.
+    self._histogram = {}  # Maps a power of two to a count of batches.
+    self._dedup_key = None  # See set_dedup().
+    self._dedup_merge = None
+    self._limiter = None  # See set_limiter().
+    self._time_left = None  # See set_deadline_func().
+    self._deadline_config = None
 
   def __repr__(self):
     return '%s(%s)' % (self.__class__.__name__, self._todo_tasklet.__name__)
 
+  def set_flush_policy(self, min_batch_size=None, max_linger_ms=None,
+                       adaptive=False):
+    """Configure when a queue that is not yet full is flushed.
+
+    By default a queue is flushed as soon as the event loop is idle.
+    With a policy set, an idle event loop only flushes queues that hold
+    at least min_batch_size items or that were created at least the
+    linger time ago; a timer on the event loop flushes the rest when
+    their linger time is up.
+
+    Args:
+      min_batch_size: Queues with fewer items may linger (default 1).
+      max_linger_ms: The longest a queue may linger, in milliseconds
+        (default _DEFAULT_LINGER_MS).
+      adaptive: If True, the linger time is _ADAPTIVE_FRACTION of the
+        observed batch latency, capped by max_linger_ms.
+    """
+    if min_batch_size is None:
+      min_batch_size = 1
+    if max_linger_ms is None:
+      max_linger_ms = self._DEFAULT_LINGER_MS
+    self._min_batch_size = min_batch_size
+    self._max_linger = max_linger_ms / 1000.0
+    self._adaptive = adaptive
+    # Queues created before the policy was set start lingering now.
+    now = time.time()
+    for options in self._queues:
+      self._started.setdefault(options, now)
+
+  def _get_linger(self):
+    """Return the current linger time in seconds."""
+    if self._adaptive:
+      if self._latency is None:
+        return 0  # Nothing measured yet; don't delay the first batch.
+      return min(self._max_linger, self._latency * self._ADAPTIVE_FRACTION)
+    return self._max_linger
+
+  def set_limiter(self, limiter):
+    """Run batches through a _BatchLimiter (or None for no limit)."""
+    self._limiter = limiter
+
+  def set_deadline_func(self, func, config=None):
+    """Trim the RPC deadline of each batch to the time that is left.
+
+    When a batch is run its futures fail with tasklets.TimeoutError
+    right away if no time is left; otherwise its options get a deadline
+    of at most the time left.
+
+    Args:
+      func: A function returning the seconds left, or None for no limit.
+        Pass None instead of a function to turn this off.
+      config: Optional Configuration whose deadline applies when the
+        options of a batch don't set one (e.g. the connection's config).
+    """
+    self._time_left = func
+    self._deadline_config = config
+
+  def _trim_deadline(self, options, left):
+    """Return options with a deadline of at most left seconds."""
+    deadline = datastore_rpc.Configuration.deadline(options,
+                                                    self._deadline_config)
+    if deadline is not None and deadline <= left:
+      return options
+    if options is None:
+      return ContextOptions(deadline=left)
+    return options.__class__(deadline=left, config=options)
+
+  def set_dedup(self, key_func, merge_func=None):
+    """Collapse items with the same key into one before running a batch.
+
+    The collapsed item takes the place of the first of its duplicates,
+    and its result (or exception) is passed on to all their futures.
+
+    Args:
+      key_func: A function taking an arg passed to add() and returning a
+        hashable key, or None if the arg must not be collapsed.
+      merge_func: Optional function taking a list of two or more args
+        with the same key and the rpc options, and returning the arg to
+        run in their place.  If it raises an exception, that is set on
+        the futures for those args.  By default the last arg is used.
+    """
+    self._dedup_key = key_func
+    self._dedup_merge = merge_func
+
+  def _dedup(self, options, todo):
+    """Return todo with duplicate items collapsed; see set_dedup()."""
+    keys = [self._dedup_key(arg) for _, arg in todo]
+    groups = {}
+    count = 0
+    for key, item in zip(keys, todo):
+      if key is not None:
+        groups.setdefault(key, []).append(item)
+        count += 1
+    if len(groups) == count:
+      return todo  # No duplicates.
+    new_todo = []
+    for key, item in zip(keys, todo):
+      if key is None:
+        new_todo.append(item)
+        continue
+      group = groups.pop(key, None)
+      if group is None:
+        continue  # Collapsed into an earlier item.
+      if len(group) == 1:
+        new_todo.append(item)
+        continue
+      args = [arg for _, arg in group]
+      futs = [fut for fut, _ in group]
+      try:
+        if self._dedup_merge is None:
+          arg = args[-1]
+        else:
+          arg = self._dedup_merge(args, options)
+      except Exception, err:
+        tb = sys.exc_info()[2]
+        for fut in futs:
+          fut.set_exception(err, tb)
+        continue
+      group_fut = tasklets.Future()
+      group_fut.add_immediate_callback(self._fan_out, group_fut, futs)
+      new_todo.append((group_fut, arg))
+    return new_todo
+
+  def _fan_out(self, group_fut, futs):
+    err = group_fut.get_exception()
+    if err is not None:
+      tb = group_fut.get_traceback()
+      for fut in futs:
+        if not fut.done():
+          fut.set_exception(err, tb)
+    else:
+      result = group_fut.get_result()
+      for fut in futs:
+        if not fut.done():
+          fut.set_result(result)
+
+  def batch_size_histogram(self):
+    """Return a histogram of the sizes of the batches run so far.
+
+    Returns:
+      A dict mapping a power of two N to the number of batches whose
+      size was greater than N/2 and at most N.
+    """
+    return dict(self._histogram)
+
   def run_queue(self, options, todo):
     """Actually run the _todo_tasklet."""
     utils.logging_debug('AutoBatcher(%s): %d items',
                         self._todo_tasklet.__name__, len(todo))
-    batch_fut = self._todo_tasklet(todo, options)
+    self._started.pop(options, None)
+    if self._timer is not None and not self._queues:
+      eventloop.cancel_call(self._timer)
+      self._timer = None
+    # Drop the items whose Futures were cancelled while queued.
+    todo = [item for item in todo if not item[0].done()]
+    if not todo:
+      return
+    batch_todo = todo
+    if self._dedup_key is not None:
+      batch_todo = self._dedup(options, todo)
+      if not batch_todo:
+        return  # Every item failed in the merge function.
+    bucket = 1
+    while bucket < len(batch_todo):
+      bucket <<= 1
+    self._histogram[bucket] = self._histogram.get(bucket, 0) + 1
+    if self._limiter is None:
+      batch_fut = self._start_batch(batch_todo, options)
+    else:
+      batch_fut = self._limiter.run(self._start_batch, batch_todo, options)
     self._running.append(batch_fut)
     # Add a callback when we're done.
     batch_fut.add_callback(self._finished_callback, batch_fut, todo)
 
+  def _start_batch(self, todo, options):
+    """Run the _todo_tasklet on a batch, now that it may start.
+
+    With a limiter this is called when the limiter actually starts the
+    batch, so the time it spent waiting there counts against the
+    deadline and not towards the measured batch latency.
+
+    Returns:
+      A Future for the batch.
+    """
+    if self._time_left is not None:
+      left = self._time_left()
+      if left is not None:
+        if left <= 0:
+          err = tasklets.TimeoutError('Deadline passed before %s could run' %
+                                      self._todo_tasklet.__name__)
+          for fut, _ in todo:
+            fut.set_exception(err)
+          batch_fut = tasklets.Future()
+          batch_fut.set_result(None)
+          return batch_fut
+        options = self._trim_deadline(options, left)
+    batch_fut = self._todo_tasklet(todo, options)
+    batch_fut.add_callback(self._record_latency, time.time())
+    return batch_fut
+
+  def _record_latency(self, started):
+    """Add the latency of a batch started at the given time to the average."""
+    latency = time.time() - started
+    if self._latency is None:
+      self._latency = latency
+    else:
+      self._latency += self._LATENCY_WEIGHT * (latency - self._latency)
+
   def _on_idle(self):
     """An idler eventloop can run.
 
     Eventloop calls this when it has finished processing all immediate
-    callbacks. This method runs _todo_tasklet even before the batch is full.
+    callbacks. This method runs _todo_tasklet even before the batch is full,
+    subject to the flush policy.
     """
-    if not self.action():
+    if self._max_linger is None:
+      if not self.action():
+        return None
+      return True
+    if not self._queues:
       return None
-    return True
+    if self._run_ready_queues():
+      return True
+    self._schedule_timer()
+    return False
 
-  def add(self, arg, options=None):
+  def _run_ready_queues(self):
+    """Run the queues that the flush policy allows to run now.
+
+    Returns:
+      True if any queue was run.
+    """
+    linger = self._get_linger()
+    now = time.time()
+    ran = False
+    for options in sorted(self._queues, key=self._ranks.__getitem__):
+      todo = self._queues[options]
+      if (len(todo) >= self._min_batch_size or
+          now >= self._started.get(options, 0) + linger):
+        self.run_queue(options, self._take_queue(options))
+        ran = True
+    return ran
+
+  def _schedule_timer(self):
+    """Schedule _on_timer() for when the oldest queue stops lingering."""
+    if self._timer is not None:
+      eventloop.cancel_call(self._timer)
+    when = min(self._started.itervalues()) + self._get_linger()
+    self._timer = eventloop.queue_call(max(0, when - time.time()),
+                                       self._on_timer)
+
+  def _on_timer(self):
+    self._timer = None
+    self._run_ready_queues()
+    if self._queues:
+      self._schedule_timer()
+
+  def add(self, arg, options=None, priority=0):
     """Adds an arg and gets back a future.
 
     Args:
       arg: one argument for _todo_tasklet.
       options: rpc options.
+      priority: queues with a higher priority are run first; a queue
+        has the highest priority of the calls that added to it.
 
     Return:
       An instance of future, representing the result of running
         _todo_tasklet without batching.
     """
-    fut = tasklets.Future('%s.add(%s, %s)' % (self, arg, options))
+    fut = tasklets.Future((self._add_info, arg, options))
     todo = self._queues.get(options)
     if todo is None:
       utils.logging_debug('AutoBatcher(%s): creating new queue for %r',
@@ -201,28 +575,53 @@ class AutoBatcher(object):
       if not self._queues:
         eventloop.add_idle(self._on_idle)
       todo = self._queues[options] = []
+      self._seq += 1
+      self._set_rank(options, (-priority, self._seq))
+      if self._max_linger is not None:
+        self._started[options] = time.time()
+    else:
+      rank = self._ranks[options]
+      if -priority < rank[0]:
+        self._set_rank(options, (-priority, rank[1]))
     todo.append((fut, arg))
     if len(todo) >= self._limit:
-      del self._queues[options]
-      self.run_queue(options, todo)
+      self.run_queue(options, self._take_queue(options))
     return fut
 
-  def add_once(self, arg, options=None):
+  def _add_info(self, arg, options):
+    return '%s.add(%s, %s)' % (self, arg, options)
+
+  def add_once(self, arg, options=None, priority=0):
     cache_key = (arg, options)
     fut = self._cache.get(cache_key)
     if fut is None:
-      fut = self.add(arg, options)
+      fut = self.add(arg, options, priority)
       self._cache[cache_key] = fut
       fut.add_immediate_callback(self._cache.__delitem__, cache_key)
     return fut
 
+  def _set_rank(self, options, rank):
+    self._ranks[options] = rank
+    heapq.heappush(self._order, (rank[0], rank[1], options))
+
+  def _take_queue(self, options):
+    """Remove the queue for the given options and return its todo list."""
+    del self._ranks[options]
+    if len(self._order) > 2 * len(self._ranks) + 16:
+      # Too many stale entries; rebuild the heap from the live ranks.
+      self._order = [(rank[0], rank[1], opts)
+                     for opts, rank in self._ranks.iteritems()]
+      heapq.heapify(self._order)
+    return self._queues.pop(options)
+
   def action(self):
-    queues = self._queues
-    if not queues:
-      return False
-    options, todo = queues.popitem()  # TODO: Should this use FIFO ordering?
-    self.run_queue(options, todo)
-    return True
+    order = self._order
+    while order:
+      neg_priority, seq, options = heapq.heappop(order)
+      if self._ranks.get(options) == (neg_priority, seq):
+        self.run_queue(options, self._take_queue(options))
+        return True
+    return False
 
   def _finished_callback(self, batch_fut, todo):
     """Passes exception along.
@@ -250,15 +649,692 @@ class AutoBatcher(object):
         yield self._running  # A list of Futures
 
 
+def _approximate_size(value):
+  """Cheap estimate of the memory used by a value in the context cache.
+
+  This only looks at the containers that entities are made of (Model
+  instances, lists and the _BaseValue/_CompressedValue wrappers); it is
+  meant for budgeting, not for accounting.
+  """
+  size = sys.getsizeof(value)
+  if isinstance(value, model.Model):
+    size += sys.getsizeof(value._values)
+    for val in value._values.itervalues():
+      size += _approximate_size(val)
+    if value._lazy_pbs is not None:
+      for entries in value._lazy_pbs.itervalues():
+        for p, unused_indexed in entries:
+          size += p.ByteSize()
+  elif isinstance(value, (list, tuple)):
+    for val in value:
+      size += _approximate_size(val)
+  elif isinstance(value, model._BaseValue):
+    size += _approximate_size(value.b_val)
+  elif isinstance(value, model._CompressedValue):
+    size += sys.getsizeof(value.z_val)
+  return size
+
+
+class ContextCache(dict):
+  """The default in-process cache for Context: an unbounded dict.
+
+  Keys are Key instances; values are Model instances or None (meaning
+  the entity is known not to exist).  Context only looks up entries
+  through get(), so that is where hits and misses are counted.
+
+  A replacement cache class must support the dict operations used by
+  Context (get(), __contains__(), __getitem__(), __setitem__(),
+  update(), clear() and iteration over keys) as well as stats(), and
+  its constructor must accept the max_items and max_bytes keyword
+  arguments.
+  """
+
+  def __init__(self, max_items=None, max_bytes=None):
+    super(ContextCache, self).__init__()
+    self._max_items = max_items
+    self._max_bytes = max_bytes
+    self._hits = 0
+    self._misses = 0
+    self._evictions = 0
+
+  def get(self, key, default=None):
+    try:
+      value = self[key]
+    except KeyError:
+      self._misses += 1
+      return default
+    self._hits += 1
+    return value
+
+  def stats(self):
+    """Return a dict with hits, misses, evictions, items and bytes.
+
+    The bytes entry is None unless the cache keeps track of sizes.
+    """
+    return {'hits': self._hits,
+            'misses': self._misses,
+            'evictions': self._evictions,
+            'items': len(self),
+            'bytes': None,
+            }
+
+
+class LRUContextCache(object):
+  """A context cache bounded by entry count and/or approximate size.
+
+  When either limit is exceeded the least recently used entries are
+  evicted (but never the one that was stored last).  Sizes are
+  estimated by _approximate_size() when an entry is stored.
+
+  This supports the same mapping operations as ContextCache, but it is
+  not a dict: entries are kept in a private dict mapping each key to a
+  [prev, next, key, value, size] link of a circular doubly-linked list,
+  ordered from least to most recently used, so that no dict method can
+  hand out links instead of values.
+  """
+
+  __hash__ = None  # Mutable, like a dict.
+
+  def __init__(self, max_items=None, max_bytes=None):
+    self._max_items = max_items
+    self._max_bytes = max_bytes
+    self._links = {}
+    self._root = root = []
+    root[:] = [root, root, None, None, 0]
+    self._bytes = 0
+    self._hits = 0
+    self._misses = 0
+    self._evictions = 0
+
+  def __repr__(self):
+    return '%s(%d items, %d bytes)' % (self.__class__.__name__,
+                                       len(self), self._bytes)
+
+  def __eq__(self, other):
+    if isinstance(other, LRUContextCache):
+      other = dict(other.iteritems())
+    elif not isinstance(other, dict):
+      return NotImplemented
+    return dict(self.iteritems()) == other
+
+  def __ne__(self, other):
+    eq = self.__eq__(other)
+    if eq is NotImplemented:
+      return eq
+    return not eq
+
+  def __len__(self):
+    return len(self._links)
+
+  def __contains__(self, key):
+    return key in self._links
+
+  has_key = __contains__
+
+  def __iter__(self):
+    return iter(self._links)
+
+  iterkeys = __iter__
+
+  def keys(self):
+    return self._links.keys()
+
+  def _touch(self, link):
+    # Move a link to the most recently used end of the list.
+    prev, next = link[0], link[1]
+    prev[1] = next
+    next[0] = prev
+    root = self._root
+    last = root[0]
+    last[1] = root[0] = link
+    link[0] = last
+    link[1] = root
+
+  def _unlink(self, link):
+    prev, next = link[0], link[1]
+    prev[1] = next
+    next[0] = prev
+    self._bytes -= link[4]
+
+  def __getitem__(self, key):
+    link = self._links[key]
+    self._touch(link)
+    return link[3]
+
+  def get(self, key, default=None):
+    link = self._links.get(key)
+    if link is None:
+      self._misses += 1
+      return default
+    self._hits += 1
+    self._touch(link)
+    return link[3]
+
+  def __setitem__(self, key, value):
+    size = 0
+    if self._max_bytes is not None:
+      size = _approximate_size(value)
+    link = self._links.get(key)
+    if link is not None:
+      self._bytes += size - link[4]
+      link[3] = value
+      link[4] = size
+      self._touch(link)
+    else:
+      root = self._root
+      last = root[0]
+      link = [last, root, key, value, size]
+      last[1] = root[0] = link
+      self._links[key] = link
+      self._bytes += size
+    self._evict()
+
+  def _evict(self):
+    max_items = self._max_items
+    max_bytes = self._max_bytes
+    root = self._root
+    links = self._links
+    while ((max_items is not None and len(links) > max_items) or
+           (max_bytes is not None and self._bytes > max_bytes)):
+      link = root[1]
+      if link[1] is root:
+        break  # Never evict the most recently stored entry.
+      self._unlink(link)
+      del links[link[2]]
+      self._evictions += 1
+
+  def __delitem__(self, key):
+    link = self._links.pop(key)
+    self._unlink(link)
+
+  def pop(self, key, *default):
+    link = self._links.pop(key, None)
+    if link is None:
+      if default:
+        return default[0]
+      raise KeyError(key)
+    self._unlink(link)
+    return link[3]
+
+  def popitem(self):
+    """Remove and return the least recently used (key, value) pair."""
+    link = self._root[1]
+    if link is self._root:
+      raise KeyError('popitem(): cache is empty')
+    del self._links[link[2]]
+    self._unlink(link)
+    return link[2], link[3]
+
+  def setdefault(self, key, default=None):
+    if key in self._links:
+      return self[key]
+    self[key] = default
+    return default
+
+  def update(self, other):
+    if hasattr(other, 'iteritems'):
+      other = other.iteritems()
+    for key, value in other:
+      self[key] = value
+
+  def clear(self):
+    self._links.clear()
+    root = self._root
+    root[:] = [root, root, None, None, 0]
+    self._bytes = 0
+
+  def itervalues(self):
+    for link in self._links.itervalues():
+      yield link[3]
+
+  def iteritems(self):
+    for key, link in self._links.iteritems():
+      yield key, link[3]
+
+  def values(self):
+    return list(self.itervalues())
+
+  def items(self):
+    return list(self.iteritems())
+
+  def copy(self):
+    """Return a plain dict with the same entries (like ContextCache)."""
+    return dict(self.iteritems())
+
+  def stats(self):
+    """Return a dict like ContextCache.stats()."""
+    return {'hits': self._hits,
+            'misses': self._misses,
+            'evictions': self._evictions,
+            'items': len(self),
+            'bytes': self._bytes if self._max_bytes is not None else None,
+            }
+
+
+class L2EntityCache(object):
+  """A thread-safe cache of serialized entities shared by all Contexts.
+
+  Context.get() consults this after its own cache and before memcache,
+  for keys whose L2 cache timeout (see Context._get_l2_cache_timeout())
+  is positive.  Entities are stored as serialized EntityProto strings,
+  so each get() decodes a fresh Model instance and no mutable state is
+  shared between requests or threads.
+
+  Context.put() and Context.delete() invalidate the key in this process
+  only; other instances see updates only once the entry expires.
+
+  To guard against storing an entity read before a concurrent write,
+  a Context takes a token from generation before it starts looking
+  for a value and passes it to set(); the value is dropped if the key
+  was invalidated after the token was taken.
+  """
+
+  _max_invalidated = 10000  # How many invalidated keys to remember.
+
+  def __init__(self, max_items=None, max_bytes=None):
+    self._lock = threading.Lock()
+    self._cache = LRUContextCache(max_items=max_items, max_bytes=max_bytes)
+    self._invalidated = {}  # Maps key to generation when invalidated.
+    self._floor = 0  # Tokens below this are rejected by set().
+    self._expirations = 0
+    self.generation = 0
+
+  def get(self, key):
+    """Return the serialized entity for a key, or None."""
+    with self._lock:
+      entry = self._cache.get(key)
+      if entry is None:
+        return None
+      expires, pbs = entry
+      if expires < time.time():
+        del self._cache[key]
+        self._expirations += 1
+        return None
+      return pbs
+
+  def set(self, key, pbs, timeout, token):
+    """Store a serialized entity for timeout seconds.
+
+    Returns:
+      True if stored, False if the key was invalidated after token
+      was taken.
+    """
+    with self._lock:
+      if token < self._floor or self._invalidated.get(key, -1) > token:
+        return False
+      self._cache[key] = (time.time() + timeout, pbs)
+      return True
+
+  def invalidate(self, key):
+    """Remove a key and reject any set() using an earlier token."""
+    with self._lock:
+      self.generation += 1
+      if len(self._invalidated) >= self._max_invalidated:
+        self._invalidated.clear()
+        self._floor = self.generation
+      self._invalidated[key] = self.generation
+      self._cache.pop(key, None)
+
+  def clear(self):
+    with self._lock:
+      self.generation += 1
+      self._invalidated.clear()
+      self._floor = self.generation
+      self._cache.clear()
+
+  def stats(self):
+    """Return a dict like ContextCache.stats() plus 'expirations'.
+
+    An expired entry found by get() counts as a miss.
+    """
+    with self._lock:
+      stats = self._cache.stats()
+      stats['hits'] -= self._expirations
+      stats['misses'] += self._expirations
+      stats['expirations'] = self._expirations
+      return stats
+
+
+_l2_cache = None
+
+
+def get_l2_cache():
+  """Return the process-wide L2EntityCache, or None if not enabled."""
+  return _l2_cache
+
+
+def set_l2_cache(cache):
+  """Install (or with None, remove) the process-wide L2EntityCache.
+
+  Example:
+    ndb.set_l2_cache(ndb.L2EntityCache(max_items=10000))
+
+  Only model classes with a positive _l2_cache_timeout (or keys for
+  which the L2 cache timeout policy or the l2_cache_timeout option is
+  positive) use the cache.
+  """
+  global _l2_cache
+  if cache is not None and not isinstance(cache, L2EntityCache):
+    raise TypeError('cache must be an L2EntityCache; received %r' % (cache,))
+  _l2_cache = cache
+
+
+class _BloomFilter(object):
+  """A fixed-size Bloom filter over 128-bit key digests.
+
+  Bit positions are derived from the two halves of the digest by
+  double hashing.  The bits live in a bytearray, so the memory use is
+  about -capacity * ln(error_rate) / ln(2)**2 bits regardless of the
+  number of entries added.
+  """
+
+  def __init__(self, capacity, error_rate):
+    nbits = int(math.ceil(-capacity * math.log(error_rate) /
+                          (math.log(2) ** 2)))
+    self._nbits = max(8, nbits)
+    self._nhashes = max(1, int(round(self._nbits * math.log(2) / capacity)))
+    self._bits = bytearray((self._nbits + 7) // 8)
+    self.count = 0
+
+  def _positions(self, digest):
+    h1, h2 = struct.unpack('<QQ', digest)
+    nbits = self._nbits
+    for i in xrange(self._nhashes):
+      yield (h1 + i * h2) % nbits
+
+  def add(self, digest):
+    bits = self._bits
+    for pos in self._positions(digest):
+      bits[pos >> 3] |= 1 << (pos & 7)
+    self.count += 1
+
+  def __contains__(self, digest):
+    bits = self._bits
+    for pos in self._positions(digest):
+      if not bits[pos >> 3] & (1 << (pos & 7)):
+        return False
+    return True
+
+
+class _NegativeFilter(object):
+  """Confirmed misses for one kind and timeout, expiring by generation.
+
+  There are two Bloom filters: misses are added to the current one,
+  and both are consulted.  Every timeout/2 seconds (or sooner, when
+  the current one reaches half the capacity) the older filter is
+  dropped, so a miss is remembered for between timeout/2 and timeout
+  seconds.  Bloom filters can't forget single entries, so invalidated
+  keys that may still be present are kept in an exact overrides dict,
+  which is pruned when the filters they could be in are dropped.
+  """
+
+  def __init__(self, timeout, capacity, error_rate):
+    self._span = timeout / 2.0
+    self._gen_capacity = max(1, capacity // 2)
+    self._error_rate = error_rate
+    self._generation = 0
+    self._current = self._new_filter()
+    self._previous = None
+    self._started = time.time()
+    self._overrides = {}  # Maps digest to generation when overridden.
+
+  def _new_filter(self):
+    # Two filters are consulted, so each gets half the error rate.
+    return _BloomFilter(self._gen_capacity, self._error_rate / 2.0)
+
+  def _maybe_rotate(self):
+    now = time.time()
+    if now - self._started >= 2 * self._span:
+      self._previous = None
+      self._current = self._new_filter()
+      self._generation += 2
+      self._started = now
+      self._overrides.clear()
+    elif (now - self._started >= self._span or
+          self._current.count >= self._gen_capacity):
+      self._previous = self._current
+      self._current = self._new_filter()
+      self._generation += 1
+      self._started = now
+      oldest = self._generation - 1
+      for digest, generation in self._overrides.items():
+        if generation < oldest:
+          del self._overrides[digest]
+
+  def add(self, digest):
+    self._maybe_rotate()
+    self._overrides.pop(digest, None)
+    self._current.add(digest)
+
+  def __contains__(self, digest):
+    self._maybe_rotate()
+    if digest in self._overrides:
+      return False
+    return (digest in self._current or
+            (self._previous is not None and digest in self._previous))
+
+  def invalidate(self, digest):
+    if digest in self:
+      self._overrides[digest] = self._generation
+
+
+class NegativeCache(object):
+  """A thread-safe, process-wide memory of keys known not to exist.
+
+  Context.get() consults this before memcache and the datastore for
+  keys whose negative cache timeout (see
+  Context._get_negative_cache_timeout()) is positive, and records a
+  miss when the datastore returns nothing.  Each kind (and timeout)
+  gets its own pair of Bloom filters sized by capacity and
+  error_rate, so a million remembered misses take about 2.6 MB at the
+  default error rate.
+
+  NOTE: A Bloom filter has false positives: with probability up to
+  error_rate, get() returns None for a key that does exist.  Only
+  enable this for kinds where that is acceptable (e.g. dedup markers)
+  and choose error_rate accordingly.
+
+  Context.put() invalidates the key in this process only.  A miss
+  recorded concurrently with a put of the same kind is dropped (the
+  same token scheme as L2EntityCache, but per kind).
+  """
+
+  def __init__(self, capacity=1000000, error_rate=1e-4):
+    if not isinstance(capacity, (int, long)) or capacity <= 0:
+      raise ValueError('capacity must be a positive integer; received %r' %
+                       (capacity,))
+    if not 0 < error_rate < 1:
+      raise ValueError('error_rate must be between 0 and 1; received %r' %
+                       (error_rate,))
+    self._capacity = capacity
+    self._error_rate = error_rate
+    self._lock = threading.Lock()
+    self._filters = {}  # Maps (kind, timeout) to _NegativeFilter.
+    self._generations = {}  # Maps kind to invalidation count.
+    self._clears = 0  # Number of clear() calls.
+    self._hits = 0
+    self._misses = 0
+
+  @staticmethod
+  def _digest(key):
+    return hashlib.md5(key.serialized()).digest()
+
+  def token(self, key):
+    """Return a token to pass to add() for this key."""
+    return (self._clears, self._generations.get(key.kind(), 0))
+
+  def contains(self, key, timeout):
+    """Return True if the key is (probably) known not to exist."""
+    digest = self._digest(key)
+    with self._lock:
+      filt = self._filters.get((key.kind(), timeout))
+      if filt is not None and digest in filt:
+        self._hits += 1
+        return True
+      self._misses += 1
+      return False
+
+  def add(self, key, timeout, token):
+    """Remember that a key doesn't exist for about timeout seconds.
+
+    Returns:
+      True if added, False if the kind saw an invalidation after token
+      was taken.
+    """
+    digest = self._digest(key)
+    kind = key.kind()
+    with self._lock:
+      if (self._clears, self._generations.get(kind, 0)) != token:
+        return False
+      filt = self._filters.get((kind, timeout))
+      if filt is None:
+        filt = self._filters[(kind, timeout)] = _NegativeFilter(
+          timeout, self._capacity, self._error_rate)
+      filt.add(digest)
+      return True
+
+  def invalidate(self, key):
+    """Forget that a key doesn't exist (because it is being written)."""
+    kind = key.kind()
+    with self._lock:
+      # Even without a filter for the kind, a miss may be on its way.
+      self._generations[kind] = self._generations.get(kind, 0) + 1
+      filters = [filt for (filt_kind, _), filt in self._filters.iteritems()
+                 if filt_kind == kind]
+      if not filters:
+        return
+      digest = self._digest(key)
+      for filt in filters:
+        filt.invalidate(digest)
+
+  def clear(self):
+    with self._lock:
+      self._filters.clear()
+      self._clears += 1
+
+  def stats(self):
+    """Return a dict with hits, misses and kinds."""
+    with self._lock:
+      return {'hits': self._hits,
+              'misses': self._misses,
+              'kinds': len(set(kind for kind, _ in self._filters)),
+              }
+
+
+_negative_cache = None
+
+
+def get_negative_cache():
+  """Return the process-wide NegativeCache, or None if not enabled."""
+  return _negative_cache
+
+
+def set_negative_cache(cache):
+  """Install (or with None, remove) the process-wide NegativeCache.
+
+  Only model classes with a positive _negative_cache_timeout (or keys
+  for which the negative cache timeout policy or the
+  negative_cache_timeout option is positive) use the cache.
+  """
+  global _negative_cache
+  if cache is not None and not isinstance(cache, NegativeCache):
+    raise TypeError('cache must be a NegativeCache; received %r' % (cache,))
+  _negative_cache = cache
+
+
+def _decode_entity_pbs(adapter, pbs, lazy=None):
+  """Convert a list of entity protobufs (or None) to entities.
+
+  With the executor_decode_threshold option this runs in a worker
+  thread, concurrently with the event loop and with other decodes, and
+  without the request's environment.  This is safe because decoding
+  only uses the protobufs and class-level state that doesn't change
+  after a model class is created (the kind map, properties and codec):
+  Keys are built from the protobuf references, so they never look at
+  the default app or namespace in os.environ, and fake properties for
+  Expando entities are added to the entity's own property dict.  (The
+  method caches filled in by Property._find_methods() may be computed
+  twice, which is harmless.)  Model classes that override _from_pb()
+  or Property classes that override _deserialize() or _db_get_value()
+  to use the context or os.environ must not be decoded this way;
+  conversions done by _from_base_type() happen on first access, in
+  the calling thread.
+  """
+  entities = []
+  for pb in pbs:
+    if pb is not None:
+      pb = adapter.pb_to_entity(pb, lazy)
+    entities.append(pb)
+  return entities
+
+
+class _BatchLimiter(object):
+  """Caps the number of batches in flight across several AutoBatchers.
+
+  Batches started while the cap is reached wait in FIFO order until an
+  earlier batch completes.  A waiting batch is represented by a Future
+  that receives the result of the batch once it has run, so flush()
+  waits for it like for any other running batch.
+  """
+
+  def __init__(self, limit):
+    self._limit = limit
+    self._in_flight = 0
+    self._waiting = collections.deque()  # (future, tasklet, args) tuples.
+    self._releasing = False
+    self._max_waiting = 0
+
+  def run(self, todo_tasklet, *args):
+    """Run todo_tasklet(*args) now or when there is room.
+
+    Returns:
+      A Future for the result of todo_tasklet(*args).
+    """
+    if self._in_flight < self._limit:
+      return self._start(todo_tasklet, args)
+    fut = tasklets.Future()
+    self._waiting.append((fut, todo_tasklet, args))
+    self._max_waiting = max(self._max_waiting, len(self._waiting))
+    return fut
+
+  def _start(self, todo_tasklet, args):
+    self._in_flight += 1
+    batch_fut = todo_tasklet(*args)
+    batch_fut.add_immediate_callback(self._release)
+    return batch_fut
+
+  def _release(self):
+    self._in_flight -= 1
+    if self._releasing:
+      return  # A batch completed synchronously inside the loop below.
+    self._releasing = True
+    try:
+      while self._waiting and self._in_flight < self._limit:
+        fut, todo_tasklet, args = self._waiting.popleft()
+        batch_fut = self._start(todo_tasklet, args)
+        batch_fut.add_immediate_callback(tasklets._transfer_result,
+                                         batch_fut, fut)
+    finally:
+      self._releasing = False
+
+  def stats(self):
+    """Return a dict with the in_flight, waiting and max_waiting counts."""
+    return {'in_flight': self._in_flight,
+            'waiting': len(self._waiting),
+            'max_waiting': self._max_waiting}
+
+
 class Context(object):
 
   def __init__(self, conn=None, auto_batcher_class=AutoBatcher, config=None,
-               parent_context=None):
+               parent_context=None, cache_class=None):
     # NOTE: If conn is not None, config is only used to get the
-    # auto-batcher limits.
+    # auto-batcher and cache limits.
     if conn is None:
       conn = model.make_connection(config)
     self._conn = conn
+    self._undecoded_conn = None  # See _get_undecoded_conn().
+    self._deadline = None  # See set_deadline().
     self._auto_batcher_class = auto_batcher_class
     self._parent_context = parent_context  # For transaction nesting.
     # Get the get/put/delete limits (defaults 1000, 500, 500).
@@ -276,6 +1352,22 @@ class Context(object):
     self._get_batcher = auto_batcher_class(self._get_tasklet, max_get)
     self._put_batcher = auto_batcher_class(self._put_tasklet, max_put)
     self._delete_batcher = auto_batcher_class(self._delete_tasklet, max_delete)
+    # Collapse duplicate keys (and entities) within a batch.
+    self._get_batcher.set_dedup(self._dedup_key_key)
+    self._put_batcher.set_dedup(self._dedup_key_entity, self._merge_puts)
+    self._delete_batcher.set_dedup(self._dedup_key_key)
+    # Optionally cap the number of datastore RPCs these have in flight.
+    max_in_flight = ContextOptions.max_rpcs_in_flight(config, conn.config)
+    self._rpc_limiter = None
+    if max_in_flight is not None:
+      self._rpc_limiter = _BatchLimiter(max_in_flight)
+      for batcher in (self._get_batcher, self._put_batcher,
+                      self._delete_batcher):
+        batcher.set_limiter(self._rpc_limiter)
+    # Trim their RPC deadlines to the request deadline, if one is set.
+    for batcher in (self._get_batcher, self._put_batcher,
+                    self._delete_batcher):
+      batcher.set_deadline_func(self._time_left, conn.config)
     # We only have a single limit for memcache (default 1000).
     max_memcache = (ContextOptions.max_memcache_items(config, conn.config) or
                     datastore_rpc.Connection.MAX_GET_KEYS)
@@ -288,6 +1380,8 @@ class Context(object):
                                                     max_memcache)
     self._memcache_off_batcher = auto_batcher_class(self._memcache_off_tasklet,
                                                     max_memcache)
+    self._memcache_lock_batcher = auto_batcher_class(
+      self._memcache_lock_tasklet, max_memcache)
     # Create a list of batchers for flush().
     self._batchers = [self._get_batcher,
                       self._put_batcher,
@@ -296,8 +1390,29 @@ class Context(object):
                       self._memcache_set_batcher,
                       self._memcache_del_batcher,
                       self._memcache_off_batcher,
+                      self._memcache_lock_batcher,
                       ]
-    self._cache = {}
+    # Configure the flush policy, if any.
+    min_batch_size = ContextOptions.min_batch_size(config, conn.config)
+    max_linger_ms = ContextOptions.max_batch_linger_ms(config, conn.config)
+    adaptive = ContextOptions.adaptive_batch_linger(config, conn.config)
+    if (min_batch_size is not None or max_linger_ms is not None or
+        adaptive is not None):
+      for batcher in self._batchers:
+        batcher.set_flush_policy(min_batch_size=min_batch_size,
+                                 max_linger_ms=max_linger_ms,
+                                 adaptive=bool(adaptive))
+    # Create the in-process cache.  It is only bounded if a limit is
+    # configured (or a cache class that has its own limits is passed in).
+    max_cache_items = ContextOptions.max_cache_items(config, conn.config)
+    max_cache_bytes = ContextOptions.max_cache_bytes(config, conn.config)
+    if cache_class is None:
+      if max_cache_items is None and max_cache_bytes is None:
+        cache_class = ContextCache
+      else:
+        cache_class = LRUContextCache
+    self._cache = cache_class(max_items=max_cache_items,
+                              max_bytes=max_cache_bytes)
     self._memcache = memcache.Client()
     self._on_commit_queue = []
 
@@ -317,6 +1432,55 @@ class Context(object):
           more = True
           break
 
+  def set_deadline(self, seconds):
+    """Set a deadline for the datastore and memcache work of this context.
+
+    Batches are run with their RPC deadlines trimmed to the time left,
+    and memcache calls use at most that time as their deadline.  Once
+    the deadline has passed they fail with tasklets.TimeoutError right
+    away instead of holding up the request.  A transaction started from
+    this context inherits the deadline.
+
+    Args:
+      seconds: The number of seconds from now, or None to clear it.
+    """
+    if seconds is None:
+      self._deadline = None
+    else:
+      self._deadline = time.time() + seconds
+
+  def get_deadline(self):
+    """Return the deadline as a time.time() value, or None if not set."""
+    return self._deadline
+
+  def _time_left(self):
+    """Return the seconds left before the deadline, or None."""
+    if self._deadline is None:
+      return None
+    return self._deadline - time.time()
+
+  def _get_rpc_deadline(self, deadline, default=None):
+    """Return an RPC deadline trimmed to the time left.
+
+    Args:
+      deadline: The RPC deadline in seconds, or None.
+      default: The deadline that applies if deadline is None.
+
+    Raises:
+      tasklets.TimeoutError if the deadline set with set_deadline()
+      has passed.
+    """
+    left = self._time_left()
+    if left is None:
+      return deadline
+    if left <= 0:
+      raise tasklets.TimeoutError('Deadline passed before memcache call')
+    if deadline is None:
+      deadline = default
+    if deadline is None or deadline > left:
+      return left
+    return deadline
+
   @tasklets.tasklet
   def _get_tasklet(self, todo, options):
     if not todo:
@@ -326,24 +1490,102 @@ class Context(object):
     for unused_fut, key in todo:
       datastore_keys.append(key)
     # Now wait for the datastore RPC(s) and pass the results to the futures.
-    entities = yield self._conn.async_get(options, datastore_keys)
+    conn = self._get_undecoded_conn(options)
+    if conn is None:
+      entities = yield self._conn.async_get(options, datastore_keys)
+    else:
+      pbs = yield conn.async_get(options, datastore_keys)
+      entities = yield self._decode_entities(pbs, options)
     for ent, (fut, unused_key) in zip(entities, todo):
       fut.set_result(ent)
 
+  def _get_undecoded_conn(self, options):
+    """Return a Connection that leaves entities undecoded, or None.
+
+    This is only used if the executor_decode_threshold or lazy_decode
+    option is set; the protobufs it returns must be passed to
+    _decode_entities().  Transactional connections are not supported.
+    The Connection is created on first use and shared by all gets and
+    queries of this Context.
+    """
+    if (not ContextOptions.executor_decode_threshold(options,
+                                                     self._conn.config) and
+        ContextOptions.lazy_decode(options, self._conn.config) is None):
+      return None
+    if self._undecoded_conn is None:
+      if isinstance(self._conn, datastore_rpc.TransactionalConnection):
+        return None
+      adapter = copy.copy(self._conn.adapter)
+      adapter.pb_to_entity = lambda pb: pb
+      self._undecoded_conn = datastore_rpc.Connection(
+        adapter=adapter, config=self._conn.config)
+    return self._undecoded_conn
+
+  @tasklets.tasklet
+  def _decode_entities(self, pbs, options):
+    """Convert entity protobufs (or None) to entities.
+
+    Batches of at least executor_decode_threshold entities are decoded
+    using tasklets.run_in_executor(), so that other tasklets can make
+    progress meanwhile.  The lazy_decode option, if set, overrides the
+    model classes' _lazy_decode setting.
+    """
+    threshold = ContextOptions.executor_decode_threshold(options,
+                                                         self._conn.config)
+    lazy = ContextOptions.lazy_decode(options, self._conn.config)
+    adapter = self._conn.adapter
+    if threshold is not None and len(pbs) >= threshold:
+      entities = yield tasklets.run_in_executor(_decode_entity_pbs,
+                                                adapter, pbs, lazy)
+    else:
+      entities = _decode_entity_pbs(adapter, pbs, lazy)
+    raise tasklets.Return(entities)
+
+  @staticmethod
+  def _dedup_key_key(key):
+    return key
+
+  @staticmethod
+  def _dedup_key_entity(ent):
+    # Each put of an entity with an incomplete key creates a new entity,
+    # even if the same entity object is put twice, so never collapse it.
+    if ent._has_complete_key():
+      return ent._key
+    return None
+
+  def _merge_puts(self, ents, options):
+    """Pick the entity to put for several puts of the same key in a batch.
+
+    The last entity wins, unless the strict_put_dedup option is set and
+    the entities differ, in which case BadRequestError is raised.
+    """
+    last = ents[-1]
+    if ContextOptions.strict_put_dedup(options, self._conn.config):
+      for ent in ents:
+        if ent is not last and ent != last:
+          raise datastore_errors.BadRequestError(
+            'Different entities with key %r put in the same batch' %
+            (last._key,))
+    return last
+
   @tasklets.tasklet
   def _put_tasklet(self, todo, options):
     if not todo:
       raise RuntimeError('Nothing to do.')
-    # TODO: What if the same entity is being put twice?
-    # TODO: What if two entities with the same key are being put?
+    # Entities with the same complete key have already been collapsed by
+    # the AutoBatcher; see _merge_puts().  An entity with an incomplete
+    # key may occur more than once; each put gets its own key, and the
+    # entity ends up with the last one.
     datastore_entities = []
+    incomplete = []
     for unused_fut, ent in todo:
       datastore_entities.append(ent)
+      incomplete.append(not ent._has_complete_key())
     # Wait for datastore RPC(s).
     keys = yield self._conn.async_put(options, datastore_entities)
-    for key, (fut, ent) in zip(keys, todo):
+    for key, (fut, ent), new in zip(keys, todo, incomplete):
       if key != ent._key:
-        if ent._has_complete_key():
+        if not new:
           raise datastore_errors.BadKeyError(
               'Entity key differs from the one returned by the datastore. '
               'Expected %r, got %r' % (key, ent._key))
@@ -577,6 +1819,20 @@ class Context(object):
       flag = True
     return flag
 
+  def _get_batch_priority(self, options=None):
+    """Return the AutoBatcher priority for an operation.
+
+    Args:
+      options: ContextOptions instance, or None.
+
+    Returns:
+      An integer; higher priorities are dispatched first.
+    """
+    priority = ContextOptions.batch_priority(options, self._conn.config)
+    if priority is None:
+      priority = 0
+    return priority
+
   @staticmethod
   def default_memcache_timeout_policy(key):
     """Default memcache timeout policy.
@@ -648,6 +1904,130 @@ class Context(object):
     # If this returns None, the system default (typically, 5) will apply.
     return ContextOptions.memcache_deadline(options, self._conn.config)
 
+  @staticmethod
+  def default_l2_cache_timeout_policy(key):
+    """Default L2 cache timeout policy.
+
+    This defers to _l2_cache_timeout on the Model class.
+
+    Args:
+      key: Key instance.
+
+    Returns:
+      L2 cache timeout to use (number of seconds), or None.
+    """
+    timeout = None
+    if key is not None and isinstance(key, model.Key):
+      modelclass = model.Model._kind_map.get(key.kind())
+      if modelclass is not None:
+        policy = getattr(modelclass, '_l2_cache_timeout', None)
+        if policy is not None:
+          if isinstance(policy, (int, long, float)):
+            timeout = policy
+          else:
+            timeout = policy(key)
+    return timeout
+
+  _l2_cache_timeout_policy = default_l2_cache_timeout_policy
+
+  def set_l2_cache_timeout_policy(self, func):
+    """Set the policy function for the L2 cache timeout (expiration).
+
+    Args:
+      func: A function that accepts a key instance as argument and returns
+        the number of seconds to keep the entity in the L2 cache.  May be
+        None.
+
+    If the function returns 0 the L2 cache is not used for that key.
+    """
+    if func is None:
+      func = self.default_l2_cache_timeout_policy
+    elif isinstance(func, (int, long, float)):
+      func = lambda unused_key, flag=func: flag
+    self._l2_cache_timeout_policy = func
+
+  def get_l2_cache_timeout_policy(self):
+    """Return the current policy function for the L2 cache timeout."""
+    return self._l2_cache_timeout_policy
+
+  def _get_l2_cache_timeout(self, key, options=None):
+    """Return the L2 cache timeout for this key; 0 means don't use it."""
+    timeout = ContextOptions.l2_cache_timeout(options)
+    if timeout is None:
+      timeout = self._l2_cache_timeout_policy(key)
+    if timeout is None:
+      timeout = ContextOptions.l2_cache_timeout(self._conn.config)
+    if timeout is None:
+      timeout = 0
+    return timeout
+
+  @staticmethod
+  def default_negative_cache_timeout_policy(key):
+    """Default negative cache timeout policy.
+
+    This defers to _negative_cache_timeout on the Model class.
+
+    Args:
+      key: Key instance.
+
+    Returns:
+      Negative cache timeout to use (number of seconds), or None.
+    """
+    timeout = None
+    if key is not None and isinstance(key, model.Key):
+      modelclass = model.Model._kind_map.get(key.kind())
+      if modelclass is not None:
+        policy = getattr(modelclass, '_negative_cache_timeout', None)
+        if policy is not None:
+          if isinstance(policy, (int, long, float)):
+            timeout = policy
+          else:
+            timeout = policy(key)
+    return timeout
+
+  _negative_cache_timeout_policy = default_negative_cache_timeout_policy
+
+  def set_negative_cache_timeout_policy(self, func):
+    """Set the policy function for the negative cache timeout.
+
+    Args:
+      func: A function that accepts a key instance as argument and returns
+        the number of seconds to remember that the key doesn't exist.
+        May be None.
+
+    If the function returns 0 the negative cache is not used for that key.
+    """
+    if func is None:
+      func = self.default_negative_cache_timeout_policy
+    elif isinstance(func, (int, long, float)):
+      func = lambda unused_key, flag=func: flag
+    self._negative_cache_timeout_policy = func
+
+  def get_negative_cache_timeout_policy(self):
+    """Return the current policy function for the negative cache timeout."""
+    return self._negative_cache_timeout_policy
+
+  def _get_negative_cache_timeout(self, key, options=None):
+    """Return the negative cache timeout for this key; 0 means don't use it."""
+    timeout = ContextOptions.negative_cache_timeout(options)
+    if timeout is None:
+      timeout = self._negative_cache_timeout_policy(key)
+    if timeout is None:
+      timeout = ContextOptions.negative_cache_timeout(self._conn.config)
+    if timeout is None:
+      timeout = 0
+    return timeout
+
+  def _invalidate_process_caches(self, keys):
+    """Remove keys written by this process from the L2 and negative caches."""
+    l2_cache = _l2_cache
+    negative_cache = _negative_cache
+    for key in keys:
+      if l2_cache is not None:
+        l2_cache.invalidate(key)
+      if negative_cache is not None:
+        negative_cache.invalidate(key)
+
 
   def _load_from_cache_if_available(self, key):
     """Returns a cached Model instance given the entity key if available.
@@ -658,13 +2038,39 @@ class Context(object):
     Returns:
       A Model instance if the key exists in the cache.
     """
-    if key in self._cache:
-      entity = self._cache[key]  # May be None, meaning "doesn't exist".
+    entity = self._cache.get(key, _NOT_CACHED)
+    if entity is not _NOT_CACHED:  # May be None, meaning "doesn't exist".
       if entity is None or entity._key == key:
         # If entity's key didn't change later, it is ok.
         # See issue 13.  http://goo.gl/jxjOP
         raise tasklets.Return(entity)
 
+  def _entity_from_memcache(self, key, mvalue, lazy=None):
+    """Decode a Model instance from a value found in memcache.
+
+    Args:
+      key: Key instance.
+      mvalue: The serialized EntityProto (without key) from memcache.
+      lazy: Optional flag overriding the model class's _lazy_decode.
+
+    Returns:
+      A Model instance, or None if the value is corrupt.
+    """
+    cls = model.Model._lookup_model(key.kind(),
+                                    self._conn.adapter.default_model)
+    pb = entity_pb.EntityProto()
+    try:
+      pb.MergePartialFromString(mvalue)
+    except ProtocolBuffer.ProtocolBufferDecodeError:
+      logging.warning('Corrupt memcache entry found '
+                      'with key %s and namespace %s' %
+                      (self._memcache_prefix + key.urlsafe(), key.namespace()))
+      return None
+    entity = cls._from_pb(pb, lazy=lazy)
+    # Store the key on the entity since it wasn't written to memcache.
+    entity._key = key
+    return entity
+
   # TODO: What about conflicting requests to different autobatchers,
   # e.g. tasklet A calls get() on a given key while tasklet B calls
   # delete()?  The outcome is nondeterministic, depending on which
@@ -690,15 +2096,53 @@ class Context(object):
     use_cache = self._use_cache(key, options)
     if use_cache:
       self._load_from_cache_if_available(key)
+    lazy = ContextOptions.lazy_decode(options, self._conn.config)
 
     use_datastore = self._use_datastore(key, options)
-    if (use_datastore and
-        isinstance(self._conn, datastore_rpc.TransactionalConnection)):
+    in_transaction = isinstance(self._conn,
+                                datastore_rpc.TransactionalConnection)
+    if use_datastore and in_transaction:
       use_memcache = False
     else:
       use_memcache = self._use_memcache(key, options)
     ns = key.namespace()
     memcache_deadline = None  # Avoid worries about uninitialized variable.
+    mvalue = None
+
+    # The L2 cache is never used in a transaction, like memcache.
+    l2_cache = _l2_cache
+    l2_timeout = 0
+    if l2_cache is not None and not in_transaction:
+      l2_timeout = self._get_l2_cache_timeout(key, options)
+    if l2_timeout > 0:
+      l2_token = l2_cache.generation
+      pbs = l2_cache.get(key)
+      if pbs is not None:
+        cls = model.Model._lookup_model(key.kind(),
+                                        self._conn.adapter.default_model)
+        pb = entity_pb.EntityProto()
+        pb.MergePartialFromString(pbs)
+        entity = cls._from_pb(pb, lazy=lazy)
+        entity._key = key
+        if use_cache:
+          self._cache[key] = entity
+        raise tasklets.Return(entity)
+    else:
+      l2_cache = None
+
+    # Likewise for the negative cache, which only remembers datastore misses.
+    negative_cache = _negative_cache
+    negative_timeout = 0
+    if negative_cache is not None and use_datastore and not in_transaction:
+      negative_timeout = self._get_negative_cache_timeout(key, options)
+    if negative_timeout > 0:
+      negative_token = negative_cache.token(key)
+      if negative_cache.contains(key, negative_timeout):
+        if use_cache:
+          self._cache[key] = None
+        raise tasklets.Return(None)
+    else:
+      negative_cache = None
 
     if use_memcache:
       mkey = self._memcache_prefix + key.urlsafe()
@@ -710,30 +2154,36 @@ class Context(object):
       if use_cache:
         self._load_from_cache_if_available(key)
       if mvalue not in (_LOCKED, None):
-        cls = model.Model._lookup_model(key.kind(),
-                                        self._conn.adapter.default_model)
-        pb = entity_pb.EntityProto()
-
-        try:
-          pb.MergePartialFromString(mvalue)
-        except ProtocolBuffer.ProtocolBufferDecodeError:
-          logging.warning('Corrupt memcache entry found '
-                          'with key %s and namespace %s' % (mkey, ns))
-          mvalue = None
+        entity = self._entity_from_memcache(key, mvalue, lazy)
+        if entity is None:
+          mvalue = None  # Corrupt.
         else:
-          entity = cls._from_pb(pb)
-          # Store the key on the entity since it wasn't written to memcache.
-          entity._key = key
           if use_cache:
             # Update in-memory cache.
             self._cache[key] = entity
+          if l2_cache is not None:
+            l2_cache.set(key, mvalue, l2_timeout, l2_token)
           raise tasklets.Return(entity)
 
       if mvalue is None and use_datastore:
-        yield self.memcache_set(mkey, _LOCKED, time=_LOCK_TIME, namespace=ns,
-                                use_cache=True, deadline=memcache_deadline)
-        yield self.memcache_gets(mkey, namespace=ns, use_cache=True,
-                                 deadline=memcache_deadline)
+        if ContextOptions.memcache_fused_lock(options, self._conn.config):
+          # Add the lock and fetch its CAS id in one batched operation.
+          # If someone else stored a value meanwhile, use it.
+          lvalue = yield self._memcache_lock_and_gets(
+            mkey, namespace=ns, deadline=memcache_deadline)
+          if lvalue not in (_LOCKED, None):
+            entity = self._entity_from_memcache(key, lvalue, lazy)
+            if entity is not None:
+              if use_cache:
+                self._cache[key] = entity
+              if l2_cache is not None:
+                l2_cache.set(key, lvalue, l2_timeout, l2_token)
+              raise tasklets.Return(entity)
+        else:
+          yield self.memcache_set(mkey, _LOCKED, time=_LOCK_TIME, namespace=ns,
+                                  use_cache=True, deadline=memcache_deadline)
+          yield self.memcache_gets(mkey, namespace=ns, use_cache=True,
+                                   deadline=memcache_deadline)
 
     if not use_datastore:
       # NOTE: Do not cache this miss.  In some scenarios this would
@@ -741,14 +2191,22 @@ class Context(object):
       raise tasklets.Return(None)
 
     if use_cache:
-      entity = yield self._get_batcher.add_once(key, options)
+      entity = yield self._get_batcher.add_once(
+        key, options, self._get_batch_priority(options))
     else:
-      entity = yield self._get_batcher.add(key, options)
+      entity = yield self._get_batcher.add(
+        key, options, self._get_batch_priority(options))
 
-    if entity is not None:
-      if use_memcache and mvalue != _LOCKED:
+    if entity is None and negative_cache is not None:
+      negative_cache.add(key, negative_timeout, negative_token)
+
+    if entity is not None and mvalue != _LOCKED:
+      if use_memcache or l2_cache is not None:
         # Don't serialize the key since it's already the memcache key.
         pbs = entity._to_pb(set_key=False).SerializePartialToString()
+        if l2_cache is not None:
+          l2_cache.set(key, pbs, l2_timeout, l2_token)
+      if use_memcache:
         # Don't attempt to write to memcache if too big.  Note that we
         # use LBYL ("look before you leap") because a multi-value
         # memcache operation would fail for all entities rather than
@@ -784,6 +2242,7 @@ class Context(object):
     memcache_deadline = None  # Avoid worries about uninitialized variable.
 
     if entity._has_complete_key():
+      self._invalidate_process_caches([key])
       use_memcache = self._use_memcache(key, options)
       if use_memcache:
         # Wait for memcache operations before starting datastore RPCs.
@@ -807,7 +2266,11 @@ class Context(object):
                                   deadline=memcache_deadline)
 
     if use_datastore:
-      key = yield self._put_batcher.add(entity, options)
+      key = yield self._put_batcher.add(entity, options,
+                                        self._get_batch_priority(options))
+      if _l2_cache is not None or _negative_cache is not None:
+        # In a transaction this waits until the commit.
+        self.call_on_commit(lambda k=key: self._invalidate_process_caches([k]))
       if not isinstance(self._conn, datastore_rpc.TransactionalConnection):
         if use_memcache is None:
           use_memcache = self._use_memcache(key, options)
@@ -832,6 +2295,7 @@ class Context(object):
   @tasklets.tasklet
   def delete(self, key, **ctx_options):
     options = _make_ctx_options(ctx_options)
+    self._invalidate_process_caches([key])
     if self._use_memcache(key, options):
       memcache_deadline = self._get_memcache_deadline(options)
       mkey = self._memcache_prefix + key.urlsafe()
@@ -841,8 +2305,11 @@ class Context(object):
                               use_cache=True, deadline=memcache_deadline)
 
     if self._use_datastore(key, options):
-      yield self._delete_batcher.add(key, options)
+      yield self._delete_batcher.add(key, options,
+                                     self._get_batch_priority(options))
       # TODO: Delete from memcache here?
+      if _l2_cache is not None:
+        self.call_on_commit(lambda: self._invalidate_process_caches([key]))
 
     if self._use_cache(key, options):
       self._cache[key] = None
@@ -865,11 +2332,13 @@ class Context(object):
     mfut = merge_future
     if mfut is None:
       mfut = tasklets.MultiFuture('map_query')
+    inq = tasklets.SerialQueueFuture()
+    # Cancelling mfut stops the query (and thereby the helper).
+    mfut.add_immediate_callback(tasklets._propagate_cancel, mfut, inq)
 
     @tasklets.tasklet
     def helper():
       try:
-        inq = tasklets.SerialQueueFuture()
         query.run_to_queue(inq, self._conn, options)
         while True:
           try:
@@ -911,8 +2380,8 @@ class Context(object):
 
     # Check the cache.  If there is a valid cached entry, substitute
     # that for the result, even if the cache has an explicit None.
-    if key in self._cache:
-      cached_ent = self._cache[key]
+    cached_ent = self._cache.get(key, _NOT_CACHED)
+    if cached_ent is not _NOT_CACHED:
       if (cached_ent is None or
           cached_ent.key == key and cached_ent.__class__ is ent.__class__):
         return cached_ent
@@ -979,10 +2448,14 @@ class Context(object):
         adapter=parent._conn.adapter,
         config=parent._conn.config,
         transaction=transaction)
+      # The transaction's cache is never bounded; evicting from it would
+      # lose track of keys whose memcache entries must be cleared.
       tctx = parent.__class__(conn=tconn,
                               auto_batcher_class=parent._auto_batcher_class,
-                              parent_context=parent)
+                              parent_context=parent,
+                              cache_class=ContextCache)
       tctx._old_ds_conn = datastore._GetConnection()
+      tctx._deadline = parent._deadline
       ok = False
       try:
         # Copy memcache policies.  Note that get() will never use
@@ -1067,6 +2540,29 @@ class Context(object):
     """
     self._cache.clear()
 
+  def get_batch_size_histograms(self):
+    """Return the batch size histograms of the auto-batchers.
+
+    Returns:
+      A dict mapping the names 'get', 'put', 'delete', 'memcache_get',
+      'memcache_set', 'memcache_del', 'memcache_off' and 'memcache_lock'
+      to the result of AutoBatcher.batch_size_histogram().
+    """
+    names = ['get', 'put', 'delete', 'memcache_get', 'memcache_set',
+             'memcache_del', 'memcache_off', 'memcache_lock']
+    return dict((name, batcher.batch_size_histogram())
+                for name, batcher in zip(names, self._batchers))
+
+  def get_cache_stats(self):
+    """Return statistics for the in-memory cache.
+
+    Returns:
+      A dict with keys 'hits', 'misses', 'evictions', 'items' and
+      'bytes' (the latter is None unless max_cache_bytes is set).
+      The counters are not reset by clear_cache().
+    """
+    return self._cache.stats()
+
   @tasklets.tasklet
   def _clear_memcache(self, keys):
     keys = set(key for key in keys if self._use_memcache(key))
@@ -1086,7 +2582,8 @@ class Context(object):
     keys = set()
     for unused_fut, key in todo:
       keys.add(key)
-    rpc = memcache.create_rpc(deadline=deadline)
+    rpc = memcache.create_rpc(
+      deadline=self._get_rpc_deadline(deadline, _MEMCACHE_DEADLINE))
     results = yield self._memcache.get_multi_async(keys, for_cas=for_cas,
                                                    namespace=namespace,
                                                    rpc=rpc)
@@ -1103,7 +2600,8 @@ class Context(object):
     mapping = {}
     for unused_fut, (key, value) in todo:
       mapping[key] = value
-    rpc = memcache.create_rpc(deadline=deadline)
+    rpc = memcache.create_rpc(
+      deadline=self._get_rpc_deadline(deadline, _MEMCACHE_DEADLINE))
     results = yield method(mapping, time=time, namespace=namespace, rpc=rpc)
     for fut, (key, unused_value) in todo:
       if results is None:
@@ -1120,7 +2618,8 @@ class Context(object):
     keys = set()
     for unused_fut, key in todo:
       keys.add(key)
-    rpc = memcache.create_rpc(deadline=deadline)
+    rpc = memcache.create_rpc(
+      deadline=self._get_rpc_deadline(deadline, _MEMCACHE_DEADLINE))
     statuses = yield self._memcache.delete_multi_async(keys, seconds=seconds,
                                                        namespace=namespace,
                                                        rpc=rpc)
@@ -1140,12 +2639,51 @@ class Context(object):
     mapping = {}  # {key: delta}
     for unused_fut, (key, delta) in todo:
       mapping[key] = delta
-    rpc = memcache.create_rpc(deadline=deadline)
+    rpc = memcache.create_rpc(
+      deadline=self._get_rpc_deadline(deadline, _MEMCACHE_DEADLINE))
     results = yield self._memcache.offset_multi_async(
       mapping, initial_value=initial_value, namespace=namespace, rpc=rpc)
     for fut, (key, unused_delta) in todo:
       fut.set_result(results.get(key))
 
+  @tasklets.tasklet
+  def _memcache_lock_tasklet(self, todo, options):
+    if not todo:
+      raise RuntimeError('Nothing to do.')
+    time, namespace, deadline = options
+    keys = set()
+    for unused_fut, key in todo:
+      keys.add(key)
+    # Add (not set) the lock, so a concurrent reader's lock or value is
+    # left alone; either way the get below returns what's there now.
+    rpc = memcache.create_rpc(
+      deadline=self._get_rpc_deadline(deadline, _MEMCACHE_DEADLINE))
+    yield self._memcache.add_multi_async(dict.fromkeys(keys, _LOCKED),
+                                         time=time, namespace=namespace,
+                                         rpc=rpc)
+    rpc = memcache.create_rpc(
+      deadline=self._get_rpc_deadline(deadline, _MEMCACHE_DEADLINE))
+    results = yield self._memcache.get_multi_async(keys, for_cas=True,
+                                                   namespace=namespace,
+                                                   rpc=rpc)
+    for fut, key in todo:
+      fut.set_result(results.get(key))
+
+  def _memcache_lock_and_gets(self, key, namespace=None, deadline=None):
+    """Lock a memcache key for get() and fetch its value and CAS id.
+
+    This is the fused equivalent of memcache_set(key, _LOCKED) followed
+    by memcache_gets(key); all keys in a batch share the same two RPCs.
+
+    Returns:
+      A Future whose result is the value now in memcache (usually
+      _LOCKED), or None.
+    """
+    if namespace is None:
+      namespace = namespace_manager.get_namespace()
+    return self._memcache_lock_batcher.add_once(
+      key, (_LOCK_TIME, namespace, deadline))
+
   def memcache_get(self, key, for_cas=False, namespace=None, use_cache=False,
                    deadline=None):
     """An auto-batching wrapper for memcache.get() or .get_multi().
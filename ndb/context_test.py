@@ -1,6 +1,7 @@
 """Tests for context.py."""
 
 import logging
+import os
 import random
 import socket
 import threading
@@ -11,7 +12,9 @@ from .google_imports import datastore
 from .google_imports import datastore_errors
 from .google_imports import datastore_rpc
 from .google_imports import memcache
+from .google_imports import namespace_manager
 from .google_imports import taskqueue
+from .google_imports import users
 from .google_test_imports import unittest
 
 from . import context
@@ -84,6 +87,59 @@ class ContextTests(test_utils.NDBTest):
     self.assertEqual(name, '_get_tasklet')
     self.assertEqual(len(todo), 3)
 
+  def testContext_AutoBatcher_GetFusedLock(self):
+    # Adding the lock and fetching its CAS id takes one batching round
+    # instead of two.
+    def rounds(ids, **options):
+      MyAutoBatcher.reset_log()
+      @tasklets.tasklet
+      def foo():
+        keys = [model.Key(flat=['Foo', i]) for i in ids]
+        ents = yield [self.ctx.get(key, **options) for key in keys]
+        raise tasklets.Return(ents)
+      self.assertEqual(foo().get_result(), [None, None, None])
+      for name, todo in MyAutoBatcher._log:
+        self.assertEqual(len(todo), 3)
+      return [name for name, _ in MyAutoBatcher._log]
+    default = rounds((1, 2, 3))
+    fused = rounds((4, 5, 6), memcache_fused_lock=True)
+    self.assertEqual(default,
+                     ['_memcache_get_tasklet',
+                      '_memcache_set_tasklet',
+                      '_memcache_get_tasklet',
+                      '_get_tasklet'])
+    self.assertEqual(fused,
+                     ['_memcache_get_tasklet',
+                      '_memcache_lock_tasklet',
+                      '_get_tasklet'])
+    self.assertTrue(len(fused) < len(default))
+
+  def testContext_GetFusedLockMemcacheState(self):
+    class Foo(model.Model):
+      n = model.IntegerProperty()
+    key = Foo(n=1).put()
+    mkey = self.ctx._memcache_prefix + key.urlsafe()
+    ent = self.ctx.get(key, memcache_fused_lock=True,
+                       use_cache=False).get_result()
+    self.assertEqual(ent.n, 1)
+    self.ctx.flush().check_success()
+    # The lock was replaced by the entity through cas().
+    mvalue = memcache.get(mkey)
+    self.assertNotEqual(mvalue, None)
+    self.assertNotEqual(mvalue, context._LOCKED)
+    # A concurrent reader's lock is not overwritten, but cas() still works
+    # with the CAS id fetched along with it.
+    memcache.delete(mkey)
+    memcache.set(mkey, context._LOCKED, time=context._LOCK_TIME)
+    val = self.ctx._memcache_lock_and_gets(mkey).get_result()
+    self.assertEqual(val, context._LOCKED)
+    self.assertTrue(self.ctx.memcache_cas(mkey, 'x').get_result())
+    # If a value showed up after the first get, it is used as a hit.
+    memcache.set(mkey, mvalue)
+    val = self.ctx._memcache_lock_and_gets(mkey).get_result()
+    self.assertEqual(val, mvalue)
+    self.assertEqual(self.ctx._entity_from_memcache(key, val).n, 1)
+
   @tasklets.tasklet
   def create_entities(self):
     key0 = model.Key(flat=['Foo', None])
@@ -132,6 +188,73 @@ class ContextTests(test_utils.NDBTest):
     self.assertEqual(name, '_delete_tasklet')
     self.assertEqual(len(todo), 3)
 
+  def testContext_AutoBatcher_Priority(self):
+    @tasklets.tasklet
+    def foo():
+      key1 = model.Key(flat=['Foo', 1])
+      key2 = model.Key(flat=['Foo', 2])
+      fut1 = self.ctx.get(key1, use_cache=False, use_memcache=False)
+      fut2 = self.ctx.get(key2, use_cache=False, use_memcache=False,
+                          batch_priority=5)
+      yield fut1, fut2
+    foo().check_success()
+    self.assertEqual([(name, [key for _, key in todo])
+                      for name, todo in MyAutoBatcher._log],
+                     [('_get_tasklet', [model.Key('Foo', 2)]),
+                      ('_get_tasklet', [model.Key('Foo', 1)])])
+
+  def testContext_AutoBatcher_GetDedup(self):
+    key = model.Key('Foo', 1)
+    futs = [self.ctx.get(key, use_cache=False, use_memcache=False)
+            for _ in range(3)]
+    self.assertEqual([f.get_result() for f in futs], [None] * 3)
+    self.assertEqual([(name, [key for _, key in todo])
+                      for name, todo in MyAutoBatcher._log],
+                     [('_get_tasklet', [key])])
+
+  def testContext_AutoBatcher_PutDedup(self):
+    key = model.Key('Foo', 1)
+    ent1 = model.Expando(key=key, x=1)
+    ent2 = model.Expando(key=key, x=2)
+    ent3 = model.Expando(key=model.Key('Foo', 3))
+    futs = [self.ctx.put(ent, use_memcache=False)
+            for ent in (ent1, ent3, ent2, ent3)]
+    keys = [f.get_result() for f in futs]
+    self.assertEqual(keys, [key, ent3.key, key, ent3.key])
+    name, todo = MyAutoBatcher._log[0]
+    self.assertEqual(name, '_put_tasklet')
+    self.assertEqual([ent for _, ent in todo], [ent2, ent3])
+    ent = self.ctx.get(key, use_cache=False, use_memcache=False).get_result()
+    self.assertEqual(ent.x, 2)
+
+  def testContext_AutoBatcher_PutIncompleteKeys(self):
+    # Every put of an incomplete key creates an entity, even when the
+    # same entity object is put twice in one batch.
+    ent = model.Expando(x=1)
+    futs = [self.ctx.put(ent, use_memcache=False) for _ in range(2)]
+    keys = [f.get_result() for f in futs]
+    self.assertNotEqual(keys[0], keys[1])
+    self.assertEqual(ent.key, keys[1])
+    name, todo = MyAutoBatcher._log[0]
+    self.assertEqual(name, '_put_tasklet')
+    self.assertEqual([e for _, e in todo], [ent, ent])
+    for key in keys:
+      self.assertEqual(key.get(use_cache=False, use_memcache=False).x, 1)
+
+  def testContext_AutoBatcher_PutDedupStrict(self):
+    key = model.Key('Foo', 1)
+    ent1 = model.Expando(key=key, x=1)
+    ent2 = model.Expando(key=key, x=2)
+    futs = [self.ctx.put(ent, use_memcache=False, strict_put_dedup=True)
+            for ent in (ent1, ent2)]
+    for fut in futs:
+      self.assertRaises(datastore_errors.BadRequestError, fut.get_result)
+    # Putting the same or an equal entity twice is fine.
+    ent3 = model.Expando(key=key, x=1)
+    futs = [self.ctx.put(ent, use_memcache=False, strict_put_dedup=True)
+            for ent in (ent1, ent1, ent3)]
+    self.assertEqual([f.get_result() for f in futs], [key] * 3)
+
   def testContext_AutoBatcher_Limit(self):
     # Check that the default limit is taken from the connection.
     self.assertEqual(self.ctx._get_batcher._limit,
@@ -186,6 +309,459 @@ class ContextTests(test_utils.NDBTest):
     self.assertTrue(isinstance(err1, ValueError))
     self.assertTrue(err1 is err2)
 
+  def make_echo_batcher(self, log):
+    @tasklets.tasklet
+    def echo_tasklet(todo, options):
+      log.append([arg for _, arg in todo])
+      for fut, arg in todo:
+        fut.set_result(arg)
+    return context.AutoBatcher(echo_tasklet, 100)
+
+  def testAutoBatcher_MinBatchSize(self):
+    log = []
+    batcher = self.make_echo_batcher(log)
+    batcher.set_flush_policy(min_batch_size=3, max_linger_ms=10000)
+    @tasklets.tasklet
+    def producer(i):
+      yield tasklets.sleep(0.001 * i)
+      res = yield batcher.add(i)
+      raise tasklets.Return(res)
+    futs = [producer(i) for i in range(6)]
+    self.assertEqual([f.get_result() for f in futs], range(6))
+    self.assertEqual(log, [[0, 1, 2], [3, 4, 5]])
+    self.assertEqual(batcher.batch_size_histogram(), {4: 2})
+
+  def testAutoBatcher_MaxLinger(self):
+    log = []
+    batcher = self.make_echo_batcher(log)
+    batcher.set_flush_policy(min_batch_size=10, max_linger_ms=20)
+    t0 = time.time()
+    futs = [batcher.add(i) for i in range(2)]
+    self.assertEqual([f.get_result() for f in futs], [0, 1])
+    self.assertTrue(time.time() - t0 >= 0.02)
+    self.assertEqual(log, [[0, 1]])
+    self.assertEqual(batcher._timer, None)
+
+  def testAutoBatcher_FlushIgnoresLinger(self):
+    log = []
+    batcher = self.make_echo_batcher(log)
+    batcher.set_flush_policy(min_batch_size=10, max_linger_ms=10000)
+    fut = batcher.add(42)
+    batcher.flush().check_success()
+    self.assertEqual(fut.get_result(), 42)
+    self.assertEqual(log, [[42]])
+    self.assertEqual(batcher._timer, None)
+
+  def testAutoBatcher_PolicySetWhileQueued(self):
+    log = []
+    batcher = self.make_echo_batcher(log)
+    t0 = time.time()
+    futs = [batcher.add(i) for i in range(2)]
+    batcher.set_flush_policy(min_batch_size=10, max_linger_ms=20)
+    self.assertEqual(batcher._started.keys(), [None])
+    self.assertEqual([f.get_result() for f in futs], [0, 1])
+    self.assertTrue(time.time() - t0 >= 0.02)
+    self.assertEqual(log, [[0, 1]])
+    self.assertEqual(batcher._timer, None)
+
+  def testAutoBatcher_AdaptiveLinger(self):
+    batcher = self.make_echo_batcher([])
+    batcher.set_flush_policy(max_linger_ms=50, adaptive=True)
+    self.assertEqual(batcher._get_linger(), 0)
+    batcher._latency = 0.1
+    self.assertAlmostEqual(batcher._get_linger(), 0.01)
+    batcher._latency = 10
+    self.assertAlmostEqual(batcher._get_linger(), 0.05)
+    batcher.add(1).check_success()
+    eventloop.run()  # Let _record_latency() record the latency.
+    self.assertTrue(batcher._latency < 10)
+
+  def testAutoBatcher_Histogram(self):
+    log = []
+    batcher = self.make_echo_batcher(log)
+    for n in 1, 2, 3, 5, 8:
+      futs = [batcher.add(i) for i in range(n)]
+      tasklets.Future.wait_all(futs)
+    self.assertEqual(batcher.batch_size_histogram(), {1: 1, 2: 1, 4: 1, 8: 2})
+
+  def testAutoBatcher_FifoOrder(self):
+    log = []
+    batcher = self.make_echo_batcher(log)
+    options = ['c', 'a', 'e', 'b', 'd']
+    for opts in options:
+      batcher.add(opts, opts)
+    while batcher.action():
+      pass
+    self.assertEqual(log, [[opts] for opts in options])
+
+  def testAutoBatcher_Priority(self):
+    log = []
+    batcher = self.make_echo_batcher(log)
+    batcher.add('low', 'a')
+    batcher.add('high', 'b', priority=1)
+    batcher.add('low', 'c')
+    batcher.add('promoted', 'c', priority=2)
+    batcher.add('negative', 'd', priority=-1)
+    while batcher.action():
+      pass
+    self.assertEqual(log, [['low', 'promoted'], ['high'], ['low'],
+                           ['negative']])
+
+  def testAutoBatcher_OrderStaysSmall(self):
+    batcher = self.make_echo_batcher([])
+    batcher._limit = 1
+    for i in range(1000):
+      batcher.add(i, i)
+    batcher.add('x', 'x', priority=1)
+    self.assertTrue(len(batcher._order) <= 20)
+    self.assertEqual(batcher._ranks, {})
+
+  def testAutoBatcher_Dedup(self):
+    log = []
+    batcher = self.make_echo_batcher(log)
+    batcher.set_dedup(lambda arg: arg if arg != 'x' else None)
+    futs = [batcher.add(arg) for arg in ['a', 'b', 'a', 'x', 'x', 'a']]
+    self.assertEqual([f.get_result() for f in futs],
+                     ['a', 'b', 'a', 'x', 'x', 'a'])
+    self.assertEqual(log, [['a', 'b', 'x', 'x']])
+
+  def testAutoBatcher_DedupMerge(self):
+    log = []
+    batcher = self.make_echo_batcher(log)
+    def merge(args, options):
+      if args[0] == 'bad':
+        raise ValueError(args)
+      return '+'.join(args)
+    batcher.set_dedup(lambda arg: arg[0], merge)
+    futs = [batcher.add(arg) for arg in ['a1', 'bad', 'a2', 'bad', 'c']]
+    self.assertEqual(futs[0].get_result(), 'a1+a2')
+    self.assertEqual(futs[2].get_result(), 'a1+a2')
+    self.assertEqual(futs[4].get_result(), 'c')
+    self.assertTrue(isinstance(futs[1].get_exception(), ValueError))
+    self.assertTrue(futs[1].get_exception() is futs[3].get_exception())
+    self.assertEqual(log, [['a1+a2', 'c']])
+
+  def testAutoBatcher_DedupError(self):
+    self.ExpectWarnings()
+    @tasklets.tasklet
+    def failing_tasklet(todo, options):
+      raise ZeroDivisionError
+      yield  # Make this a generator.
+    batcher = context.AutoBatcher(failing_tasklet, 100)
+    batcher.set_dedup(lambda arg: arg)
+    futs = [batcher.add(arg) for arg in [1, 1, 2]]
+    for fut in futs:
+      self.assertRaises(ZeroDivisionError, fut.get_result)
+
+  def testAutoBatcher_Limiter(self):
+    state = {'running': 0, 'max_running': 0}
+    log = []
+    @tasklets.tasklet
+    def slow_tasklet(todo, options):
+      state['running'] += 1
+      state['max_running'] = max(state['max_running'], state['running'])
+      yield tasklets.sleep(0.001)
+      state['running'] -= 1
+      log.append(options)
+      for fut, arg in todo:
+        fut.set_result(arg)
+    limiter = context._BatchLimiter(2)
+    batchers = [context.AutoBatcher(slow_tasklet, 2) for _ in range(2)]
+    for batcher in batchers:
+      batcher.set_limiter(limiter)
+    futs = [batchers[i % 2].add(i, i // 4) for i in range(20)]
+    self.assertEqual([f.get_result() for f in futs], range(20))
+    self.assertEqual(state['max_running'], 2)
+    self.assertEqual(log, [i // 4 for i in range(0, 20, 2)])
+    stats = limiter.stats()
+    self.assertEqual(stats['in_flight'], 0)
+    self.assertEqual(stats['waiting'], 0)
+    self.assertEqual(stats['max_waiting'], 8)
+
+  def testAutoBatcher_LimiterFlush(self):
+    @tasklets.tasklet
+    def slow_tasklet(todo, options):
+      yield tasklets.sleep(0.001)
+      for fut, arg in todo:
+        fut.set_result(arg)
+    limiter = context._BatchLimiter(1)
+    batcher = context.AutoBatcher(slow_tasklet, 1)
+    batcher.set_limiter(limiter)
+    futs = [batcher.add(i) for i in range(3)]
+    self.assertEqual(limiter.stats()['waiting'], 2)
+    batcher.flush().check_success()
+    self.assertTrue(all(f.done() for f in futs))
+
+  def testAutoBatcher_Cancel(self):
+    log = []
+    batcher = self.make_echo_batcher(log)
+    futs = [batcher.add(i) for i in range(4)]
+    futs[1].cancel()
+    futs[3].cancel()
+    batcher.flush().check_success()
+    self.assertEqual(log, [[0, 2]])
+    self.assertEqual(futs[2].get_result(), 2)
+    self.assertTrue(futs[1].cancelled())
+    # If everything was cancelled, nothing is run.
+    futs = [batcher.add(i) for i in range(2)]
+    for fut in futs:
+      fut.cancel()
+    batcher.flush().check_success()
+    self.assertEqual(log, [[0, 2]])
+    # A cancelled add_once() Future isn't handed out again.
+    fut = batcher.add_once(5)
+    fut.cancel()
+    fut2 = batcher.add_once(5)
+    self.assertFalse(fut2 is fut)
+    self.assertEqual(fut2.get_result(), 5)
+
+  def testContext_CancelGet(self):
+    keys = [model.Key('Foo', i) for i in range(1, 4)]
+    futs = [self.ctx.get(key) for key in keys]
+    futs[1].cancel()
+    self.ctx.flush().check_success()
+    self.assertRaises(tasklets.CancelledError, futs[1].get_result)
+    self.assertEqual([futs[0].get_result(), futs[2].get_result()],
+                     [None, None])
+    batches = [todo for name, todo in MyAutoBatcher._log
+               if name == '_get_tasklet']
+    self.assertEqual([[key for _, key in todo] for todo in batches],
+                     [[keys[0], keys[2]]])
+
+  def testContext_CancelSharedGet(self):
+    # Concurrent gets of the same key share the batched lookup (and the
+    # memcache lookup); cancelling one must not cancel the other.
+    ent = model.Expando(key=model.Key('Foo', 1), bar=1)
+    key = self.ctx.put(ent).get_result()
+    ev = eventloop.get_event_loop()
+    for use_memcache in False, True:
+      self.ctx.clear_cache()
+      fut1 = self.ctx.get(key, use_memcache=use_memcache)
+      fut2 = self.ctx.get(key, use_memcache=use_memcache)
+      while ev.current:
+        ev.run0()  # Until both are waiting for the same lookup.
+      self.assertFalse(fut1.done())
+      self.assertTrue(fut1.cancel())
+      self.assertRaises(tasklets.CancelledError, fut1.get_result)
+      self.assertEqual(fut2.get_result(), ent)
+
+  def testAutoBatcher_DeadlineFunc(self):
+    deadlines = []
+    @tasklets.tasklet
+    def echo_tasklet(todo, options):
+      deadlines.append(context.ContextOptions.deadline(options))
+      for fut, arg in todo:
+        fut.set_result(arg)
+    batcher = context.AutoBatcher(echo_tasklet, 100)
+    left = [3]
+    batcher.set_deadline_func(lambda: left[0])
+    self.assertEqual(batcher.add(1).get_result(), 1)
+    options = context.ContextOptions(deadline=1)
+    self.assertEqual(batcher.add(2, options).get_result(), 2)
+    left[0] = None
+    self.assertEqual(batcher.add(3).get_result(), 3)
+    self.assertEqual(deadlines, [3, 1, None])
+    # The config's deadline applies if the options don't set one.
+    left[0] = 3
+    batcher.set_deadline_func(lambda: left[0],
+                              context.ContextOptions(deadline=2))
+    self.assertEqual(batcher.add(4).get_result(), 4)
+    self.assertEqual(deadlines, [3, 1, None, None])
+    # No time left means fail fast without running the batch.
+    left[0] = 0
+    fut = batcher.add(5)
+    self.assertRaises(tasklets.TimeoutError, fut.get_result)
+    self.assertEqual(len(deadlines), 4)
+
+  def testContext_Deadline(self):
+    self.assertEqual(self.ctx.get_deadline(), None)
+    self.assertEqual(self.ctx._get_rpc_deadline(None, 5), None)
+    self.ctx.set_deadline(60)
+    self.assertTrue(self.ctx.get_deadline() > time.time())
+    self.assertEqual(self.ctx._get_rpc_deadline(2), 2)
+    self.assertEqual(self.ctx._get_rpc_deadline(None, 5), 5)
+    self.assertTrue(self.ctx._get_rpc_deadline(120) <= 60)
+    @tasklets.tasklet
+    def callback():
+      ctx = tasklets.get_context()
+      self.assertEqual(ctx.get_deadline(), self.ctx.get_deadline())
+    self.ctx.transaction(callback).check_success()
+    # Once the deadline has passed, work fails fast.
+    self.ctx.set_deadline(0)
+    self.assertRaises(tasklets.TimeoutError, self.ctx._get_rpc_deadline, 2)
+    fut = self.ctx.get(model.Key('Foo', 1))
+    self.assertRaises(tasklets.TimeoutError, fut.get_result)
+    fut = self.ctx.memcache_get('foo')
+    self.assertRaises(tasklets.TimeoutError, fut.get_result)
+    self.ctx.set_deadline(None)
+    self.assertEqual(self.ctx.get(model.Key('Foo', 1)).get_result(), None)
+
+  def testAutoBatcher_LimiterStartsClock(self):
+    # A batch waiting in the limiter gets its deadline trimmed, and its
+    # latency measured, only once it starts.
+    deadlines = []
+    left = [10]
+    @tasklets.tasklet
+    def slow_tasklet(todo, options):
+      deadlines.append(context.ContextOptions.deadline(options))
+      left[0] -= 1
+      yield tasklets.sleep(0.05)
+      for fut, arg in todo:
+        fut.set_result(arg)
+    limiter = context._BatchLimiter(1)
+    batcher = context.AutoBatcher(slow_tasklet, 1)
+    batcher.set_limiter(limiter)
+    batcher.set_deadline_func(lambda: left[0])
+    futs = [batcher.add(i) for i in range(4)]
+    self.assertEqual([f.get_result() for f in futs], range(4))
+    self.assertEqual(deadlines, [10, 9, 8, 7])
+    eventloop.run()
+    self.assertTrue(batcher._latency < 0.09, batcher._latency)
+
+  def testContext_FlushPolicyOptions(self):
+    self.assertEqual(self.ctx._get_batcher._max_linger, None)
+    config = context.ContextOptions(min_batch_size=5, max_batch_linger_ms=3)
+    ctx = context.Context(config=config)
+    for batcher in ctx._batchers:
+      self.assertEqual(batcher._min_batch_size, 5)
+      self.assertAlmostEqual(batcher._max_linger, 0.003)
+      self.assertFalse(batcher._adaptive)
+    self.assertRaises(datastore_errors.BadArgumentError,
+                      context.ContextOptions, min_batch_size=0)
+    self.assertRaises(datastore_errors.BadArgumentError,
+                      context.ContextOptions, max_batch_linger_ms=-1)
+    self.assertRaises(datastore_errors.BadArgumentError,
+                      context.ContextOptions, adaptive_batch_linger=1)
+    self.assertRaises(datastore_errors.BadArgumentError,
+                      context.ContextOptions, batch_priority='high')
+    self.assertRaises(datastore_errors.BadArgumentError,
+                      context.ContextOptions, max_rpcs_in_flight=0)
+    self.assertEqual(ctx._rpc_limiter, None)
+    ctx = context.Context(
+      config=context.ContextOptions(max_rpcs_in_flight=4))
+    self.assertEqual(ctx._rpc_limiter._limit, 4)
+    self.assertTrue(ctx._get_batcher._limiter is ctx._rpc_limiter)
+    self.assertTrue(ctx._delete_batcher._limiter is ctx._rpc_limiter)
+    self.assertEqual(ctx._memcache_get_batcher._limiter, None)
+    hists = self.ctx.get_batch_size_histograms()
+    self.assertEqual(sorted(hists),
+                     ['delete', 'get', 'memcache_del', 'memcache_get',
+                      'memcache_lock', 'memcache_off', 'memcache_set', 'put'])
+
+  def testContext_ExecutorDecode(self):
+    self.assertRaises(datastore_errors.BadArgumentError,
+                      context.ContextOptions, executor_decode_threshold=0)
+    class Blob(model.Model):
+      n = model.IntegerProperty()
+    keys = model.put_multi([Blob(n=i) for i in range(5)])
+    jobs = []
+    class SyncExecutor(object):
+      def submit(self, func, *args):
+        jobs.append(len(args[1]))
+        job = tasklets._ThreadPoolJob(func, args)
+        job.run()
+        return job
+    tasklets.set_executor(SyncExecutor())
+    try:
+      ctx = context.Context(
+        config=context.ContextOptions(executor_decode_threshold=3))
+      ctx.set_cache_policy(False)
+      ctx.set_memcache_policy(False)
+      tasklets.set_context(ctx)
+      self.assertEqual([ent.n for ent in model.get_multi(keys)], range(5))
+      self.assertEqual(jobs, [5])
+      # Small batches are decoded in place.
+      self.assertEqual(keys[0].get().n, 0)
+      self.assertEqual(jobs, [5])
+      # Query results are decoded in the executor too.
+      self.assertEqual(sorted(ent.n for ent in Blob.query().fetch()),
+                       range(5))
+      self.assertEqual(jobs, [5, 5])
+      # As are the results of map and iter queries.
+      self.assertEqual(sorted(Blob.query().map(lambda ent: ent.n)), range(5))
+      self.assertEqual(sorted(ent.n for ent in Blob.query()), range(5))
+      self.assertEqual(jobs, [5, 5, 5, 5])
+      # But keys-only queries don't need decoding.
+      self.assertEqual(len(Blob.query().fetch(keys_only=True)), 5)
+      self.assertEqual(len(list(Blob.query().iter(keys_only=True))), 5)
+      self.assertEqual(jobs, [5, 5, 5, 5])
+      keys[0].delete()
+      ents = model.get_multi(keys)
+      self.assertEqual(ents[0], None)
+      self.assertEqual([ent.n for ent in ents[1:]], range(1, 5))
+      self.assertEqual(jobs, [5, 5, 5, 5, 5])
+    finally:
+      tasklets.set_executor(None)
+
+  def testContext_ExecutorDecodeThreads(self):
+    # Worker threads can decode concurrently, and the outcome doesn't
+    # depend on the default app and namespace in os.environ.
+    class Inner(model.Model):
+      k = model.KeyProperty()
+    class Blob(model.Model):
+      n = model.IntegerProperty()
+      k = model.KeyProperty(repeated=True)
+      u = model.UserProperty()
+      inner = model.LocalStructuredProperty(Inner)
+    class Loose(model.Expando):
+      pass
+    ents = []
+    for i in range(20):
+      key = model.Key('Foo', i + 1, namespace='ns%d' % (i % 3))
+      ents.append(Blob(id=i + 1, n=i, k=[key], u=users.User('a@b.com'),
+                       inner=Inner(k=key)))
+      ents.append(Loose(id=i + 1, n=i, s='x' * i, sub=Inner(k=key)))
+    pbs = [ent._to_pb() for ent in ents] + [None]
+    adapter = self.ctx._conn.adapter
+    expected = context._decode_entity_pbs(adapter, pbs)
+    self.assertEqual(expected[:-1:2], ents[::2])  # The Blob entities.
+    results = []
+    def decode():
+      for _ in range(10):
+        results.append(context._decode_entity_pbs(adapter, pbs))
+    threads = [threading.Thread(target=decode) for _ in range(4)]
+    os.environ['APPLICATION_ID'] = 'otherapp'
+    namespace_manager.set_namespace('otherns')
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+    self.assertEqual(len(results), 40)
+    for entities in results:
+      self.assertEqual(entities, expected)
+      self.assertEqual(entities[0].key.app(), self.APP_ID)
+      self.assertEqual(entities[0].k[0].namespace(), 'ns0')
+      self.assertEqual(entities[1].sub.k.namespace(), 'ns0')
+
+  def testContext_LazyDecode(self):
+    self.assertRaises(datastore_errors.BadArgumentError,
+                      context.ContextOptions, lazy_decode=1)
+    class Blob(model.Model):
+      n = model.IntegerProperty()
+      text = model.TextProperty()
+    keys = model.put_multi([Blob(n=i, text='x' * i) for i in range(3)])
+    self.ctx.set_cache_policy(False)
+    # From the datastore; this also writes the entities to memcache.
+    ents = model.get_multi(keys, lazy_decode=True)
+    self.assertEqual([sorted(ent._lazy_pbs) for ent in ents],
+                     [['n', 'text']] * 3)
+    self.assertEqual([ent.n for ent in ents], range(3))
+    # From memcache.
+    ent = keys[2].get(lazy_decode=True)
+    self.assertEqual(sorted(ent._lazy_pbs), ['n', 'text'])
+    self.assertEqual(ent.text, 'xx')
+    self.assertEqual(ent.key, keys[2])
+    self.assertEqual(keys[2].get()._lazy_pbs, None)
+    # From a query.
+    ents = Blob.query().fetch(lazy_decode=True)
+    self.assertEqual([ent._lazy_pbs is not None for ent in ents], [True] * 3)
+    self.assertEqual(sorted(ent.n for ent in ents), range(3))
+    # The option overrides the model class's setting.
+    Blob._lazy_decode = True
+    self.ctx.set_memcache_policy(False)
+    self.assertEqual(keys[1].get(lazy_decode=False)._lazy_pbs, None)
+    self.assertEqual(sorted(keys[1].get()._lazy_pbs), ['n', 'text'])
+
   def testContext_MultiRpc(self):
     # This test really tests the proper handling of MultiRpc by
     # queue_rpc() in eventloop.py.  It's easier to test from here, and
@@ -222,6 +798,127 @@ class ContextTests(test_utils.NDBTest):
       self.assertEqual(self.ctx._cache, {})  # Whitebox.
     foo().check_success()
 
+  def testContext_CacheStats(self):
+    ctx = self.ctx
+    ctx.set_memcache_policy(False)
+    key1 = model.Key('Foo', 1)
+    ent1 = model.Expando(key=key1, foo=42)
+    ctx.put(ent1).check_success()
+    self.assertTrue(ctx.get(key1).get_result() is ent1)
+    self.assertEqual(ctx.get(model.Key('Foo', 2)).get_result(), None)
+    stats = ctx.get_cache_stats()
+    self.assertEqual(stats['hits'], 1)
+    self.assertEqual(stats['misses'], 1)
+    self.assertEqual(stats['evictions'], 0)
+    self.assertEqual(stats['items'], 2)
+    self.assertEqual(stats['bytes'], None)
+    ctx.clear_cache()
+    stats = ctx.get_cache_stats()
+    self.assertEqual(stats['items'], 0)
+    self.assertEqual(stats['hits'], 1)
+
+  def testContext_CacheMaxItems(self):
+    config = context.ContextOptions(max_cache_items=3)
+    ctx = context.Context(config=config)
+    self.assertTrue(isinstance(ctx._cache, context.LRUContextCache))
+    tasklets.set_context(ctx)
+    ctx.set_memcache_policy(False)
+    keys = [model.Key('Foo', i) for i in range(1, 6)]
+    for key in keys[:3]:
+      ctx.put(model.Expando(key=key)).check_success()
+    ctx.get(keys[0]).check_success()  # Now keys[1] is least recently used.
+    ctx.put(model.Expando(key=keys[3])).check_success()
+    self.assertEqual(sorted(ctx._cache), [keys[0], keys[2], keys[3]])
+    ctx.put(model.Expando(key=keys[4])).check_success()
+    self.assertEqual(sorted(ctx._cache), [keys[0], keys[3], keys[4]])
+    stats = ctx.get_cache_stats()
+    self.assertEqual(stats['evictions'], 2)
+    self.assertEqual(stats['items'], 3)
+    # An evicted entity is fetched again.
+    ent = ctx.get(keys[1]).get_result()
+    self.assertEqual(ent.key, keys[1])
+    self.assertEqual(sorted(ctx._cache), [keys[1], keys[3], keys[4]])
+
+  def testContext_CacheMaxBytes(self):
+    class Big(model.Model):
+      blob = model.BlobProperty()
+    cache = context.LRUContextCache(max_bytes=10000)
+    key1 = model.Key('Big', 1)
+    key2 = model.Key('Big', 2)
+    key3 = model.Key('Big', 3)
+    cache[key1] = Big(key=key1, blob='x' * 4000)
+    cache[key2] = Big(key=key2, blob='x' * 4000)
+    self.assertEqual(len(cache), 2)
+    self.assertTrue(cache.stats()['bytes'] > 8000)
+    cache[key3] = Big(key=key3, blob='x' * 4000)
+    self.assertEqual(sorted(cache), [key2, key3])
+    self.assertTrue(cache.stats()['bytes'] <= 10000)
+    # The entry stored last is kept even if it is too big by itself.
+    cache[key1] = Big(key=key1, blob='x' * 20000)
+    self.assertEqual(list(cache), [key1])
+    self.assertEqual(cache.stats()['evictions'], 3)
+    del cache[key1]
+    self.assertEqual(cache.stats()['bytes'], 0)
+    self.assertEqual(cache, {})
+
+  def testContext_LRUCacheMapping(self):
+    # Every way of reading values returns entities, never internal links.
+    cache = context.LRUContextCache(max_items=10)
+    keys = [model.Key('Foo', i) for i in range(1, 4)]
+    ents = [model.Expando(key=key) for key in keys]
+    cache.update(zip(keys, ents))
+    expected = dict(zip(keys, ents))
+    self.assertFalse(isinstance(cache, dict))
+    self.assertEqual(cache, expected)
+    self.assertEqual(expected, cache)
+    self.assertFalse(cache != expected)
+    self.assertEqual(dict(cache), expected)
+    self.assertEqual(cache.copy(), expected)
+    self.assertEqual(type(cache.copy()), dict)
+    self.assertEqual(dict(cache.items()), expected)
+    self.assertEqual(dict(cache.iteritems()), expected)
+    self.assertEqual(sorted(cache.values()), sorted(ents))
+    self.assertEqual(sorted(cache.itervalues()), sorted(ents))
+    self.assertEqual(sorted(cache.keys()), keys)
+    self.assertEqual(sorted(cache), keys)
+    self.assertEqual(len(cache), 3)
+    self.assertTrue(keys[0] in cache)
+    self.assertTrue(cache.has_key(keys[0]))
+    self.assertTrue(cache[keys[0]] is ents[0])  # Now most recently used.
+    self.assertEqual(cache.popitem(), (keys[1], ents[1]))
+    self.assertEqual(cache.pop(keys[2]), ents[2])
+    self.assertEqual(cache.pop(keys[2], None), None)
+    self.assertRaises(KeyError, cache.pop, keys[2])
+    self.assertEqual(cache.setdefault(keys[0]), ents[0])
+    self.assertEqual(cache.setdefault(keys[1]), None)
+    self.assertEqual(cache, {keys[0]: ents[0], keys[1]: None})
+    cache.clear()
+    self.assertRaises(KeyError, cache.popitem)
+    self.assertEqual(cache, {})
+    self.assertRaises(TypeError, hash, cache)
+
+  def testContext_CacheBoundedTransaction(self):
+    config = context.ContextOptions(max_cache_items=2)
+    ctx = context.Context(config=config)
+    tasklets.set_context(ctx)
+    ctx.set_memcache_policy(False)
+    keys = [model.Key('Foo', 1, 'Bar', i) for i in range(1, 5)]
+    def txn():
+      tctx = tasklets.get_context()
+      self.assertEqual(type(tctx._cache), context.ContextCache)
+      for key in keys:
+        model.Expando(key=key).put()
+      self.assertEqual(len(tctx._cache), 4)
+    ctx.transaction(txn).check_success()
+    self.assertEqual(len(ctx._cache), 2)
+    self.assertEqual(ctx.get_cache_stats()['evictions'], 2)
+
+  def testContext_CacheOptionErrors(self):
+    self.assertRaises(datastore_errors.BadArgumentError,
+                      context.ContextOptions, max_cache_items=0)
+    self.assertRaises(datastore_errors.BadArgumentError,
+                      context.ContextOptions, max_cache_bytes='1k')
+
   def testContext_CacheMemcache(self):
     # Test that when get() finds the value in memcache, it updates
     # _cache.
@@ -1531,5 +2228,243 @@ class ContextFutureCachingTests(test_utils.NDBTest):
     self.assertFalse(f1 is f4,
                     'Context memcache get future cached after result known.')
 
+
+class ContextL2CacheTests(test_utils.NDBTest):
+
+  def setUp(self):
+    super(ContextL2CacheTests, self).setUp()
+    self.l2 = context.L2EntityCache(max_items=100)
+    context.set_l2_cache(self.l2)
+    class Foo(model.Model):
+      _l2_cache_timeout = 60
+      name = model.StringProperty()
+    self.Foo = Foo
+
+  def tearDown(self):
+    context.set_l2_cache(None)
+    super(ContextL2CacheTests, self).tearDown()
+
+  def NewContext(self):
+    # Simulate a new request: a fresh Context without an in-process cache.
+    ctx = context.Context()
+    ctx.set_memcache_policy(False)
+    tasklets.set_context(ctx)
+    return ctx
+
+  def testSharedAcrossContexts(self):
+    key = self.Foo(name='a').put()
+    self.assertEqual(self.l2.get(key), None)
+    self.NewContext()
+    self.assertEqual(key.get().name, 'a')
+    self.assertNotEqual(self.l2.get(key), None)
+    # Remove the entity behind the L2 cache's back.
+    self.conn.delete([key])
+    ctx = self.NewContext()
+    ent1 = key.get()
+    self.assertEqual(ent1.name, 'a')
+    self.assertEqual(ent1.key, key)
+    ctx.clear_cache()
+    ent2 = key.get()
+    self.assertEqual(ent2, ent1)
+    self.assertFalse(ent2 is ent1)  # Each get() decodes a new instance.
+    stats = self.l2.stats()
+    self.assertEqual(stats['hits'], 3)  # Including the whitebox check.
+    self.assertEqual(stats['items'], 1)
+
+  def testPutAndDeleteInvalidate(self):
+    key = self.Foo(name='a').put()
+    self.NewContext()
+    ent = key.get()
+    self.assertNotEqual(self.l2.get(key), None)
+    ent.name = 'b'
+    ent.put()
+    self.assertEqual(self.l2.get(key), None)
+    self.NewContext()
+    self.assertEqual(key.get().name, 'b')
+    self.assertNotEqual(self.l2.get(key), None)
+    key.delete()
+    self.assertEqual(self.l2.get(key), None)
+    self.NewContext()
+    self.assertEqual(key.get(), None)
+
+  def testTransactionInvalidatesOnCommit(self):
+    key = self.Foo(name='a').put()
+    ctx = self.NewContext()
+    key.get()
+    def txn():
+      ent = key.get()
+      self.assertEqual(ent.name, 'a')
+      ent.name = 'b'
+      ent.put()
+      self.assertEqual(self.l2.get(key), None)  # Invalidated before writing.
+    ctx.transaction(txn).check_success()
+    self.assertEqual(self.l2.get(key), None)
+    self.NewContext()
+    self.assertEqual(key.get().name, 'b')
+
+  def testFusedLockHitFillsL2(self):
+    ent = self.Foo(name='a')
+    key = ent.put(use_memcache=False)
+    pbs = ent._to_pb(set_key=False).SerializePartialToString()
+    # Only a memcache hit can find the entity now.
+    self.conn.delete([key])
+    ctx = self.NewContext()
+    ctx.set_memcache_policy(True)
+    mkey = ctx._memcache_prefix + key.urlsafe()
+    memcache_get = ctx.memcache_get
+    @tasklets.tasklet
+    def racing_memcache_get(*args, **kwds):
+      value = yield memcache_get(*args, **kwds)
+      memcache.set(mkey, pbs)  # Another request filled memcache meanwhile.
+      raise tasklets.Return(value)
+    ctx.memcache_get = racing_memcache_get
+    ent = ctx.get(key, memcache_fused_lock=True).get_result()
+    self.assertEqual(ent.name, 'a')
+    self.assertEqual(self.l2.get(key), pbs)
+
+  def testPolicy(self):
+    class Bar(model.Model):
+      pass
+    key = Bar().put()
+    ctx = self.NewContext()
+    key.get()
+    self.assertEqual(self.l2.get(key), None)  # Bar has no _l2_cache_timeout.
+    key.get(l2_cache_timeout=10, use_cache=False)
+    self.assertNotEqual(self.l2.get(key), None)
+    foo_key = self.Foo().put()
+    ctx.set_l2_cache_timeout_policy(0)
+    foo_key.get(use_cache=False)
+    self.assertEqual(self.l2.get(foo_key), None)
+    ctx.set_l2_cache_timeout_policy(None)
+    self.assertEqual(ctx._get_l2_cache_timeout(foo_key), 60)
+
+  def testExpiration(self):
+    self.Foo._l2_cache_timeout = 0.01
+    key = self.Foo(name='a').put()
+    self.NewContext()
+    key.get()
+    self.assertNotEqual(self.l2.get(key), None)
+    time.sleep(0.02)
+    self.assertEqual(self.l2.get(key), None)
+    stats = self.l2.stats()
+    self.assertEqual(stats['expirations'], 1)
+    self.assertEqual(stats['items'], 0)
+
+  def testStaleSetIsRejected(self):
+    key = model.Key('Foo', 1)
+    token = self.l2.generation
+    self.assertTrue(self.l2.set(key, 'old', 60, token))
+    token = self.l2.generation
+    self.l2.invalidate(key)
+    self.assertFalse(self.l2.set(key, 'old', 60, token))
+    self.assertEqual(self.l2.get(key), None)
+    token = self.l2.generation
+    self.assertTrue(self.l2.set(key, 'new', 60, token))
+    self.assertEqual(self.l2.get(key), 'new')
+
+  def testSetL2CacheTypeError(self):
+    self.assertRaises(TypeError, context.set_l2_cache, {})
+
+
+class ContextNegativeCacheTests(test_utils.NDBTest):
+
+  def setUp(self):
+    super(ContextNegativeCacheTests, self).setUp()
+    self.neg = context.NegativeCache(capacity=1000, error_rate=1e-6)
+    context.set_negative_cache(self.neg)
+    class Marker(model.Model):
+      _negative_cache_timeout = 60
+    self.Marker = Marker
+    MyAutoBatcher.reset_log()
+    self.ctx = context.Context(auto_batcher_class=MyAutoBatcher)
+    self.ctx.set_cache_policy(False)
+    tasklets.set_context(self.ctx)
+
+  def tearDown(self):
+    context.set_negative_cache(None)
+    super(ContextNegativeCacheTests, self).tearDown()
+
+  def CountGets(self):
+    return len([name for name, _ in MyAutoBatcher._log
+                if name == '_get_tasklet'])
+
+  def testMissIsRemembered(self):
+    key = model.Key('Marker', 'token')
+    self.assertEqual(key.get(), None)
+    self.assertEqual(self.CountGets(), 1)
+    MyAutoBatcher.reset_log()
+    self.assertEqual(key.get(), None)
+    self.assertEqual(MyAutoBatcher._log, [])  # No memcache or datastore.
+    self.assertEqual(self.neg.stats()['hits'], 1)
+
+  def testPutInvalidates(self):
+    key = model.Key('Marker', 'token')
+    self.assertEqual(key.get(), None)
+    self.Marker(key=key).put()
+    self.assertNotEqual(key.get(), None)
+    self.assertFalse(self.neg.contains(key, 60))
+
+  def testPutInTransactionInvalidates(self):
+    key = model.Key('Marker', 'token')
+    self.assertEqual(key.get(), None)
+    def txn():
+      self.assertEqual(key.get(), None)  # Not from the negative cache.
+      self.Marker(key=key).put()
+    self.ctx.transaction(txn).check_success()
+    self.assertEqual(self.CountGets(), 2)
+    self.assertNotEqual(key.get(), None)
+
+  def testConcurrentPutDropsMiss(self):
+    key = model.Key('Marker', 'token')
+    token = self.neg.token(key)
+    self.assertTrue(self.neg.add(key, 60, token))
+    token = self.neg.token(key)
+    self.neg.invalidate(model.Key('Marker', 'other'))
+    self.assertFalse(self.neg.add(key, 60, token))
+
+  def testConcurrentPutDropsFirstMiss(self):
+    # The first miss for a kind races a put before there is a filter.
+    key = model.Key('Marker', 'token')
+    token = self.neg.token(key)
+    self.neg.invalidate(key)
+    self.assertFalse(self.neg.add(key, 60, token))
+    self.assertFalse(self.neg.contains(key, 60))
+    # Likewise for clear(), for a kind it has never seen.
+    key = model.Key('Other', 'token')
+    token = self.neg.token(key)
+    self.neg.clear()
+    self.assertFalse(self.neg.add(key, 60, token))
+    self.assertTrue(self.neg.add(key, 60, self.neg.token(key)))
+
+  def testPolicy(self):
+    key = model.Key('Other', 1)
+    key.get()
+    key.get()
+    self.assertEqual(self.CountGets(), 2)  # Not enabled for this kind.
+    key.get(negative_cache_timeout=10)
+    key.get(negative_cache_timeout=10)
+    self.assertEqual(self.CountGets(), 3)
+    self.ctx.set_negative_cache_timeout_policy(0)
+    marker_key = model.Key('Marker', 1)
+    marker_key.get()
+    marker_key.get()
+    self.assertEqual(self.CountGets(), 5)
+    self.ctx.set_negative_cache_timeout_policy(None)
+    self.assertEqual(self.ctx._get_negative_cache_timeout(marker_key), 60)
+
+  def testExpiration(self):
+    self.Marker._negative_cache_timeout = 0.02
+    key = model.Key('Marker', 'token')
+    key.get()
+    self.assertTrue(self.neg.contains(key, 0.02))
+    time.sleep(0.05)
+    self.assertFalse(self.neg.contains(key, 0.02))
+
+  def testArguments(self):
+    self.assertRaises(ValueError, context.NegativeCache, capacity=0)
+    self.assertRaises(ValueError, context.NegativeCache, error_rate=1)
+    self.assertRaises(TypeError, context.set_negative_cache, set())
+
+
 if __name__ == '__main__':
   unittest.main()
@@ -53,6 +53,7 @@ class NdbDjangoMiddleware(object):
     tasklets.set_context(None)
     ctx.flush().check_success()
     eventloop.run()  # Ensure writes are flushed, etc.
+    eventloop.report_stats()
 
   def process_response(self, request, response):
     """Called by Django just before returning a response."""
@@ -7,23 +7,42 @@ callback functions with an optional time delay.
 Normally, event loops are singleton objects, though there is no
 enforcement of this requirement.
 
+EventLoop is also the interface for alternative event loop backends:
+a backend subclasses it and overrides wait(), which is called when
+nothing else is ready to run.  SelectEventLoop is such a backend; it
+can also wait for file descriptors to become ready.  Use
+set_event_loop_class() to choose the backend for the current thread.
+
+Call enable_stats() to have event loops collect counts and timings of
+the callbacks they run and of the time they spend waiting; see
+report_stats().
+
 The API here is inspired by Monocle.
 """
 
 import collections
+import errno
+import heapq
 import logging
 import os
+import threading
 import time
 
+try:
+  import select as _select
+except ImportError:
+  _select = None  # E.g. in the App Engine sandbox.
+
 from .google_imports import apiproxy_rpc
 from .google_imports import datastore_rpc
 
 from . import utils
 
-__all__ = ['EventLoop',
-           'add_idle', 'queue_call', 'queue_rpc',
-           'get_event_loop',
+__all__ = ['EventLoop', 'SelectEventLoop',
+           'add_idle', 'queue_call', 'cancel_call', 'queue_rpc',
+           'get_event_loop', 'set_event_loop_class',
            'run', 'run0', 'run1',
+           'enable_stats', 'get_stats', 'report_stats', 'set_stats_hook',
            ]
 
 _logging_debug = utils.logging_debug
@@ -46,24 +65,44 @@ class EventLoop(object):
         run only when no other RPCs need to be fired first.
         For example, AutoBatcher uses idler to fire a batch RPC even before
         the batch is full.
-      queue: a sorted list of (absolute time in sec, callback, args, kwds),
-        sorted by time. These callbacks run only after the said time.
+      queue: a heap of [absolute time in sec, sequence number, callback,
+        args, kwds] lists, ordered by time and then by sequence number
+        (so events with the same time run in FIFO order).  These
+        callbacks run only after the said time.  A cancelled event has
+        its callback set to None and is discarded when it reaches the
+        top of the heap.
       rpcs: a map from rpc to (callback, args, kwds). Callback is called
         when the rpc finishes.
+      stats: an _EventLoopStats instance if stats are enabled (see
+        enable_stats()), else None.
+      incoming: a FIFO list of (callback, args, kwds) queued by other
+        threads using queue_threadsafe_call(); guarded by lock.
+      expected: how many calls from other threads are still expected
+        (see expect_threadsafe_call()).
     """
     self.current = collections.deque()
     self.idlers = collections.deque()
     self.inactive = 0  # How many idlers in a row were no-ops
     self.queue = []
+    self.counter = 0  # Sequence number for queue entries.
+    self.cancelled = 0  # How many queue entries are cancelled.
     self.rpcs = {}
+    self.incoming = collections.deque()
+    self.expected = 0
+    self.lock = threading.Condition(threading.Lock())
+    self.stats = None
+    if _stats_enabled:
+      self.stats = _EventLoopStats()
 
   def clear(self):
     """Remove all pending events without running any."""
-    while self.current or self.idlers or self.queue or self.rpcs:
+    while (self.current or self.idlers or self.queue or self.rpcs or
+           self.incoming or self.expected):
       current = self.current
       idlers = self.idlers
       queue = self.queue
       rpcs = self.rpcs
+      incoming = self.incoming
       _logging_debug('Clearing stale EventLoop instance...')
       if current:
         _logging_debug('  current = %s', current)
@@ -73,47 +112,99 @@ class EventLoop(object):
         _logging_debug('  queue = %s', queue)
       if rpcs:
         _logging_debug('  rpcs = %s', rpcs)
+      if incoming or self.expected:
+        _logging_debug('  incoming = %s (%d expected)',
+                       incoming, self.expected)
       self.__init__()
       current.clear()
       idlers.clear()
       queue[:] = []
       rpcs.clear()
+      incoming.clear()
       _logging_debug('Cleared')
 
-  def insort_event_right(self, event, lo=0, hi=None):
-    """Insert event in queue, and keep it sorted assuming queue is sorted.
+  def _has_pending(self):
+    """Return True if there are any pending events."""
+    return bool(self.current or self.idlers or self.queue or self.rpcs or
+                self.incoming or self.expected)
 
-    If event is already in queue, insert it to the right of the rightmost
-    event (to keep FIFO order).
+  def enable_stats(self, enabled=True):
+    """Start or stop collecting stats; see get_stats().
+
+    Enabling stats when they are already enabled keeps what has been
+    collected so far.
+    """
+    if not enabled:
+      self.stats = None
+    elif self.stats is None:
+      self.stats = _EventLoopStats()
 
-    Optional args lo (default 0) and hi (default len(a)) bound the
-    slice of a to be searched.
+  def get_stats(self, reset=False):
+    """Return a snapshot of the stats collected so far.
 
     Args:
-      event: a (time in sec since unix epoch, callback, args, kwds) tuple.
-    """
+      reset: If True, start collecting afresh afterwards.
 
-    if lo < 0:
-        raise ValueError('lo must be non-negative')
-    if hi is None:
-        hi = len(self.queue)
-    while lo < hi:
-        mid = (lo + hi) // 2
-        if event[0] < self.queue[mid][0]: hi = mid
-        else: lo = mid + 1
-    self.queue.insert(lo, event)
+    Returns:
+      None if stats are not enabled; otherwise a dict as described in
+      _EventLoopStats.snapshot().
+    """
+    stats = self.stats
+    if stats is None:
+      return None
+    if reset:
+      self.stats = _EventLoopStats()
+    return stats.snapshot()
 
   def queue_call(self, delay, callback, *args, **kwds):
-    """Schedule a function call at a specific time in the future."""
+    """Schedule a function call at a specific time in the future.
+
+    Returns:
+      None if delay is None (meaning the call is scheduled to run as
+      soon as possible); otherwise an opaque handle that can be passed
+      to cancel_call().
+    """
     if delay is None:
       self.current.append((callback, args, kwds))
-      return
+      return None
     if delay < 1e9:
       when = delay + time.time()
     else:
       # Times over a billion seconds are assumed to be absolute.
       when = delay
-    self.insort_event_right((when, callback, args, kwds))
+    self.counter += 1
+    event = [when, self.counter, callback, args, kwds]
+    heapq.heappush(self.queue, event)
+    return event
+
+  def cancel_call(self, event):
+    """Cancel a call scheduled with queue_call().
+
+    Args:
+      event: The handle returned by queue_call().
+
+    Returns:
+      True if the call was cancelled, False if it already ran or was
+      already cancelled.
+    """
+    if event is None or event[2] is None:
+      return False
+    event[2] = None
+    event[3] = event[4] = None  # Release references early.
+    self.cancelled += 1
+    if self.cancelled > 64 and self.cancelled * 2 > len(self.queue):
+      # Most of the heap is dead weight; rebuild it without those.
+      self.queue[:] = [ev for ev in self.queue if ev[2] is not None]
+      heapq.heapify(self.queue)
+      self.cancelled = 0
+    return True
+
+  def _pop_cancelled(self):
+    """Discard cancelled events from the top of the queue."""
+    queue = self.queue
+    while queue and queue[0][2] is None:
+      heapq.heappop(queue)
+      self.cancelled -= 1
 
   def queue_rpc(self, rpc, callback=None, *args, **kwds):
     """Schedule an RPC with an optional callback.
@@ -146,6 +237,50 @@ class EventLoop(object):
     for rpc in rpcs:
       self.rpcs[rpc] = (callback, args, kwds)
 
+  def expect_threadsafe_call(self):
+    """Announce that another thread will call queue_threadsafe_call().
+
+    Until that call arrives, run0() waits for it instead of reporting
+    that all queues are empty.  This must be called from the thread
+    that runs the event loop, once for each expected call.
+    """
+    self.expected += 1
+
+  def queue_threadsafe_call(self, callback, *args, **kwds):
+    """Schedule a function call from another thread.
+
+    The call runs as soon as possible in the thread that runs the event
+    loop, waking it up if it is waiting.  Each such call satisfies one
+    earlier expect_threadsafe_call().  (While RPCs are pending the loop
+    is blocked waiting for those, so the call may only run after the
+    next RPC completes.)
+    """
+    self.lock.acquire()
+    try:
+      self.incoming.append((callback, args, kwds))
+      self.lock.notify()
+    finally:
+      self.lock.release()
+
+  def _take_incoming(self):
+    """Move calls queued by other threads to the current queue."""
+    self.lock.acquire()
+    try:
+      while self.incoming:
+        self.current.append(self.incoming.popleft())
+        self.expected -= 1
+    finally:
+      self.lock.release()
+
+  def _wait_incoming(self, delay):
+    """Wait at most delay seconds (None means forever) for another thread."""
+    self.lock.acquire()
+    try:
+      if not self.incoming:
+        self.lock.wait(delay)
+    finally:
+      self.lock.release()
+
   def add_idle(self, callback, *args, **kwds):
     """Add an idle callback.
 
@@ -171,7 +306,10 @@ class EventLoop(object):
     idler = self.idlers.popleft()
     callback, args, kwds = idler
     _logging_debug('idler: %s', callback.__name__)
-    res = callback(*args, **kwds)
+    if self.stats is None:
+      res = callback(*args, **kwds)
+    else:
+      res = self.stats.call('idle', callback, args, kwds)
     # See add_idle() for the meaning of the callback return value.
     if res is not None:
       if res:
@@ -190,27 +328,60 @@ class EventLoop(object):
       A time to sleep if something happened (may be 0);
       None if all queues are empty.
     """
+    if self.incoming:
+      self._take_incoming()
     if self.current:
       self.inactive = 0
       callback, args, kwds = self.current.popleft()
       _logging_debug('nowevent: %s', callback.__name__)
-      callback(*args, **kwds)
+      if self.stats is None:
+        callback(*args, **kwds)
+      else:
+        self.stats.call('current', callback, args, kwds)
       return 0
     if self.run_idle():
       return 0
     delay = None
+    if self.cancelled:
+      self._pop_cancelled()
     if self.queue:
       delay = self.queue[0][0] - time.time()
       if delay <= 0:
         self.inactive = 0
-        _, callback, args, kwds = self.queue.pop(0)
+        event = heapq.heappop(self.queue)
+        _, _, callback, args, kwds = event
+        event[2] = None  # Make a late cancel_call() a no-op.
         _logging_debug('event: %s', callback.__name__)
-        callback(*args, **kwds)
+        if self.stats is None:
+          callback(*args, **kwds)
+        else:
+          self.stats.add_lag(-delay)
+          self.stats.call('timer', callback, args, kwds)
         # TODO: What if it raises an exception?
         return 0
+    return self.wait(delay)
+
+  def wait(self, delay):
+    """Wait for I/O to complete and run its callback.
+
+    This is called by run0() when no callback, idler or timer was
+    ready to run; it is the method that EventLoop backends override.
+
+    Args:
+      delay: Seconds until the next timer is due, or None if there
+        are no timers.
+
+    Returns:
+      Like run0(): a time to sleep if something happened (may be 0);
+      None if there was nothing to wait for.
+    """
     if self.rpcs:
       self.inactive = 0
-      rpc = datastore_rpc.MultiRpc.wait_any(self.rpcs)
+      if self.stats is None:
+        rpc = datastore_rpc.MultiRpc.wait_any(self.rpcs)
+      else:
+        rpc = self.stats.wait('rpc', datastore_rpc.MultiRpc.wait_any,
+                              self.rpcs)
       if rpc is not None:
         _logging_debug('rpc: %s.%s', rpc.service, rpc.method)
         # Yes, wait_any() may return None even for a non-empty argument.
@@ -221,9 +392,20 @@ class EventLoop(object):
         callback, args, kwds = self.rpcs[rpc]
         del self.rpcs[rpc]
         if callback is not None:
-          callback(*args, **kwds)
+          if self.stats is None:
+            callback(*args, **kwds)
+          else:
+            self.stats.call('rpc', callback, args, kwds)
           # TODO: Again, what about exceptions?
       return 0
+    if self.expected:
+      # Nothing to do until another thread calls back (or a timer is due).
+      self.inactive = 0
+      if self.stats is None:
+        self._wait_incoming(delay)
+      else:
+        self.stats.wait('thread', self._wait_incoming, delay)
+      return 0
     return delay
 
   def run1(self):
@@ -236,7 +418,10 @@ class EventLoop(object):
     if delay is None:
       return False
     if delay > 0:
-      time.sleep(delay)
+      if self.stats is None:
+        time.sleep(delay)
+      else:
+        self.stats.wait('sleep', time.sleep, delay)
     return True
 
   def run(self):
@@ -248,8 +433,338 @@ class EventLoop(object):
         break
 
 
+class SelectEventLoop(EventLoop):
+  """An event loop that can also wait for file descriptors.
+
+  Callbacks registered with add_reader() or add_writer() are called
+  each time their file descriptor is ready, until they are removed.
+  An RPC that has a fileno() method is waited for the same way, so
+  that many such RPCs can be waited for at once.  Other RPCs are
+  waited for using MultiRpc.wait_any(), as in EventLoop; while any of
+  those (or calls from other threads, see expect_threadsafe_call())
+  are pending, file descriptors are only polled between them.
+
+  epoll is used where available, select() elsewhere.
+  """
+
+  _use_epoll = True  # Tests set this to False to exercise select().
+
+  def __init__(self):
+    """Constructor.
+
+    Fields (in addition to those of EventLoop):
+      readers: a map from file descriptor to (callback, args, kwds).
+        The callback is called when the descriptor is readable.
+      writers: a map from file descriptor to (callback, args, kwds).
+        The callback is called when the descriptor is writable.
+    """
+    if _select is None:
+      raise RuntimeError('SelectEventLoop requires the select module')
+    super(SelectEventLoop, self).__init__()
+    self.readers = {}
+    self.writers = {}
+    epoll = getattr(self, '_epoll', None)
+    if epoll is not None:
+      epoll.close()
+    self._epoll = None
+    self._registered = set()  # File descriptors registered with epoll.
+    if self._use_epoll and hasattr(_select, 'epoll'):
+      self._epoll = _select.epoll()
+
+  def clear(self):
+    """Remove all pending events without running any."""
+    if self.readers or self.writers:
+      _logging_debug('  readers = %s', self.readers)
+      _logging_debug('  writers = %s', self.writers)
+      for fd in list(self._registered):
+        self._epoll.unregister(fd)
+      self._registered.clear()
+      self.readers.clear()
+      self.writers.clear()
+    super(SelectEventLoop, self).clear()
+
+  def _has_pending(self):
+    return (super(SelectEventLoop, self)._has_pending() or
+            bool(self.readers or self.writers))
+
+  def add_reader(self, fd, callback, *args, **kwds):
+    """Call a callback whenever a file descriptor is readable.
+
+    This replaces any reader callback already set for the descriptor.
+    """
+    self.readers[fd] = (callback, args, kwds)
+    self._update(fd)
+
+  def remove_reader(self, fd):
+    """Stop watching a file descriptor for readability.
+
+    Returns:
+      True if a reader callback was removed, False otherwise.
+    """
+    if self.readers.pop(fd, None) is None:
+      return False
+    self._update(fd)
+    return True
+
+  def add_writer(self, fd, callback, *args, **kwds):
+    """Call a callback whenever a file descriptor is writable.
+
+    This replaces any writer callback already set for the descriptor.
+    """
+    self.writers[fd] = (callback, args, kwds)
+    self._update(fd)
+
+  def remove_writer(self, fd):
+    """Stop watching a file descriptor for writability.
+
+    Returns:
+      True if a writer callback was removed, False otherwise.
+    """
+    if self.writers.pop(fd, None) is None:
+      return False
+    self._update(fd)
+    return True
+
+  def _update(self, fd):
+    """Bring the epoll registration for a file descriptor up to date."""
+    if self._epoll is None:
+      return
+    mask = 0
+    if fd in self.readers:
+      mask |= _select.EPOLLIN
+    if fd in self.writers:
+      mask |= _select.EPOLLOUT
+    if fd in self._registered:
+      if mask:
+        self._epoll.modify(fd, mask)
+      else:
+        self._epoll.unregister(fd)
+        self._registered.discard(fd)
+    elif mask:
+      self._epoll.register(fd, mask)
+      self._registered.add(fd)
+
+  def queue_rpc(self, rpc, callback=None, *args, **kwds):
+    """Schedule an RPC with an optional callback.
+
+    If the RPC has a fileno() method, the callback is called when that
+    file descriptor becomes readable; otherwise this is the same as
+    EventLoop.queue_rpc().
+    """
+    fileno = getattr(rpc, 'fileno', None)
+    if fileno is None:
+      super(SelectEventLoop, self).queue_rpc(rpc, callback, *args, **kwds)
+      return
+    if rpc.state not in (_RUNNING, _FINISHING):
+      raise RuntimeError('rpc must be sent to service before queueing')
+    fd = fileno()
+    def rpc_ready():
+      self.remove_reader(fd)
+      if callback is not None:
+        callback(*args, **kwds)
+    self.add_reader(fd, rpc_ready)
+
+  def _poll(self, timeout):
+    """Wait for file descriptors to become ready.
+
+    Args:
+      timeout: Seconds to wait at most, or None to wait indefinitely.
+
+    Returns:
+      A list of (callback, args, kwds) for the ready descriptors.
+    """
+    try:
+      if self._epoll is not None:
+        if timeout is None:
+          timeout = -1
+        events = self._epoll.poll(timeout)
+      else:
+        rlist, wlist, _ = _select.select(list(self.readers),
+                                         list(self.writers), [], timeout)
+        events = [(fd, _READABLE) for fd in rlist]
+        events += [(fd, _WRITABLE) for fd in wlist]
+    except (_select.error, IOError, OSError), err:
+      if err.args and err.args[0] == errno.EINTR:
+        return []
+      raise
+    ready = []
+    for fd, mask in events:
+      if mask & _READABLE and fd in self.readers:
+        ready.append(self.readers[fd])
+      if mask & _WRITABLE and fd in self.writers:
+        ready.append(self.writers[fd])
+    return ready
+
+  def wait(self, delay):
+    """Wait for file descriptors, RPCs or the next timer.
+
+    See EventLoop.wait().
+    """
+    if not self.readers and not self.writers:
+      return super(SelectEventLoop, self).wait(delay)
+    self.inactive = 0
+    if self.rpcs or self.expected:
+      # We can't block on both at once; just poll the descriptors.
+      timeout = 0
+    elif delay is None:
+      timeout = None
+    else:
+      timeout = max(delay, 0)
+    if self.stats is None:
+      ready = self._poll(timeout)
+    else:
+      ready = self.stats.wait('fd', self._poll, timeout)
+    for callback, args, kwds in ready:
+      _logging_debug('fd: %s', callback.__name__)
+      if self.stats is None:
+        callback(*args, **kwds)
+      else:
+        self.stats.call('fd', callback, args, kwds)
+    if ready or not (self.rpcs or self.expected):
+      return 0
+    return super(SelectEventLoop, self).wait(delay)
+
+
+if _select is not None and hasattr(_select, 'epoll'):
+  # Errors and hangups count as ready, so the callback gets to see them.
+  _READABLE = _select.EPOLLIN | _select.EPOLLERR | _select.EPOLLHUP
+  _WRITABLE = _select.EPOLLOUT | _select.EPOLLERR | _select.EPOLLHUP
+else:
+  _READABLE = 1
+  _WRITABLE = 4
+
+
+class _EventLoopStats(object):
+  """Counts and timings collected by an EventLoop.
+
+  Callbacks are timed per category: 'current' (queued with a delay of
+  None), 'idle', 'timer', 'rpc' (RPC completion callbacks) and, for
+  SelectEventLoop, 'fd'.  Time spent blocked is recorded per kind of
+  wait: 'rpc' (MultiRpc.wait_any()), 'sleep' (until the next timer),
+  'thread' (for another thread, see expect_threadsafe_call()) and
+  'fd' (select or epoll).  The time a callback spends in a nested
+  event loop is attributed to the nested callbacks and waits, not to
+  the callback itself, so the callback times add up to CPU time.
+  """
+
+  def __init__(self):
+    self.started = time.time()
+    self.calls = {}  # Maps category to [count, time, max time, name].
+    self.waits = {}  # Maps kind to [count, time, max time].
+    self.rpc_histogram = {}  # Maps a power of two (msec) to a count.
+    self.lag = [0, 0.0, 0.0]  # Count, total and max timer lag.
+    self.nested = 0.0  # Time spent in nested calls and waits so far.
+
+  def call(self, category, callback, args, kwds):
+    """Call callback(*args, **kwds), timing it; return its result."""
+    outer = self.nested
+    self.nested = 0.0
+    t0 = time.time()
+    try:
+      return callback(*args, **kwds)
+    finally:
+      elapsed = time.time() - t0
+      own = elapsed - self.nested
+      self.nested = outer + elapsed
+      record = self.calls.get(category)
+      if record is None:
+        record = self.calls[category] = [0, 0.0, 0.0, None]
+      record[0] += 1
+      record[1] += own
+      if own >= record[2]:
+        record[2] = own
+        record[3] = getattr(callback, '__name__', None) or repr(callback)
+
+  def wait(self, kind, func, *args):
+    """Call func(*args), timing it as a wait; return its result."""
+    t0 = time.time()
+    try:
+      return func(*args)
+    finally:
+      elapsed = time.time() - t0
+      self.nested += elapsed
+      record = self.waits.get(kind)
+      if record is None:
+        record = self.waits[kind] = [0, 0.0, 0.0]
+      record[0] += 1
+      record[1] += elapsed
+      record[2] = max(record[2], elapsed)
+      if kind == 'rpc':
+        bucket = 1
+        while bucket < elapsed * 1000:
+          bucket <<= 1
+        self.rpc_histogram[bucket] = self.rpc_histogram.get(bucket, 0) + 1
+
+  def add_lag(self, lag):
+    """Record how late a timer callback is run."""
+    self.lag[0] += 1
+    self.lag[1] += lag
+    self.lag[2] = max(self.lag[2], lag)
+
+  def snapshot(self):
+    """Return the stats as a dict.
+
+    The dict has these keys:
+      elapsed: Seconds since the stats were started.
+      calls: A dict mapping each callback category to a dict with keys
+        count, time (total seconds), max_time and max_name (the name
+        of the slowest callback).
+      waits: A dict mapping each kind of wait to a dict with keys
+        count, time and max_time.
+      cpu_time: Total seconds spent in callbacks.
+      wait_time: Total seconds spent waiting.
+      rpc_wait_histogram: A dict mapping a power of two N to the number
+        of RPC waits that took more than N/2 and at most N msec.
+      timer_lag: A dict with keys count, time and max_time, giving how
+        long after their due time timer callbacks were run.
+    """
+    calls = {}
+    cpu_time = 0.0
+    for category, (count, total, longest, name) in self.calls.iteritems():
+      calls[category] = {'count': count, 'time': total,
+                         'max_time': longest, 'max_name': name}
+      cpu_time += total
+    waits = {}
+    wait_time = 0.0
+    for kind, (count, total, longest) in self.waits.iteritems():
+      waits[kind] = {'count': count, 'time': total, 'max_time': longest}
+      wait_time += total
+    count, total, longest = self.lag
+    return {'elapsed': time.time() - self.started,
+            'calls': calls,
+            'waits': waits,
+            'cpu_time': cpu_time,
+            'wait_time': wait_time,
+            'rpc_wait_histogram': dict(self.rpc_histogram),
+            'timer_lag': {'count': count, 'time': total, 'max_time': longest},
+            }
+
+
+def _log_stats(stats):
+  """The default stats hook: log a one-line summary."""
+  ncalls = sum(call['count'] for call in stats['calls'].itervalues())
+  slowest = None
+  for call in stats['calls'].itervalues():
+    if slowest is None or call['max_time'] > slowest['max_time']:
+      slowest = call
+  rpc_wait = stats['waits'].get('rpc', {'count': 0, 'time': 0.0})
+  logging.info('EventLoop: %d callbacks in %.3f sec (slowest %s, %.3f sec); '
+               '%d RPC waits in %.3f sec; %.3f sec waiting in total; '
+               'max timer lag %.3f sec',
+               ncalls, stats['cpu_time'],
+               slowest and slowest['max_name'],
+               slowest and slowest['max_time'] or 0.0,
+               rpc_wait['count'], rpc_wait['time'], stats['wait_time'],
+               stats['timer_lag']['max_time'])
+
+
+_stats_enabled = False  # See enable_stats().
+_stats_hook = _log_stats  # See set_stats_hook().
+
+
 class _State(utils.threading_local):
   event_loop = None
+  event_loop_class = None  # None means EventLoop.
 
 
 _EVENT_LOOP_KEY = '__EVENT_LOOP__'
@@ -270,15 +785,92 @@ def get_event_loop():
     _state.event_loop = None
     ev = None
   if ev is None:
-    ev = EventLoop()
+    ev = (_state.event_loop_class or EventLoop)()
     _state.event_loop = ev
     os.environ[_EVENT_LOOP_KEY] = '1'
   return ev
 
 
+def set_event_loop_class(cls):
+  """Set the EventLoop class that get_event_loop() uses in this thread.
+
+  Args:
+    cls: EventLoop or a subclass of it (e.g. SelectEventLoop), or None
+      to restore the default.
+
+  If the thread's current event loop is of a different class it is
+  replaced right away, which is only allowed while it has no pending
+  events; otherwise RuntimeError is raised.
+  """
+  if cls is not None and not (isinstance(cls, type) and
+                              issubclass(cls, EventLoop)):
+    raise TypeError('Expected an EventLoop subclass, got %r' % (cls,))
+  ev = _state.event_loop
+  if ev is not None and ev.__class__ is not (cls or EventLoop):
+    if not os.getenv(_EVENT_LOOP_KEY):
+      ev.clear()  # Left over from a previous request.
+    elif ev._has_pending():
+      raise RuntimeError('Cannot replace an event loop with pending events')
+    _state.event_loop = None
+  _state.event_loop_class = cls
+
+
+def enable_stats(enabled=True):
+  """Turn stats collection on or off for all event loops.
+
+  This affects the current thread's event loop as well as those
+  created later (e.g. for new requests).
+  """
+  global _stats_enabled
+  _stats_enabled = bool(enabled)
+  get_event_loop().enable_stats(enabled)
+
+
+def get_stats(reset=False):
+  """Return the stats of the current event loop; see EventLoop.get_stats()."""
+  return get_event_loop().get_stats(reset)
+
+
+def set_stats_hook(hook):
+  """Set the function that report_stats() calls.
+
+  Args:
+    hook: A function taking a stats dict (see EventLoop.get_stats()),
+      or None to restore the default, which logs a one-line summary.
+  """
+  global _stats_hook
+  _stats_hook = hook or _log_stats
+
+
+def report_stats():
+  """Pass the current event loop's stats to the stats hook and reset them.
+
+  This is called at the end of each request by toplevel() and
+  NdbDjangoMiddleware.  It does nothing unless stats are enabled.
+  Exceptions raised by the hook are logged, not propagated.
+
+  Returns:
+    The stats dict, or None if stats are not enabled.
+  """
+  ev = _state.event_loop
+  if ev is None or ev.stats is None:
+    return None
+  stats = ev.get_stats(reset=True)
+  try:
+    _stats_hook(stats)
+  except Exception:
+    logging.exception('EventLoop stats hook failed')
+  return stats
+
+
 def queue_call(*args, **kwds):
   ev = get_event_loop()
-  ev.queue_call(*args, **kwds)
+  return ev.queue_call(*args, **kwds)
+
+
+def cancel_call(event):
+  ev = get_event_loop()
+  return ev.cancel_call(event)
 
 
 def queue_rpc(rpc, callback=None, *args, **kwds):
@@ -2,8 +2,10 @@
 
 import logging
 import os
+import threading
 import time
 
+from .google_imports import apiproxy_rpc
 from .google_imports import apiproxy_stub_map
 from .google_imports import datastore_rpc
 from .google_test_imports import unittest
@@ -12,12 +14,23 @@ from . import eventloop
 from . import test_utils
 
 class EventLoopTests(test_utils.NDBTest):
+  """Conformance tests; subclassed below for each EventLoop backend."""
+
+  event_loop_class = eventloop.EventLoop
 
   def setUp(self):
     super(EventLoopTests, self).setUp()
     if eventloop._EVENT_LOOP_KEY in os.environ:
       del os.environ[eventloop._EVENT_LOOP_KEY]
+    eventloop.set_event_loop_class(self.event_loop_class)
     self.ev = eventloop.get_event_loop()
+    self.assertEqual(self.ev.__class__, self.event_loop_class)
+
+  def tearDown(self):
+    super(EventLoopTests, self).tearDown()
+    # Idlers may linger; end the request so the loop can be replaced.
+    del os.environ[eventloop._EVENT_LOOP_KEY]
+    eventloop.set_event_loop_class(None)
 
   the_module = eventloop
 
@@ -31,7 +44,8 @@ class EventLoopTests(test_utils.NDBTest):
     eventloop.queue_call(2, g, 100, 'abc')
     t_after = time.time()
     self.assertEqual(len(self.ev.queue), 3)
-    [(t1, f1, a1, k1), (t2, f2, a2, k2), (t3, f3, a3, k3)] = self.ev.queue
+    [(t1, _, f1, a1, k1), (t2, _, f2, a2, k2), (t3, _, f3, a3, k3)] = sorted(
+      self.ev.queue)
     self.assertTrue(t1 < t2)
     self.assertTrue(t2 < t3)
     self.assertTrue(abs(t1 - (t_before + 1)) <= t_after - t_before)
@@ -64,7 +78,7 @@ class EventLoopTests(test_utils.NDBTest):
     [(_f1, a1, _k1), (_f2, a2, _k2)] = self.ev.current
     self.assertEqual(a1, (2,))  # first event should have arg = 2
     self.assertEqual(a2, (1,))  # second event should have arg = 1
-    (_t, _f, a, _k) = self.ev.queue[0]
+    (_t, _n, _f, a, _k) = self.ev.queue[0]
     self.assertEqual(a, (0,))  # third event should have arg = 0
 
     eventloop.run()
@@ -80,6 +94,44 @@ class EventLoopTests(test_utils.NDBTest):
     eventloop.run()
     self.assertEqual(record, ['hello', 42])
 
+  def testFifoOrderForEventsWithSameTime(self):
+    order = []
+    def foo(arg): order.append(arg)
+    when = time.time()
+    for i in range(10):
+      self.ev.queue_call(when, foo, i)
+    eventloop.queue_call(when - 1, foo, -1)
+    eventloop.run()
+    self.assertEqual(order, [-1, 0, 1, 2, 3, 4, 5, 6, 7, 8, 9])
+
+  def testCancelCall(self):
+    record = []
+    def foo(arg):
+      record.append(arg)
+    e1 = eventloop.queue_call(0.01, foo, 1)
+    e2 = eventloop.queue_call(0.02, foo, 2)
+    e3 = eventloop.queue_call(0.03, foo, 3)
+    self.assertTrue(eventloop.cancel_call(e2))
+    self.assertFalse(eventloop.cancel_call(e2))
+    self.assertTrue(self.ev.cancel_call(e1))
+    self.assertEqual(eventloop.queue_call(None, foo, 0), None)
+    eventloop.run()
+    self.assertEqual(record, [0, 3])
+    self.assertFalse(eventloop.cancel_call(e3))  # Already ran.
+    self.assertEqual(self.ev.queue, [])
+    self.assertEqual(self.ev.cancelled, 0)
+
+  def testCancelManyCalls(self):
+    record = []
+    def foo(arg):
+      record.append(arg)
+    events = [eventloop.queue_call(0, foo, i) for i in range(200)]
+    for event in events[:150]:
+      eventloop.cancel_call(event)
+    self.assertTrue(len(self.ev.queue) < 200)  # The heap was compacted.
+    eventloop.run()
+    self.assertEqual(record, range(150, 200))
+
   def testRunWithRpcs(self):
     record = []
     def foo(arg):
@@ -151,6 +203,219 @@ class EventLoopTests(test_utils.NDBTest):
     ev = eventloop.get_event_loop()  # A new event loop.
     self.assertEqual(len(ev.rpcs), 0)
 
+  def testThreadsafeCall(self):
+    record = []
+    def worker():
+      time.sleep(0.01)
+      self.ev.queue_threadsafe_call(record.append, 'worker')
+    eventloop.queue_call(0.05, record.append, 'timer')
+    self.ev.expect_threadsafe_call()
+    thread = threading.Thread(target=worker)
+    thread.start()
+    self.ev.run()  # Waits for the worker thread and the timer.
+    thread.join()
+    self.assertEqual(record, ['worker', 'timer'])
+    self.assertEqual(self.ev.expected, 0)
+    self.assertEqual(self.ev.run0(), None)
+
+  def testStats(self):
+    self.assertEqual(self.ev.get_stats(), None)
+    self.ev.enable_stats()
+    def idler():
+      return None
+    self.ev.add_idle(idler)
+    eventloop.queue_call(None, lambda: None)
+    eventloop.queue_call(0.01, time.sleep, 0.01)
+    self.ev.run()
+    stats = eventloop.get_stats()
+    calls = stats['calls']
+    self.assertEqual(sorted(calls), ['current', 'idle', 'timer'])
+    self.assertEqual(calls['current']['count'], 1)
+    self.assertEqual(calls['idle']['count'], 1)
+    self.assertEqual(calls['idle']['max_name'], 'idler')
+    self.assertEqual(calls['timer']['count'], 1)
+    self.assertEqual(calls['timer']['max_name'], 'sleep')
+    self.assertTrue(calls['timer']['max_time'] >= 0.005)
+    self.assertTrue(stats['cpu_time'] >= calls['timer']['time'])
+    self.assertTrue(stats['waits']['sleep']['count'] >= 1)
+    self.assertEqual(stats['timer_lag']['count'], 1)
+    self.assertTrue(stats['timer_lag']['max_time'] >= 0)
+    self.assertEqual(stats['rpc_wait_histogram'], {})
+    self.ev.enable_stats(False)
+    self.assertEqual(self.ev.get_stats(), None)
+
+  def testStatsNestedRun(self):
+    self.ev.enable_stats()
+    def inner():
+      time.sleep(0.02)
+    def outer():
+      eventloop.queue_call(None, inner)
+      self.ev.run()
+    eventloop.queue_call(None, outer)
+    self.ev.run()
+    calls = self.ev.get_stats()['calls']
+    self.assertEqual(calls['current']['count'], 2)
+    # The time outer() spent in the nested loop counts toward inner().
+    self.assertEqual(calls['current']['max_name'], 'inner')
+
+  def testReportStats(self):
+    self.assertEqual(eventloop.report_stats(), None)
+    reports = []
+    eventloop.set_stats_hook(reports.append)
+    eventloop.enable_stats()
+    try:
+      eventloop.queue_call(None, lambda: None)
+      eventloop.run()
+      stats = eventloop.report_stats()
+      self.assertEqual(reports, [stats])
+      self.assertEqual(stats['calls']['current']['count'], 1)
+      self.assertEqual(eventloop.get_stats()['calls'], {})  # Reset.
+      eventloop._log_stats(stats)  # The default hook.
+      # Event loops for new requests collect stats too.
+      del os.environ[eventloop._EVENT_LOOP_KEY]
+      self.assertNotEqual(eventloop.get_event_loop().stats, None)
+      def bad_hook(unused_stats):
+        raise ZeroDivisionError
+      eventloop.set_stats_hook(bad_hook)
+      self.ExpectErrors()
+      self.assertNotEqual(eventloop.report_stats(), None)
+    finally:
+      eventloop.enable_stats(False)
+      eventloop.set_stats_hook(None)
+    self.assertEqual(eventloop.get_event_loop().stats, None)
+
+  def testSetEventLoopClass(self):
+    self.assertRaises(TypeError, eventloop.set_event_loop_class, object)
+    self.assertRaises(TypeError, eventloop.set_event_loop_class,
+                      eventloop.EventLoop())
+    class MyEventLoop(self.event_loop_class):
+      pass
+    eventloop.queue_call(None, lambda: None)
+    self.assertRaises(RuntimeError,
+                      eventloop.set_event_loop_class, MyEventLoop)
+    self.assertTrue(eventloop.get_event_loop() is self.ev)
+    eventloop.run()
+    eventloop.set_event_loop_class(MyEventLoop)
+    ev = eventloop.get_event_loop()
+    self.assertEqual(ev.__class__, MyEventLoop)
+    # Setting the same class again keeps the loop.
+    eventloop.set_event_loop_class(MyEventLoop)
+    self.assertTrue(eventloop.get_event_loop() is ev)
+    # So does a new request.
+    del os.environ[eventloop._EVENT_LOOP_KEY]
+    self.assertEqual(eventloop.get_event_loop().__class__, MyEventLoop)
+
+
+class SelectEventLoopTests(EventLoopTests):
+
+  event_loop_class = eventloop.SelectEventLoop
+
+  def setUp(self):
+    super(SelectEventLoopTests, self).setUp()
+    self.fds = []
+
+  def tearDown(self):
+    super(SelectEventLoopTests, self).tearDown()
+    for fd in self.fds:
+      os.close(fd)
+
+  def MakePipe(self):
+    rfd, wfd = os.pipe()
+    self.fds += [rfd, wfd]
+    return rfd, wfd
+
+  def testReader(self):
+    rfd, wfd = self.MakePipe()
+    record = []
+    def reader(arg):
+      data = os.read(rfd, 100)
+      record.append((arg, data))
+      if data == 'b':
+        self.ev.remove_reader(rfd)
+      else:
+        eventloop.queue_call(0.01, os.write, wfd, 'b')
+    self.ev.add_reader(rfd, reader, arg=42)
+    eventloop.queue_call(0.01, os.write, wfd, 'a')
+    eventloop.run()  # Returns only when the reader is removed.
+    self.assertEqual(record, [(42, 'a'), (42, 'b')])
+    self.assertFalse(self.ev.remove_reader(rfd))
+    self.assertEqual(self.ev.readers, {})
+
+  def testWriter(self):
+    rfd, wfd = self.MakePipe()
+    record = []
+    def writer():
+      os.write(wfd, 'x')
+      self.ev.remove_writer(wfd)
+    def reader():
+      record.append(os.read(rfd, 100))
+      self.ev.remove_reader(rfd)
+    self.ev.add_reader(rfd, reader)
+    self.ev.add_writer(wfd, writer)
+    eventloop.run()
+    self.assertEqual(record, ['x'])
+    self.assertFalse(self.ev.remove_writer(wfd))
+
+  def testReaderDoesNotDelayTimers(self):
+    rfd, wfd = self.MakePipe()
+    record = []
+    def reader():
+      record.append(os.read(rfd, 100))
+      self.ev.remove_reader(rfd)
+    self.ev.add_reader(rfd, reader)
+    eventloop.queue_call(0.01, record.append, 1)
+    eventloop.queue_call(0.02, os.write, wfd, 'x')
+    eventloop.run()
+    self.assertEqual(record, [1, 'x'])
+
+  def testRpcWithFileno(self):
+    rfd, wfd = self.MakePipe()
+    class FakeRpc(object):
+      state = apiproxy_rpc.RPC.RUNNING
+      def fileno(self):
+        return rfd
+    rpc = FakeRpc()
+    record = []
+    eventloop.queue_rpc(rpc, record.append, 'done')
+    self.assertEqual(self.ev.rpcs, {})
+    self.assertTrue(rfd in self.ev.readers)
+    eventloop.queue_call(0.01, os.write, wfd, 'x')
+    eventloop.run()
+    self.assertEqual(record, ['done'])
+    self.assertEqual(self.ev.readers, {})
+
+  def testStatsFd(self):
+    rfd, wfd = self.MakePipe()
+    self.ev.enable_stats()
+    def reader():
+      os.read(rfd, 100)
+      self.ev.remove_reader(rfd)
+    self.ev.add_reader(rfd, reader)
+    eventloop.queue_call(0.01, os.write, wfd, 'x')
+    eventloop.run()
+    stats = self.ev.get_stats()
+    self.assertEqual(stats['calls']['fd']['count'], 1)
+    self.assertEqual(stats['calls']['fd']['max_name'], 'reader')
+    self.assertTrue(stats['waits']['fd']['count'] >= 1)
+
+  def testClearRemovesFileDescriptors(self):
+    rfd, wfd = self.MakePipe()
+    self.ev.add_reader(rfd, lambda: None)
+    self.ev.add_writer(wfd, lambda: None)
+    self.ev.clear()
+    self.assertEqual(self.ev.readers, {})
+    self.assertEqual(self.ev.writers, {})
+    self.assertEqual(self.ev.run0(), None)
+
+
+class SelectFallbackEventLoop(eventloop.SelectEventLoop):
+  _use_epoll = False
+
+
+class SelectFallbackEventLoopTests(SelectEventLoopTests):
+
+  event_loop_class = SelectFallbackEventLoop
+
 if __name__ == '__main__':
   unittest.main()
 
@@ -51,6 +51,10 @@ exceptions indicated in the list below:
 
 - FloatProperty: a double precision floating point number
 
+- IntegerArrayProperty, FloatArrayProperty: like a repeated
+  IntegerProperty or FloatProperty (and stored the same way), but the
+  value is an array.array, which is validated and serialized in bulk
+
 - BooleanProperty: a bool value
 
 - DateTimeProperty: a datetime object.  Note: App Engine always uses
@@ -280,11 +284,13 @@ Property subclass is in the docstring for the Property class.
 
 __author__ = 'guido@google.com (Guido van Rossum)'
 
+import array
 import collections
 import copy
 import cPickle as pickle
 import datetime
 import logging
+import sys
 import zlib
 
 from .google_imports import datastore
@@ -309,6 +315,7 @@ __all__ = ['Key', 'BlobKey', 'GeoPt', 'Rollback',
            'transactional', 'transactional_async', 'transactional_tasklet',
            'non_transactional',
            'get_multi', 'get_multi_async',
+           'get_multi_stream', 'get_multi_stream_async',
            'put_multi', 'put_multi_async',
            'delete_multi', 'delete_multi_async',
            'get_indexes', 'get_indexes_async',
@@ -652,14 +659,14 @@ class ModelAdapter(datastore_rpc.AbstractAdapter):
   def key_to_pb(self, key):
     return key.reference()
 
-  def pb_to_entity(self, pb):
+  def pb_to_entity(self, pb, lazy=None):
     key = None
     kind = None
     if pb.key().path().element_size():
       key = Key(reference=pb.key())
       kind = key.kind()
     modelclass = Model._lookup_model(kind, self.default_model)
-    entity = modelclass._from_pb(pb, key=key, set_key=False)
+    entity = modelclass._from_pb(pb, key=key, set_key=False, lazy=lazy)
     if self.want_pbs:
       entity._orig_pb = pb
     return entity
@@ -766,7 +773,10 @@ class Property(ModelAttribute):
 
   To store a user value, just call _store_value().  To store a
   base value, wrap the value in a _BaseValue() and then
-  call _store_value().
+  call _store_value().  (For a Property class whose only
+  conversion methods are the built-in type checks listed in
+  _TYPE_CHECK_METHODS, the base value is also the user value, so
+  _deserialize() stores it without a wrapper.)
 
   A Property subclass that wants to implement a specific
   transformation between user values and serialiazble values should
@@ -1087,6 +1097,8 @@ class Property(ModelAttribute):
     This assumes validation has already taken place.  For a repeated
     Property the value should be a list.
     """
+    if entity._lazy_pbs is not None:
+      entity._drop_lazy(self._name)
     entity._values[self._name] = value
 
   def _set_value(self, entity, value):
@@ -1110,6 +1122,8 @@ class Property(ModelAttribute):
 
   def _has_value(self, entity, unused_rest=None):
     """Internal helper to ask if the entity has a value for this Property."""
+    if entity._lazy_pbs is not None:
+      entity._decode_lazy(self._name)
     return self._name in entity._values
 
   def _retrieve_value(self, entity, default=None):
@@ -1119,6 +1133,8 @@ class Property(ModelAttribute):
     given.  For a repeated Property this returns a list if a value is
     set, otherwise None.  No additional transformations are applied.
     """
+    if entity._lazy_pbs is not None:
+      entity._decode_lazy(self._name)
     return entity._values.get(self._name, default)
 
   def _get_user_value(self, entity):
@@ -1282,6 +1298,32 @@ class Property(ModelAttribute):
     cache[names] = methods
     return methods
 
+  @classmethod
+  def _stores_raw_base_values(cls):
+    """Return whether _deserialize() may store base values unwrapped.
+
+    This is true when every _validate(), _to_base_type() and
+    _from_base_type() method of the class is one of the built-in type
+    checks in _TYPE_CHECK_METHODS, which accept any value that the
+    class's _db_get_value() returns.  Such a value then needs no
+    conversion on access, and it is re-serialized unchanged.  For any
+    other class (e.g. KeyProperty, whose _validate() checks the kind,
+    or a subclass adding its own methods) deserialized values are
+    wrapped, so they are never passed through _call_to_base_type().
+    The outcome is cached per class.
+    """
+    flag = cls.__dict__.get('_raw_base_values_cache')
+    if flag is None:
+      methods = cls._find_methods('_validate', '_to_base_type',
+                                  '_from_base_type')
+      flag = True
+      for method in methods:
+        if method not in _TYPE_CHECK_METHODS:
+          flag = False
+          break
+      cls._raw_base_values_cache = flag
+    return flag
+
   def _apply_list(self, methods):
     """Return a single callable that applies a list of methods to a value.
 
@@ -1340,6 +1382,8 @@ class Property(ModelAttribute):
     not be serialized but requesting their value will return None (or
     an empty list in the case of a repeated Property).
     """
+    if entity._lazy_pbs is not None:
+      entity._drop_lazy(self._name)
     if self._name in entity._values:
       del entity._values[self._name]
 
@@ -1419,7 +1463,7 @@ class Property(ModelAttribute):
     """
     v = p.value()
     val = self._db_get_value(v, p)
-    if val is not None:
+    if val is not None and not self._stores_raw_base_values():
       val = _BaseValue(val)
     if self._repeated:
       if self._has_value(entity):
@@ -1592,6 +1636,120 @@ class FloatProperty(Property):
     return v.doublevalue()
 
 
+class _ArrayPropertyMixin(Property):
+  """Mixin for repeated numeric properties whose value is an array.array.
+
+  Subclasses combine this with a scalar Property class and set
+  _typecode and _value_setter (the name of the PropertyValue method
+  that sets a value of that type).  Each element is stored as a
+  separate protobuf property, exactly like the elements of a repeated
+  scalar property, so the data can be queried and read as such.
+  None elements are not supported.
+  """
+
+  _repeated = True
+  _typecode = None
+  _value_setter = None
+
+  @utils.positional(1 + Property._positional)
+  def __init__(self, name=None, **kwds):
+    if not kwds.pop('repeated', True):
+      raise ValueError('%s is always repeated' % self.__class__.__name__)
+    super(_ArrayPropertyMixin, self).__init__(name=name, **kwds)
+
+  def _make_array(self, value):
+    """Internal helper to validate values and return them as a new array.
+
+    The array constructor checks the types of all values at once; the
+    per-value validation is only needed for a custom validator, choices
+    or a _validate() method added by a subclass.
+    """
+    if not isinstance(value, (list, tuple, set, frozenset, array.array)):
+      raise datastore_errors.BadValueError(
+        'Expected list, tuple or array, got %r' % (value,))
+    if (self._validator is not None or self._choices is not None or
+        len(self._find_methods('_validate', '_to_base_type')) > 1):
+      value = [self._do_validate(val) for val in value]
+    elif isinstance(value, array.array) and value.typecode == self._typecode:
+      return value[:]
+    try:
+      return array.array(self._typecode, value)
+    except (TypeError, OverflowError), err:
+      raise datastore_errors.BadValueError('Bad value for %s %s: %s' %
+                                           (self.__class__.__name__,
+                                            self._name, err))
+
+  def _set_value(self, entity, value):
+    if entity._projection:
+      raise ReadonlyPropertyError(
+        'You cannot set property values of a projection entity')
+    self._store_value(entity, self._make_array(value))
+
+  def _get_user_value(self, entity):
+    value = self._retrieve_value(entity)
+    if not isinstance(value, array.array):
+      if value is None:
+        value = array.array(self._typecode)
+      else:
+        # A list stored by code that doesn't know about arrays.
+        value = self._make_array([val.b_val if isinstance(val, _BaseValue)
+                                  else val for val in value])
+      self._store_value(entity, value)
+    return value
+
+  def _get_base_value(self, entity):
+    return [_BaseValue(val) for val in self._get_user_value(entity)]
+
+  def _get_base_value_unwrapped_as_list(self, entity):
+    return list(self._get_user_value(entity))
+
+  def _serialize(self, entity, pb, prefix='', parent_repeated=False,
+                 projection=None):
+    if projection:
+      super(_ArrayPropertyMixin, self)._serialize(
+        entity, pb, prefix, parent_repeated, projection)
+      return
+    if self._indexed:
+      add_property = pb.add_property
+    else:
+      add_property = pb.add_raw_property
+    set_value = getattr(entity_pb.PropertyValue, self._value_setter)
+    name = prefix + self._name
+    for val in self._get_user_value(entity):
+      p = add_property()
+      p.set_name(name)
+      p.set_multiple(True)
+      set_value(p.mutable_value(), val)
+
+  def _deserialize(self, entity, p, unused_depth=1):
+    val = self._db_get_value(p.value(), p)
+    if val is None:
+      return
+    value = self._retrieve_value(entity)
+    if value is None:
+      value = array.array(self._typecode)
+      self._store_value(entity, value)
+    value.append(val)
+
+
+class IntegerArrayProperty(_ArrayPropertyMixin, IntegerProperty):
+  """A repeated integer Property whose value is an array.array('l').
+
+  Note: this limits the values to the size of a C long, which is 64
+  bits on App Engine but may be 32 bits elsewhere.
+  """
+
+  _typecode = 'l'
+  _value_setter = 'set_int64value'
+
+
+class FloatArrayProperty(_ArrayPropertyMixin, FloatProperty):
+  """A repeated float Property whose value is an array.array('d')."""
+
+  _typecode = 'd'
+  _value_setter = 'set_doublevalue'
+
+
 # A custom 'meaning' for compressed properties.
 _MEANING_URI_COMPRESSED = 'ZLIB'
 
@@ -2144,6 +2302,18 @@ class TimeProperty(DateTimeProperty):
     return datetime.datetime.utcnow().time()
 
 
+# The built-in _validate() methods that only check the type of a value
+# (and for IntegerProperty and FloatProperty, coerce it to that type).
+# Each of them accepts whatever its class's _db_get_value() returns, so
+# Property._deserialize() stores the values of a class that has no other
+# conversion methods without a _BaseValue wrapper.
+_TYPE_CHECK_METHODS = frozenset(
+    cls.__dict__['_validate']
+    for cls in (BooleanProperty, IntegerProperty, FloatProperty,
+                GeoPtProperty, UserProperty, BlobKeyProperty,
+                DateTimeProperty))
+
+
 class _StructuredGetForDictMixin(Property):
   """Mixin class so *StructuredProperty can share _get_for_dict().
 
@@ -2762,13 +2932,277 @@ class ComputedProperty(GenericProperty):
     self._get_value(entity)  # For its side effects.
 
 
+# The Property methods that _ModelCodec inlines.  A property whose class
+# overrides any of these is handled by calling its _serialize() or
+# _deserialize() method instead.
+_INLINED_ENCODE_METHODS = ('_serialize', '_get_base_value_unwrapped_as_list',
+                           '_get_base_value', '_apply_to_values',
+                           '_retrieve_value', '_store_value',
+                           '_opt_call_to_base_type', '_call_to_base_type')
+_INLINED_DECODE_METHODS = ('_deserialize', '_has_value', '_retrieve_value',
+                           '_store_value')
+
+
+def _can_inline(prop, names):
+  """Return whether the class of prop inherits the named Property methods."""
+  cls = prop.__class__
+  for name in names:
+    if getattr(cls, name).im_func is not getattr(Property, name).im_func:
+      return False
+  return True
+
+
+class _ModelCodec(object):
+  """Precomputed plan for serializing the entities of a Model class.
+
+  Model._to_pb() and Model._from_pb() use this instead of sorting the
+  properties and splitting protobuf property names for every entity.
+  It has an encoder for each property, in the sorted order that
+  _to_pb() uses, and a decoder for each property name.  For a property
+  whose class doesn't override the methods involved, these inline what
+  Property._serialize() and Property._deserialize() do, using the
+  property's _to_base_type() pipeline computed up front; other
+  properties are serialized by their own methods.  The protobufs are
+  the same either way.
+
+  A codec is created by Model._fix_up_properties(); it only applies to
+  entities that share the class's _properties (i.e. not to Expando
+  entities with dynamic properties).  If properties are added to or
+  deleted from the class's _properties afterwards, the codec is no
+  longer used until _fix_up_properties() is called again.
+  """
+
+  __slots__ = ('properties', 'size', 'encoders', 'decoders')
+
+  def __init__(self, properties):
+    self.properties = properties
+    self.size = len(properties)
+    self.encoders = [_make_encoder(prop)
+                     for _, prop in sorted(properties.iteritems())]
+    self.decoders = dict((name, _make_decoder(prop))
+                         for name, prop in properties.iteritems())
+
+  def matches(self, properties):
+    """Return whether this codec was built for the given properties."""
+    return properties is self.properties and len(properties) == self.size
+
+
+def _make_encoder(prop):
+  """Return a function(entity, pb) that serializes prop; see _ModelCodec."""
+  if not _can_inline(prop, _INLINED_ENCODE_METHODS):
+    serialize = prop._serialize
+    def encode(entity, pb):
+      serialize(entity, pb, projection=entity._projection)
+    return encode
+
+  name = prop._name
+  default = prop._default
+  if prop._indexed:
+    add_property = entity_pb.EntityProto.add_property
+  else:
+    add_property = entity_pb.EntityProto.add_raw_property
+  db_set_value = prop._db_set_value
+  to_base_type = prop._apply_list(prop._find_methods('_validate',
+                                                     '_to_base_type'))
+
+  if prop._repeated:
+    def encode(entity, pb):
+      values = entity._values
+      value = values.get(name, default)
+      if value is None:
+        values[name] = []
+        return
+      value[:] = [val if isinstance(val, _BaseValue)
+                  else _BaseValue(to_base_type(val))
+                  for val in value]
+      for val in value:
+        p = add_property(pb)
+        p.set_name(name)
+        p.set_multiple(True)
+        db_set_value(p.mutable_value(), p, val.b_val)
+    return encode
+
+  def encode(entity, pb):
+    values = entity._values
+    value = values.get(name, default)
+    if value is not None and not isinstance(value, _BaseValue):
+      value = _BaseValue(to_base_type(value))
+      values[name] = value
+    p = add_property(pb)
+    p.set_name(name)
+    p.set_multiple(False)
+    v = p.mutable_value()
+    if value is not None:
+      db_set_value(v, p, value.b_val)
+  return encode
+
+
+def _make_decoder(prop):
+  """Return a function(entity, p) that deserializes p; see _ModelCodec."""
+  if not _can_inline(prop, _INLINED_DECODE_METHODS):
+    return prop._deserialize
+
+  name = prop._name
+  db_get_value = prop._db_get_value
+  wrap = not prop._stores_raw_base_values()
+
+  if prop._repeated:
+    def decode(entity, p):
+      val = db_get_value(p.value(), p)
+      if val is not None and wrap:
+        val = _BaseValue(val)
+      values = entity._values
+      if name in values:
+        value = values[name]
+        assert isinstance(value, list), repr(value)
+        value.append(val)
+      else:
+        values[name] = [val]
+    return decode
+
+  def decode(entity, p):
+    val = db_get_value(p.value(), p)
+    if val is not None and wrap:
+      val = _BaseValue(val)
+    entity._values[name] = val
+  return decode
+
+
+# Marks a slot of _CompactValues that has no value.
+_NO_VALUE = object()
+
+
+class _CompactValues(list):
+  """Value storage for an entity of a model class using compact storage.
+
+  This replaces the _values dict of such entities (see _compact_storage
+  in the Model class).  The values are kept in a list, at the position
+  that the class's _value_layout assigns to the property name; names
+  not in the layout (e.g. those of fake properties created for unknown
+  protobuf properties) go into a dict that is only created when needed.
+
+  Since code everywhere accesses ent._values as a dict mapping property
+  names to values, this class supports the dict operations used on it;
+  its list operations are only meant for internal use.
+  """
+
+  __slots__ = ('_layout', '_extra')
+
+  def __init__(self, layout):
+    list.__init__(self, [_NO_VALUE] * len(layout))
+    self._layout = layout
+    self._extra = None
+
+  def get(self, name, default=None):
+    index = self._layout.get(name)
+    if index is None:
+      if self._extra is None:
+        return default
+      return self._extra.get(name, default)
+    value = list.__getitem__(self, index)
+    if value is _NO_VALUE:
+      return default
+    return value
+
+  def __getitem__(self, name):
+    value = self.get(name, _NO_VALUE)
+    if value is _NO_VALUE:
+      raise KeyError(name)
+    return value
+
+  def __setitem__(self, name, value):
+    index = self._layout.get(name)
+    if index is not None:
+      list.__setitem__(self, index, value)
+    elif self._extra is None:
+      self._extra = {name: value}
+    else:
+      self._extra[name] = value
+
+  def __delitem__(self, name):
+    index = self._layout.get(name)
+    if index is None:
+      if self._extra is None:
+        raise KeyError(name)
+      del self._extra[name]
+    elif list.__getitem__(self, index) is _NO_VALUE:
+      raise KeyError(name)
+    else:
+      list.__setitem__(self, index, _NO_VALUE)
+
+  def __contains__(self, name):
+    return self.get(name, _NO_VALUE) is not _NO_VALUE
+
+  has_key = __contains__
+
+  def iteritems(self):
+    for name, index in self._layout.iteritems():
+      value = list.__getitem__(self, index)
+      if value is not _NO_VALUE:
+        yield name, value
+    if self._extra is not None:
+      for item in self._extra.iteritems():
+        yield item
+
+  def iterkeys(self):
+    for name, _ in self.iteritems():
+      yield name
+
+  __iter__ = iterkeys
+
+  def itervalues(self):
+    for _, value in self.iteritems():
+      yield value
+
+  def items(self):
+    return list(self.iteritems())
+
+  def keys(self):
+    return list(self.iterkeys())
+
+  def values(self):
+    return list(self.itervalues())
+
+  def __len__(self):
+    count = 0
+    for value in list.__iter__(self):
+      if value is not _NO_VALUE:
+        count += 1
+    if self._extra is not None:
+      count += len(self._extra)
+    return count
+
+  def __eq__(self, other):
+    if isinstance(other, _CompactValues):
+      other = dict(other.iteritems())
+    elif not isinstance(other, dict):
+      return NotImplemented
+    return dict(self.iteritems()) == other
+
+  def __ne__(self, other):
+    eq = self.__eq__(other)
+    if eq is NotImplemented:
+      return NotImplemented
+    return not eq
+
+  def __repr__(self):
+    return repr(dict(self.iteritems()))
+
+
 class MetaModel(type):
   """Metaclass for Model.
 
   This exists to fix up the properties -- they need to know their name.
   This is accomplished by calling the class's _fix_properties() method.
+  It also gives a class that sets _compact_storage its __slots__.
   """
 
+  def __new__(mcs, name, bases, classdict):
+    if (classdict.get('_compact_storage') and '__slots__' not in classdict and
+        not [base for base in bases if getattr(base, '_compact_storage', 0)]):
+      classdict['__slots__'] = ('_values', '_entity_key', '_lazy_pbs')
+    return super(MetaModel, mcs).__new__(mcs, name, bases, classdict)
+
   def __init__(cls, name, bases, classdict):
     super(MetaModel, cls).__init__(name, bases, classdict)
     cls._fix_up_properties()
@@ -2812,11 +3246,23 @@ class Model(_NotEqualMixin):
   # Class variables updated by _fix_up_properties()
   _properties = None
   _has_repeated = False
+  _codec = None  # A _ModelCodec, or None.
   _kind_map = {}  # Dict mapping {kind: Model subclass}
 
+  # Set this to True in a subclass to decode property values from
+  # protobufs on first access rather than in _from_pb().
+  _lazy_decode = False
+
+  # Set this to True in a subclass (not an Expando subclass) to store
+  # its entities' values in a list laid out by _value_layout rather
+  # than in a dict, and to give it __slots__; see _CompactValues.
+  _compact_storage = False
+  _value_layout = None  # Dict mapping {name: index}, or None.
+
   # Defaults for instance variables.
   _entity_key = None
   _values = None
+  _lazy_pbs = None  # Dict mapping {name: [(p, indexed), ...]}, or None.
   _projection = ()  # Tuple of names of projected properties.
 
   # Hardcoded pseudo-property for the key.
@@ -2850,6 +3296,11 @@ class Model(_NotEqualMixin):
     # self is passed implicitly through args so users can define a property
     # named 'self'.
     (self,) = args
+    layout = self._value_layout
+    if layout is not None:
+      # These are slots, which have no class defaults.
+      self._entity_key = None
+      self._lazy_pbs = None
     get_arg = self.__get_arg
     key = get_arg(kwds, 'key')
     id = get_arg(kwds, 'id')
@@ -2868,7 +3319,10 @@ class Model(_NotEqualMixin):
           app is not None or namespace is not None):
       self._key = Key(self._get_kind(), id,
                       parent=parent, app=app, namespace=namespace)
-    self._values = {}
+    if layout is None:
+      self._values = {}
+    else:
+      self._values = _CompactValues(layout)
     self._set_attributes(kwds)
     # Set the projection last, otherwise it will prevent _set_attributes().
     if projection:
@@ -3088,11 +3542,43 @@ class Model(_NotEqualMixin):
       # TODO: Move the key stuff into ModelAdapter.entity_to_pb()?
       self._key_to_pb(pb)
 
-    for unused_name, prop in sorted(self._properties.iteritems()):
-      prop._serialize(self, pb, projection=self._projection)
+    codec = self._codec
+    if self._lazy_pbs is not None:
+      self._lazy_to_pb(pb)
+    elif (codec is not None and not self._projection and
+          codec.matches(self._properties)):
+      for encode in codec.encoders:
+        encode(self, pb)
+    else:
+      for unused_name, prop in sorted(self._properties.iteritems()):
+        prop._serialize(self, pb, projection=self._projection)
 
     return pb
 
+  def _lazy_to_pb(self, pb):
+    """Internal helper for _to_pb() for an entity with undecoded values.
+
+    The original protobuf properties of a property that hasn't been
+    accessed are copied rather than decoded and encoded again, unless
+    the property's definition no longer matches them.
+    """
+    lazy_pbs = self._lazy_pbs
+    for name, prop in sorted(self._properties.iteritems()):
+      entries = lazy_pbs.get(name)
+      if entries is not None:
+        for p, indexed in entries:
+          if (indexed != prop._indexed or p.name() != name or
+              p.multiple() != prop._repeated):
+            break
+        else:
+          for p, indexed in entries:
+            if indexed:
+              pb.add_property().CopyFrom(p)
+            else:
+              pb.add_raw_property().CopyFrom(p)
+          continue
+      prop._serialize(self, pb, projection=self._projection)
+
   def _key_to_pb(self, pb):
     """Internal helper to copy the key into a protobuf."""
     key = self._key
@@ -3111,12 +3597,21 @@ class Model(_NotEqualMixin):
         group.add_element().CopyFrom(elem)
 
   @classmethod
-  def _from_pb(cls, pb, set_key=True, ent=None, key=None):
-    """Internal helper to create an entity from an EntityProto protobuf."""
+  def _from_pb(cls, pb, set_key=True, ent=None, key=None, lazy=None):
+    """Internal helper to create an entity from an EntityProto protobuf.
+
+    If lazy is true (it defaults to the class's _lazy_decode), the
+    values of the class's properties are decoded when they are first
+    accessed, and re-serializing the entity reuses the protobuf
+    properties of values that haven't been accessed.  Other properties
+    (and all properties of a projection) are decoded right away.
+    """
     if not isinstance(pb, entity_pb.EntityProto):
       raise TypeError('pb must be a EntityProto; received %r' % pb)
     if ent is None:
       ent = cls()
+    if lazy is None:
+      lazy = cls._lazy_decode
 
     # A key passed in overrides a key in the pb.
     if key is None and pb.key().path().element_size():
@@ -3128,16 +3623,76 @@ class Model(_NotEqualMixin):
     indexed_properties = pb.property_list()
     unindexed_properties = pb.raw_property_list()
     projection = []
+    codec = cls._codec
+    if codec is not None and codec.matches(ent._properties):
+      decoders = codec.decoders
+      properties = codec.properties
+    else:
+      codec = None
+    lazy_pbs = None
+    if lazy:
+      lazy_pbs = {}
+      class_properties = cls._properties
     for plist in [indexed_properties, unindexed_properties]:
       for p in plist:
         if p.meaning() == entity_pb.Property.INDEX_VALUE:
           projection.append(p.name())
+        if lazy_pbs is not None:
+          name = p.name()
+          if '.' in name:
+            name = name.split('.', 1)[0]
+          if name in class_properties:
+            entry = (p, plist is indexed_properties)
+            if name in lazy_pbs:
+              lazy_pbs[name].append(entry)
+            else:
+              lazy_pbs[name] = [entry]
+            continue
+        # Names of structured subproperties contain a period, so they
+        # aren't in the codec; neither are the names of dynamic properties.
+        if codec is not None and ent._properties is properties:
+          decode = decoders.get(p.name())
+          if decode is not None:
+            decode(ent, p)
+            continue
         prop = ent._get_property_for(p, plist is indexed_properties)
         prop._deserialize(ent, p)
 
+    if lazy_pbs:
+      ent._lazy_pbs = lazy_pbs
+      if projection:
+        ent._decode_lazy()
     ent._set_projection(projection)
     return ent
 
+  def _decode_lazy(self, name=None):
+    """Internal helper to decode values that _from_pb() left undecoded.
+
+    Args:
+      name: Optional property name; by default all values are decoded.
+    """
+    lazy_pbs = self._lazy_pbs
+    if name is None:
+      self._lazy_pbs = None
+      for entries in lazy_pbs.itervalues():
+        for p, indexed in entries:
+          self._get_property_for(p, indexed)._deserialize(self, p)
+      return
+    entries = lazy_pbs.pop(name, None)
+    if entries is None:
+      return
+    if not lazy_pbs:
+      self._lazy_pbs = None
+    for p, indexed in entries:
+      self._get_property_for(p, indexed)._deserialize(self, p)
+
+  def _drop_lazy(self, name):
+    """Internal helper to forget an undecoded value that is being replaced."""
+    lazy_pbs = self._lazy_pbs
+    lazy_pbs.pop(name, None)
+    if not lazy_pbs:
+      self._lazy_pbs = None
+
   def _set_projection(self, projection):
     by_prefix = {}
     for propname in projection:
@@ -3147,7 +3702,9 @@ class Model(_NotEqualMixin):
           by_prefix[head].append(tail)
         else:
           by_prefix[head] = [tail]
-    self._projection = tuple(projection)
+    projection = tuple(projection)
+    if projection != self._projection:  # Don't store the default.
+      self._projection = projection
     for propname, proj in by_prefix.iteritems():
       prop = self._properties.get(propname)
       subval = prop._get_base_value_unwrapped_as_list(self)
@@ -3244,8 +3801,12 @@ class Model(_NotEqualMixin):
                         'a Unicode string (%r); please encode using utf-8' %
                         (cls.__name__, kind))
     cls._properties = {}  # Map of {name: Property}
+    cls._codec = None
     if cls.__module__ == __name__:  # Skip the classes in *this* file.
       return
+    if cls._compact_storage and issubclass(cls, Expando):
+      raise TypeError('Expando subclass %s cannot use compact storage' %
+                      cls.__name__)
     for name in set(dir(cls)):
       attr = getattr(cls, name, None)
       if isinstance(attr, ModelAttribute) and not isinstance(attr, ModelKey):
@@ -3260,6 +3821,10 @@ class Model(_NotEqualMixin):
                attr._modelclass._has_repeated)):
             cls._has_repeated = True
           cls._properties[attr._name] = attr
+    cls._codec = _ModelCodec(cls._properties)
+    if cls._compact_storage:
+      cls._value_layout = dict((name, index) for index, name
+                               in enumerate(sorted(cls._properties)))
     cls._update_kind_map()
 
   @classmethod
@@ -3848,6 +4413,92 @@ def get_multi(keys, **ctx_options):
           for future in get_multi_async(keys, **ctx_options)]
 
 
+def get_multi_stream_async(keys, ordered=False, buffer_size=1000,
+                           **ctx_options):
+  """Fetches a sequence of keys, delivering results as they arrive.
+
+  Args:
+    keys: A sequence of keys.
+    ordered: If True, results are delivered in the order of keys;
+      otherwise in the order in which they complete.
+    buffer_size: At most this many keys are being fetched or waiting to
+      be delivered at any time (plus one while the consumer is waiting
+      in getq()); more keys are only fetched as the consumer catches up.
+    **ctx_options: Context options.
+
+  Returns:
+    A QueueFuture (a SerialQueueFuture if ordered is True) whose getq()
+    results are (key, entity) tuples, where entity is a Model instance
+    or None if the key wasn't found.  Cancelling it stops fetching keys.
+  """
+  from . import tasklets
+  if buffer_size <= 0:
+    raise ValueError('buffer_size must be positive; received %r' %
+                     buffer_size)
+  if ordered:
+    queue = tasklets.SerialQueueFuture(maxsize=buffer_size)
+  else:
+    queue = tasklets.QueueFuture(maxsize=buffer_size)
+
+  @tasklets.tasklet
+  def producer():
+    try:
+      for key in keys:
+        if queue.cancelled():
+          return
+        pair = tasklets.Future()
+        fut = key.get_async(**ctx_options)
+        fut.add_immediate_callback(_transfer_key_and_result, key, fut, pair)
+        room = queue.putq(pair)
+        if not room.done():
+          yield room  # The buffer is full; see QueueFuture.
+      queue.complete()
+    except Exception, err:
+      if not queue.done():
+        queue.set_exception(err, sys.exc_info()[2])
+
+  producer()
+  return queue
+
+
+def _transfer_key_and_result(key, fut, pair):
+  """Helper for get_multi_stream_async() to pair a key with its result."""
+  exc = fut.get_exception()
+  if exc is not None:
+    pair.set_exception(exc, fut.get_traceback())
+  else:
+    pair.set_result((key, fut.get_result()))
+
+
+def get_multi_stream(keys, ordered=False, buffer_size=1000, **ctx_options):
+  """Fetches a sequence of keys, yielding results as they arrive.
+
+  Args:
+    keys: A sequence of keys.
+    ordered: If True, results are yielded in the order of keys;
+      otherwise in the order in which they complete.
+    buffer_size: At most this many keys are being fetched or waiting to
+      be yielded at any time (plus one while the iterator is waiting).
+    **ctx_options: Context options.
+
+  Returns:
+    An iterator over (key, entity) tuples, where entity is a Model
+    instance or None if the key wasn't found.
+  """
+  queue = get_multi_stream_async(keys, ordered=ordered,
+                                 buffer_size=buffer_size, **ctx_options)
+  return _iter_queue(queue)
+
+
+def _iter_queue(queue):
+  """Helper for get_multi_stream() to iterate over a QueueFuture."""
+  while True:
+    try:
+      yield queue.getq().get_result()
+    except EOFError:
+      break
+
+
 def put_multi_async(entities, **ctx_options):
   """Stores a sequence of Model instances.
 
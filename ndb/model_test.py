@@ -1,5 +1,6 @@
 """Tests for model.py."""
 
+import array
 import datetime
 import difflib
 import os
@@ -3413,6 +3414,86 @@ property <
     res = model.get_multi((key1, key2, key3))
     self.assertEqual(res, [ent1, ent2, ent3])
 
+  def testGetMultiStream(self):
+    model.Model._kind_map['Model'] = model.Model
+    ents = [model.Model(key=model.Key('Model', i)) for i in range(1, 6)]
+    keys = model.put_multi(ents)
+    keys.append(model.Key('Model', 42))
+    res = list(model.get_multi_stream(keys))
+    self.assertEqual(len(res), 6)
+    self.assertEqual(dict(res), dict(zip(keys, ents + [None])))
+    res = list(model.get_multi_stream(keys, ordered=True, buffer_size=2))
+    self.assertEqual(res, zip(keys, ents + [None]))
+    self.assertRaises(ValueError, model.get_multi_stream, keys,
+                      ordered=True, buffer_size=0)
+    self.assertRaises(ValueError, model.get_multi_stream, keys,
+                      buffer_size=0)
+
+  def testGetMultiStreamAsync(self):
+    model.Model._kind_map['Model'] = model.Model
+    ents = [model.Model(key=model.Key('Model', i)) for i in range(1, 4)]
+    keys = model.put_multi(ents)
+
+    @tasklets.tasklet
+    def foo(ordered):
+      queue = model.get_multi_stream_async(keys, ordered=ordered,
+                                           buffer_size=1)
+      res = []
+      while True:
+        try:
+          key, ent = yield queue.getq()
+        except EOFError:
+          break
+        res.append((key, ent))
+      raise tasklets.Return(res)
+
+    self.assertEqual(dict(foo(False).get_result()), dict(zip(keys, ents)))
+    self.assertEqual(foo(True).get_result(), zip(keys, ents))
+
+  def testGetMultiStreamBuffer(self):
+    started = []
+    class CountingKey(model.Key):
+      def get_async(self, **ctx_options):
+        started.append(self)
+        return super(CountingKey, self).get_async(**ctx_options)
+    keys = [CountingKey('Model', i) for i in range(1, 11)]
+    for ordered in False, True:
+      del started[:]
+      queue = model.get_multi_stream_async(keys, ordered=ordered,
+                                           buffer_size=3)
+      eventloop.run()
+      # A consumer that doesn't keep up holds back the fetches.
+      self.assertEqual(len(started), 3)
+      res = []
+      while True:
+        try:
+          res.append(queue.getq().get_result())
+        except EOFError:
+          break
+        self.assertTrue(len(started) - len(res) <= 4)
+      self.assertEqual(len(res), 10)
+      if ordered:
+        self.assertEqual(res, [(key, None) for key in keys])
+      self.assertEqual(started, keys)
+    # Cancelling the queue stops fetching.
+    del started[:]
+    queue = model.get_multi_stream_async(keys, buffer_size=3)
+    eventloop.run()
+    queue.cancel()
+    eventloop.run()
+    self.assertEqual(len(started), 3)
+
+  def testGetMultiStreamError(self):
+    class FailingKey(model.Key):
+      def get_async(self, **ctx_options):
+        fut = tasklets.Future()
+        fut.set_exception(ZeroDivisionError())
+        return fut
+    keys = [model.Key('Model', 1), FailingKey('Model', 2)]
+    for ordered in False, True:
+      it = model.get_multi_stream(keys, ordered=ordered)
+      self.assertRaises(ZeroDivisionError, list, it)
+
   def testPutMultiAsync(self):
     ent1 = model.Model(key=model.Key('Model', 1))
     ent2 = model.Model(key=model.Key('Model', 2))
@@ -4559,6 +4640,326 @@ property <
     self.assertTrue(isinstance(bar.bk, model.BlobKey))
     self.assertEqual(bar.bk, bk)
 
+  def testCodecMatchesGenericSerialization(self):
+    class Sub(model.Model):
+      x = model.IntegerProperty()
+    class Everything(model.Model):
+      s = model.StringProperty(default='dflt')
+      t = model.TextProperty(compressed=True)
+      i = model.IntegerProperty(indexed=False)
+      f = model.FloatProperty(repeated=True)
+      b = model.BooleanProperty()
+      d = model.DateTimeProperty()
+      g = model.GeoPtProperty()
+      u = model.UserProperty()
+      k = model.KeyProperty()
+      j = model.JsonProperty()
+      gen = model.GenericProperty(repeated=True)
+      sub = model.StructuredProperty(Sub)
+      subs = model.StructuredProperty(Sub, repeated=True)
+      local = model.LocalStructuredProperty(Sub, repeated=True)
+      comp = model.ComputedProperty(lambda ent: ent.i and ent.i * 2)
+      empty = model.StringProperty(repeated=True)
+    self.assertTrue(Everything._codec is not None)
+    def make():
+      return Everything(
+        id=42, t='text' * 10, i=7, f=[1.5, 2.5], b=False,
+        d=datetime.datetime(2012, 1, 2, 3, 4, 5), g=AMSTERDAM, u=TESTUSER,
+        k=model.Key('Foo', 1), j={'a': [1, 2]}, gen=[1, 'two'],
+        sub=Sub(x=1), subs=[Sub(x=2), Sub()], local=[Sub(x=3)])
+    for factory in make, Everything:
+      ent1 = factory()
+      ent2 = factory()
+      ent1._prepare_for_put()
+      ent2._prepare_for_put()
+      codec = Everything._codec
+      try:
+        Everything._codec = None
+        pb = ent1._to_pb()
+        decoded = Everything._from_pb(pb)
+      finally:
+        Everything._codec = codec
+      self.assertEqual(ent2._to_pb().Encode(), pb.Encode())
+      self.assertEqual(Everything._from_pb(pb), decoded)
+    # The codec's conversion to base values sticks, like the generic one.
+    ent = make()
+    ent._to_pb()
+    self.assertTrue(isinstance(ent._values['s'], model._BaseValue))
+    self.assertEqual(ent._values['empty'], [])
+    self.assertEqual(ent.f, [1.5, 2.5])
+
+  def testCodecIsNotUsedForChangedProperties(self):
+    class A(model.Model):
+      name = model.StringProperty()
+      extra = model.StringProperty()
+    pb = A(name='a', extra='b')._to_pb()
+    del A._properties['extra']
+    ent = A._from_pb(pb)
+    self.assertTrue(isinstance(ent._properties['extra'],
+                               model.GenericProperty))
+    A._fix_up_properties()
+    self.assertTrue(A._codec.matches(A._properties))
+    # Expando entities with dynamic properties use the generic code.
+    class E(model.Expando):
+      name = model.StringProperty()
+    ent = E(name='a', other=1)
+    self.assertFalse(E._codec.matches(ent._properties))
+    ent2 = E._from_pb(ent._to_pb())
+    self.assertEqual(ent2.other, 1)
+    self.assertEqual(ent2.name, 'a')
+
+  def testLazyDecode(self):
+    class Sub(model.Model):
+      x = model.IntegerProperty()
+    class Lazy(model.Model):
+      _lazy_decode = True
+      name = model.StringProperty()
+      tags = model.StringProperty(repeated=True)
+      text = model.TextProperty(compressed=True)
+      sub = model.StructuredProperty(Sub, repeated=True)
+      json = model.JsonProperty()
+    ent = Lazy(id=1, name='joe', tags=['a', 'b'], text='x' * 100,
+               sub=[Sub(x=1), Sub(x=2)], json={'a': 1})
+    pb = ent._to_pb()
+    lazy = Lazy._from_pb(pb)
+    self.assertEqual(sorted(lazy._lazy_pbs),
+                     ['json', 'name', 'sub', 'tags', 'text'])
+    self.assertEqual(lazy._values, {})
+    self.assertEqual(lazy.name, 'joe')
+    self.assertEqual(lazy.sub[1].x, 2)
+    self.assertEqual(sorted(lazy._lazy_pbs), ['json', 'tags', 'text'])
+    # Untouched values are copied; the result is the same either way.
+    self.assertEqual(lazy._to_pb().Encode(), pb.Encode())
+    self.assertEqual(Lazy._from_pb(pb)._to_pb().Encode(), pb.Encode())
+    # Assigning or deleting a value discards the undecoded one.
+    lazy.tags = ['c']
+    del lazy.text
+    self.assertEqual(sorted(lazy._lazy_pbs), ['json'])
+    self.assertEqual(lazy.tags, ['c'])
+    self.assertEqual(lazy.text, None)
+    self.assertEqual(lazy, Lazy(id=1, name='joe', tags=['c'],
+                                sub=[Sub(x=1), Sub(x=2)], json={'a': 1}))
+    self.assertEqual(lazy._lazy_pbs, None)
+    # Eager decoding can be requested, and lazy decoding can be forced.
+    self.assertEqual(Lazy._from_pb(pb, lazy=False)._lazy_pbs, None)
+    self.assertEqual(ent, Lazy._from_pb(pb))
+    ent2 = Sub._from_pb(Sub(x=5)._to_pb(), set_key=False, lazy=True)
+    self.assertEqual(ent2._lazy_pbs.keys(), ['x'])
+    self.assertEqual(repr(ent2), 'Sub(x=5)')
+
+  def testLazyDecodeAfterSchemaChange(self):
+    class Lazy(model.Model):
+      _lazy_decode = True
+      a = model.IntegerProperty()
+      b = model.IntegerProperty()
+    pb = Lazy(a=1, b=2)._to_pb()
+    # Make b unindexed and repeated; its stored value no longer fits.
+    class Lazy(model.Model):
+      _lazy_decode = True
+      a = model.IntegerProperty()
+      b = model.IntegerProperty(indexed=False, repeated=True)
+      c = model.IntegerProperty(default=3)
+    ent = Lazy._from_pb(pb)
+    self.assertEqual(sorted(ent._lazy_pbs), ['a', 'b'])
+    self.assertEqual(ent._to_pb().Encode(),
+                     Lazy._from_pb(pb, lazy=False)._to_pb().Encode())
+    self.assertEqual(ent.b, [2])
+    self.assertEqual(ent.c, 3)
+    # Projections are always decoded.
+    ent = Lazy(a=1, b=[2], projection=['a'])
+    ent = Lazy._from_pb(ent._to_pb())
+    self.assertEqual(ent._lazy_pbs, None)
+    self.assertEqual(ent._projection, ('a',))
+    self.assertEqual(ent.a, 1)
+
+  def testDeserializeSkipsBaseValueWrapper(self):
+    class Celsius(model.FloatProperty):
+      def _from_base_type(self, value):
+        return value - 273.0
+      def _to_base_type(self, value):
+        return value + 273.0
+    class Simple(model.Model):
+      i = model.IntegerProperty(repeated=True)
+      f = model.FloatProperty()
+      b = model.BooleanProperty()
+      k = model.KeyProperty()
+      s = model.StringProperty()
+      c = Celsius()
+    ent = Simple(i=[1, 2], f=1.5, b=True, k=model.Key('K', 1), s='abc',
+                 c=20.0)
+    pb = ent._to_pb()
+    for codec in Simple._codec, None:
+      save_codec = Simple._codec
+      try:
+        Simple._codec = codec
+        ent2 = Simple._from_pb(pb, set_key=False)
+      finally:
+        Simple._codec = save_codec
+      # Values that only need a built-in type check are not wrapped.
+      self.assertEqual(ent2._values['i'], [1, 2])
+      self.assertEqual(ent2._values['f'], 1.5)
+      self.assertEqual(ent2._values['b'], True)
+      self.assertEqual(ent2._values['k'], model._BaseValue(model.Key('K', 1)))
+      self.assertEqual(ent2._values['s'], model._BaseValue('abc'))
+      self.assertEqual(ent2._values['c'], model._BaseValue(293.0))
+      self.assertEqual(ent2, ent)
+      self.assertEqual(ent2._to_pb().Encode(), pb.Encode())
+
+  def testDeserializeKeepsValuesThatFailValidation(self):
+    # Legacy keys of another kind can be read and written back as is.
+    class Old(model.Model):
+      k = model.KeyProperty(repeated=True)
+    class New(model.Model):
+      k = model.KeyProperty(kind='X', repeated=True)
+      @classmethod
+      def _get_kind(cls):
+        return 'Old'
+    pb = Old(k=[model.Key('Y', 1), model.Key('X', 2)])._to_pb()
+    for codec in New._codec, None:
+      save_codec = New._codec
+      try:
+        New._codec = codec
+        ent = New._from_pb(pb, set_key=False)
+      finally:
+        New._codec = save_codec
+      self.assertEqual(ent._to_pb().Encode(), pb.Encode())
+      self.assertEqual(ent.k, [model.Key('Y', 1), model.Key('X', 2)])
+
+  def testDeserializeDoesNotConvertTwice(self):
+    class Doubled(model.IntegerProperty):
+      def _to_base_type(self, value):
+        return value * 2
+    class Simple(model.Model):
+      d = Doubled()
+    pb = Simple(d=21)._to_pb()
+    for codec in Simple._codec, None:
+      save_codec = Simple._codec
+      try:
+        Simple._codec = codec
+        ent = Simple._from_pb(pb, set_key=False)
+      finally:
+        Simple._codec = save_codec
+      self.assertEqual(ent._values['d'], model._BaseValue(42))
+      self.assertEqual(ent._to_pb().Encode(), pb.Encode())
+
+  def testCompactStorage(self):
+    class Sub(model.Model):
+      _compact_storage = True
+      x = model.IntegerProperty()
+    class Compact(model.Model):
+      _compact_storage = True
+      name = model.StringProperty('n')
+      tags = model.StringProperty(repeated=True)
+      sub = model.StructuredProperty(Sub)
+    class Plain(model.Model):
+      name = model.StringProperty('n')
+      tags = model.StringProperty(repeated=True)
+      sub = model.StructuredProperty(Sub)
+    self.assertEqual(Compact.__slots__,
+                     ('_values', '_entity_key', '_lazy_pbs'))
+    self.assertEqual(Compact._value_layout, {'n': 0, 'sub': 1, 'tags': 2})
+    self.assertEqual(Plain._value_layout, None)
+    ent = Compact(id=1, name='joe', sub=Sub(x=1))
+    self.assertTrue(isinstance(ent._values, model._CompactValues))
+    self.assertEqual(ent.key, model.Key('Compact', 1))
+    self.assertEqual(ent.name, 'joe')
+    self.assertEqual(ent.tags, [])
+    self.assertEqual(ent.sub.x, 1)
+    self.assertEqual(ent._values, {'n': 'joe', 'tags': [], 'sub': Sub(x=1)})
+    self.assertEqual(repr(ent),
+                     "Compact(key=Key('Compact', 1), name='joe', "
+                     "sub=Sub(x=1), tags=[])")
+    del ent.name
+    self.assertFalse('n' in ent._values)
+    self.assertEqual(ent.name, None)
+    self.assertRaises(KeyError, ent._values.__getitem__, 'n')
+    ent.name = 'joe'
+    # Serialization is the same as for a regular model class.
+    plain = Plain(id=1, name='joe', sub=Sub(x=1))
+    pb = ent._to_pb()
+    self.assertEqual([p.Encode() for p in pb.property_list()],
+                     [p.Encode() for p in plain._to_pb().property_list()])
+    ent2 = Compact._from_pb(pb)
+    self.assertEqual(ent2, ent)
+    # This is what unpickling does.
+    ent3 = Compact.__new__(Compact)
+    ent3.__setstate__(ent2.__getstate__())
+    self.assertEqual(ent3, ent)
+    # Values for unknown properties are kept too.
+    class Extra(model.Model):
+      name = model.StringProperty('n')
+      extra = model.IntegerProperty()
+    ent4 = Compact._from_pb(Extra(name='joe', extra=42)._to_pb(),
+                            set_key=False)
+    self.assertEqual(ent4._properties['extra']._get_value(ent4), 42)
+    self.assertEqual(sorted(ent4._values.keys()), ['extra', 'n'])
+    self.assertEqual(len(ent4._values), 2)
+    # Expando classes cannot use this.
+    try:
+      class Bad(model.Expando):
+        _compact_storage = True
+    except TypeError:
+      pass
+    else:
+      self.fail('Expected TypeError')
+
+  def testArrayProperties(self):
+    class Series(model.Model):
+      ints = model.IntegerArrayProperty()
+      floats = model.FloatArrayProperty(indexed=False)
+    class Listy(model.Model):
+      ints = model.IntegerProperty(repeated=True)
+      floats = model.FloatProperty(repeated=True, indexed=False)
+    self.assertRaises(ValueError, model.IntegerArrayProperty, repeated=False)
+    ent = Series()
+    self.assertEqual(ent.ints, array.array('l'))
+    self.assertEqual(ent.floats, array.array('d'))
+    ent = Series(ints=[1, 2, 3], floats=(0.5, 2))
+    self.assertEqual(ent.ints, array.array('l', [1, 2, 3]))
+    self.assertEqual(ent.floats, array.array('d', [0.5, 2.0]))
+    # Arrays are copied on assignment.
+    a = array.array('l', [4])
+    ent.ints = a
+    a.append(5)
+    self.assertEqual(ent.ints, array.array('l', [4]))
+    # All values are validated at once.
+    self.assertRaises(datastore_errors.BadValueError, setattr, ent, 'ints',
+                      [1, 1.5])
+    self.assertRaises(datastore_errors.BadValueError, setattr, ent, 'ints',
+                      ['x'])
+    self.assertRaises(datastore_errors.BadValueError, setattr, ent, 'floats',
+                      [None])
+    self.assertRaises(datastore_errors.BadValueError, setattr, ent, 'ints', 42)
+    self.assertRaises(datastore_errors.BadValueError, setattr, ent, 'ints',
+                      None)
+    self.assertEqual(ent.ints, array.array('l', [4]))
+    # Serialization is the same as for a repeated property.
+    ent = Series(ints=[1, 2, 3], floats=[0.5])
+    listy = Listy(ints=[1, 2, 3], floats=[0.5])
+    pb = ent._to_pb()
+    listy_pb = listy._to_pb()
+    self.assertEqual([p.Encode() for p in pb.property_list()],
+                     [p.Encode() for p in listy_pb.property_list()])
+    self.assertEqual([p.Encode() for p in pb.raw_property_list()],
+                     [p.Encode() for p in listy_pb.raw_property_list()])
+    ent2 = Series._from_pb(listy_pb, set_key=False)
+    self.assertEqual(ent2.ints, array.array('l', [1, 2, 3]))
+    self.assertEqual(ent2.floats, array.array('d', [0.5]))
+    self.assertEqual(ent2, ent)
+    listy2 = Listy._from_pb(pb, set_key=False)
+    self.assertEqual(listy2.ints, [1, 2, 3])
+    self.assertEqual(listy2.floats, [0.5])
+    # Queries use the individual values.
+    self.assertEqual(Series.ints == 2, query.FilterNode('ints', '=', 2))
+    # Validators and choices are applied to each value.
+    class Limited(model.Model):
+      ints = model.IntegerArrayProperty(choices=[1, 2])
+      floats = model.FloatArrayProperty(validator=lambda prop, val: abs(val))
+    ent = Limited(ints=[1, 2, 1], floats=[-1.0, 2.0])
+    self.assertEqual(ent.floats, array.array('d', [1.0, 2.0]))
+    self.assertRaises(datastore_errors.BadValueError, setattr, ent, 'ints',
+                      [1, 3])
+
 
 class IndexTests(test_utils.NDBTest):
 
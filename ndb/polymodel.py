@@ -163,7 +163,7 @@ class PolyModel(model.Model):
       cls._class_map[tuple(class_key)] = cls
 
   @classmethod
-  def _from_pb(cls, pb, set_key=True, ent=None, key=None):
+  def _from_pb(cls, pb, set_key=True, ent=None, key=None, lazy=None):
     """Override.
 
     Use the class map to give the entity the correct subclass.
@@ -175,7 +175,7 @@ class PolyModel(model.Model):
         if p.name() == prop_name:
           class_name.append(p.value().stringvalue())
     cls = cls._class_map.get(tuple(class_name), cls)
-    return super(PolyModel, cls)._from_pb(pb, set_key, ent, key)
+    return super(PolyModel, cls)._from_pb(pb, set_key, ent, key, lazy)
 
   @classmethod
   def _class_key(cls):
@@ -924,7 +924,11 @@ class Query(object):
 
   @tasklets.tasklet
   def run_to_queue(self, queue, conn, options=None, dsquery=None):
-    """Run this query, putting entities into the given queue."""
+    """Run this query, putting entities into the given queue.
+
+    If the queue was created with a maxsize, this waits for the consumer
+    whenever the queue is full.
+    """
     try:
       multiquery = self._maybe_multi_query()
       if multiquery is not None:
@@ -933,12 +937,25 @@ class Query(object):
 
       if dsquery is None:
         dsquery = self._get_query(conn)
-      rpc = dsquery.run_async(conn, options)
+      ctx = tasklets.get_context()
+      undecoded_conn = None
+      if (conn is ctx._conn and
+          not datastore_query.QueryOptions.keys_only(options)):
+        undecoded_conn = ctx._get_undecoded_conn(options)
+      rpc = dsquery.run_async(undecoded_conn or conn, options)
       while rpc is not None:
         batch = yield rpc
+        if queue.cancelled():
+          return  # Don't fetch any more batches.
         rpc = batch.next_batch_async(options)
-        for i, result in enumerate(batch.results):
-          queue.putq((batch, i, result))
+        batch_results = batch.results
+        if undecoded_conn is not None:
+          # Decode this batch while the next one is being fetched.
+          batch_results = yield ctx._decode_entities(batch_results, options)
+        for i, result in enumerate(batch_results):
+          room = queue.putq((batch, i, result))
+          if room is not None and not room.done():
+            yield room  # The queue is bounded and full; see QueueFuture.
       queue.complete()
 
     except GeneratorExit:
@@ -954,8 +971,11 @@ class Query(object):
     # Internal version of run_to_queue(), without a queue.
     ctx = tasklets.get_context()
     conn = ctx._conn
+    undecoded_conn = None
+    if not datastore_query.QueryOptions.keys_only(options):
+      undecoded_conn = ctx._get_undecoded_conn(options)
     dsquery = self._get_query(conn)
-    rpc = dsquery.run_async(conn, options)
+    rpc = dsquery.run_async(undecoded_conn or conn, options)
     while rpc is not None:
       batch = yield rpc
       if (batch.skipped_results and
@@ -963,7 +983,11 @@ class Query(object):
         offset = options.offset - batch.skipped_results
         options = datastore_query.FetchOptions(offset=offset, config=options)
       rpc = batch.next_batch_async(options)
-      for result in batch.results:
+      batch_results = batch.results
+      if undecoded_conn is not None:
+        # Decode this batch while the next one is being fetched.
+        batch_results = yield ctx._decode_entities(batch_results, options)
+      for result in batch_results:
         result = ctx._update_cache_from_query_result(result, options)
         if result is not None:
           results.append(result)
@@ -1849,7 +1873,11 @@ class _MultiQuery(object):
 
   @tasklets.tasklet
   def run_to_queue(self, queue, conn, options=None):
-    """Run this query, putting entities into the given queue."""
+    """Run this query, putting entities into the given queue.
+
+    If the queue was created with a maxsize, this waits for the consumer
+    whenever the queue is full.
+    """
     if options is None:
       # Default options.
       offset = None
@@ -1901,6 +1929,7 @@ class _MultiQuery(object):
         if limit <= 0:
           break
         subit = tasklets.SerialQueueFuture('_MultiQuery.run_to_queue[ser]')
+        queue.add_immediate_callback(tasklets._propagate_cancel, queue, subit)
         subq.run_to_queue(subit, conn, options=options)
         while limit > 0:
           try:
@@ -1917,7 +1946,9 @@ class _MultiQuery(object):
               offset -= 1
             else:
               limit -= 1
-              queue.putq((None, None, result))
+              room = queue.putq((None, None, result))
+              if room is not None and not room.done():
+                yield room
       queue.complete()
       return
 
@@ -1930,6 +1961,7 @@ class _MultiQuery(object):
       for subq in self.__subqueries:
         dsquery = subq._get_query(conn)
         subit = tasklets.SerialQueueFuture('_MultiQuery.run_to_queue[par]')
+        queue.add_immediate_callback(tasklets._propagate_cancel, queue, subit)
         subq.run_to_queue(subit, conn, options=options, dsquery=dsquery)
         todo.append((subit, dsquery))
 
@@ -1972,9 +2004,11 @@ class _MultiQuery(object):
           else:
             limit -= 1
             if keys_only:
-              queue.putq((batch, index, key))
+              room = queue.putq((batch, index, key))
             else:
-              queue.putq((batch, index, entity))
+              room = queue.putq((batch, index, entity))
+            if room is not None and not room.done():
+              yield room
         subit = item.iterator
         try:
           batch, index, entity = yield subit.getq()
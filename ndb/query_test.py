@@ -126,6 +126,45 @@ class QueryTests(test_utils.NDBTest):
     self.assertEqual(results[1][2], self.jill)
     self.assertEqual(results[2][2], self.moe)
 
+  def testRunToQueueCancel(self):
+    qry = Foo.query()
+    puts = []
+    class CountingQueue(tasklets.SerialQueueFuture):
+      def putq(self, value):
+        puts.append(value)
+        super(CountingQueue, self).putq(value)
+    queue = CountingQueue()
+    options = query.QueryOptions(batch_size=1)
+    fut = qry.run_to_queue(queue, self.conn, options)
+    queue.getq().check_success()
+    queue.cancel()
+    fut.check_success()
+    # Only the first batch was put; the second was no longer needed.
+    self.assertEqual(len(puts), 1)
+    self.assertTrue(queue.cancelled())
+
+  def testRunToQueueBounded(self):
+    qry = Foo.query()
+    queue = tasklets.SerialQueueFuture(maxsize=1)
+    fut = qry.run_to_queue(queue, self.conn)
+    results = [queue.getq().get_result()]
+    self.assertFalse(fut.done())  # Held back by the full queue.
+    while True:
+      try:
+        results.append(queue.getq().get_result())
+      except EOFError:
+        break
+    fut.check_success()
+    self.assertEqual([ent.name for _, _, ent in results],
+                     ['joe', 'jill', 'moe'])
+
+  def testMapAsyncCancel(self):
+    def callback(ent):
+      return ent.name
+    fut = Foo.query().map_async(callback, batch_size=1)
+    self.assertTrue(fut.cancel())
+    self.assertRaises(tasklets.CancelledError, fut.get_result)
+
   def testRunToQueueError(self):
     self.ExpectWarnings()
     qry = Foo.query(Foo.name > '', Foo.rate > 0)
@@ -63,7 +63,9 @@ the tasklet into a generator.
 import collections
 import logging
 import os
+import Queue
 import sys
+import threading
 import types
 
 from .google_imports import apiproxy_stub_map
@@ -82,6 +84,9 @@ __all__ = ['Return', 'tasklet', 'synctasklet', 'toplevel', 'sleep',
            'make_default_context', 'make_context',
            'Future', 'MultiFuture', 'QueueFuture', 'SerialQueueFuture',
            'ReducingFuture',
+           'run_in_executor', 'set_executor',
+           'CancelledError', 'TimeoutError', 'with_timeout', 'as_completed',
+           'map_concurrent',
            ]
 
 _logging_debug = utils.logging_debug
@@ -105,6 +110,9 @@ class _State(utils.threading_local):
     super(_State, self).__init__()
     self.all_pending = set()
 
+  # NOTE: Futures are only tracked in all_pending when
+  # utils.TRACK_FUTURES is set; see Future._reset().
+
   def add_pending(self, fut):
     _logging_debug('all_pending: add %s', fut)
     self.all_pending.add(fut)
@@ -137,6 +145,20 @@ class _State(utils.threading_local):
 _state = _State()
 
 
+class CancelledError(Exception):
+  """Exception raised by a Future (or in a tasklet) that was cancelled.
+
+  See Future.cancel().
+  """
+
+
+class TimeoutError(Exception):
+  """Exception raised when work did not finish before its deadline.
+
+  See with_timeout() and Context.set_deadline().
+  """
+
+
 # Tuple of exceptions that should not be logged (except in debug mode).
 _flow_exceptions = ()
 
@@ -162,6 +184,7 @@ def _init_flow_exceptions():
   global _flow_exceptions
   _flow_exceptions = ()
   add_flow_exception(datastore_errors.Rollback)
+  add_flow_exception(CancelledError)
   try:
     from webob import exc
   except ImportError:
@@ -173,6 +196,33 @@ def _init_flow_exceptions():
 _init_flow_exceptions()
 
 
+# Max number of times in a row that a tasklet is resumed without going
+# through the event loop, when it yields something that is already done.
+_MAX_TAIL_CALLS = 100
+
+# If False, tasklets save the caller's ambient state and set their own
+# on every step, as they used to, instead of comparing it by identity
+# (see Future._help_tasklet_along()).  bench.py --switches compares both.
+_SNAPSHOT_STATE = True
+
+# The os.environ entry where namespace_manager keeps the current namespace,
+# or None if this SDK doesn't tell us; see _current_namespace().
+_NAMESPACE_KEY = getattr(namespace_manager, '_ENV_CURRENT_NAMESPACE', None)
+
+
+def _current_namespace():
+  """Return the current namespace, as tasklets save and compare it.
+
+  This is the raw os.environ value (None if unset), which avoids calling
+  get_namespace(), with its default namespace lookup, on every step;
+  set_namespace(None) unsets it again.  If the SDK doesn't say where it
+  keeps the namespace, this is get_namespace().
+  """
+  if _NAMESPACE_KEY is None:
+    return namespace_manager.get_namespace()
+  return os.environ.get(_NAMESPACE_KEY)
+
+
 class Future(object):
   """A Future has 0 or more callbacks.
 
@@ -192,14 +242,32 @@ class Future(object):
 
   # XXX Add docstrings to all methods.  Separate PEP 3148 API from RPC API.
 
-  _geninfo = None  # Extra info about suspended generator.
+  # Futures are created for every get, put and tasklet call, so keep
+  # them small.  Subclasses that don't define __slots__ get a __dict__.
+  __slots__ = ('_info', '_where', '_context', '_done', '_result',
+               '_exception', '_traceback', '_callbacks',
+               '_immediate_callbacks', '_next', '_geninfo', '_cancelled',
+               '_waiters')
 
   def __init__(self, info=None):
+    """Constructor.
+
+    Args:
+      info: Optional string describing this Future's purpose, for repr().
+        To avoid formatting it for every Future, this may also be a tuple
+        (function, arg, ...); function(arg, ...) is then only called to
+        produce the string when it is needed.
+    """
     # TODO: Make done a method, to match PEP 3148?
     __ndb_debug__ = 'SKIP'  # Hide this frame from self._where
     self._info = info  # Info from the caller about this Future's purpose.
-    self._where = utils.get_stack()
+    self._where = ()  # Where this Future was created; see TRACK_FUTURES.
+    if utils.TRACK_FUTURES:
+      self._where = utils.get_stack()
     self._context = None
+    self._geninfo = None  # The generator, while one is suspended on this.
+    self._cancelled = False  # Cancellation not yet thrown into _geninfo.
+    self._waiters = 0  # Number of tasklets and Futures waiting for this.
     self._reset()
 
   def _reset(self):
@@ -207,11 +275,20 @@ class Future(object):
     self._result = None
     self._exception = None
     self._traceback = None
-    self._callbacks = []
-    self._immediate_callbacks = []
-    _state.add_pending(self)
+    # The callback lists are only allocated when a callback is added.
+    self._callbacks = None
+    self._immediate_callbacks = None
+    if utils.TRACK_FUTURES:
+      _state.add_pending(self)
     self._next = None  # Links suspended Futures together in a stack.
 
+  def _get_info(self):
+    """Return the info string passed to the constructor, or None."""
+    info = self._info
+    if isinstance(info, tuple):
+      info = info[0](*info[1:])
+    return info
+
   # TODO: Add a __del__ that complains if neither get_exception() nor
   # check_success() was ever called?  What if it's not even done?
 
@@ -228,10 +305,11 @@ class Future(object):
     for line in self._where:
       if 'tasklets.py' not in line:
         break
-    if self._info:
-      line += ' for %s' % self._info
-    if self._geninfo:
-      line += ' %s' % self._geninfo
+    info = self._get_info()
+    if info:
+      line += ' for %s' % info
+    if self._geninfo is not None:
+      line += ' %s' % utils.gen_info(self._geninfo)
     return '<%s %x created by %s; %s>' % (
       self.__class__.__name__, id(self), line, state)
 
@@ -250,43 +328,106 @@ class Future(object):
   def add_callback(self, callback, *args, **kwds):
     if self._done:
       eventloop.queue_call(None, callback, *args, **kwds)
+    elif self._callbacks is None:
+      self._callbacks = [(callback, args, kwds)]
     else:
       self._callbacks.append((callback, args, kwds))
 
   def add_immediate_callback(self, callback, *args, **kwds):
     if self._done:
       callback(*args, **kwds)
+    elif self._immediate_callbacks is None:
+      self._immediate_callbacks = [(callback, args, kwds)]
     else:
       self._immediate_callbacks.append((callback, args, kwds))
 
   def set_result(self, result):
     if self._done:
+      if self.cancelled():
+        return  # Too late; see cancel().
       raise RuntimeError('Result cannot be set twice.')
     self._result = result
     self._done = True
-    _state.remove_pending(self)
-    for callback, args, kwds in self._immediate_callbacks:
-      callback(*args, **kwds)
-    for callback, args, kwds in self._callbacks:
-      eventloop.queue_call(None, callback, *args, **kwds)
+    if utils.TRACK_FUTURES:
+      _state.remove_pending(self)
+    self._run_callbacks()
+
+  def _run_callbacks(self):
+    if self._immediate_callbacks:
+      for callback, args, kwds in self._immediate_callbacks:
+        callback(*args, **kwds)
+    if self._callbacks:
+      for callback, args, kwds in self._callbacks:
+        eventloop.queue_call(None, callback, *args, **kwds)
 
   def set_exception(self, exc, tb=None):
     if not isinstance(exc, BaseException):
       raise TypeError('exc must be an Exception; received %r' % exc)
     if self._done:
+      if self.cancelled():
+        return  # Too late; see cancel().
       raise RuntimeError('Exception cannot be set twice.')
     self._exception = exc
     self._traceback = tb
     self._done = True
-    _state.remove_pending(self, status='fail')
-    for callback, args, kwds in self._immediate_callbacks:
-      callback(*args, **kwds)
-    for callback, args, kwds in self._callbacks:
-      eventloop.queue_call(None, callback, *args, **kwds)
+    if utils.TRACK_FUTURES:
+      _state.remove_pending(self, status='fail')
+    self._run_callbacks()
 
   def done(self):
     return self._done
 
+  def cancel(self):
+    """Cancel this Future, unless it is already done.
+
+    If a tasklet's generator is suspended waiting for another Future,
+    it stops waiting and CancelledError is thrown into the generator
+    right away; if it is waiting for an RPC, that happens when the RPC
+    completes.  The generator may catch it to clean up, or even to carry
+    on.  The Future the tasklet was waiting for is cancelled too, unless
+    other tasklets (or MultiFutures etc.) are still waiting for it; this
+    matters e.g. for the Futures that concurrent Context.get() calls for
+    the same key share.  Any other Future is completed with
+    CancelledError right away, and whatever would have set its result
+    later is ignored.
+
+    Note that cancelling a Future that other code is also waiting for
+    (e.g. using get_result()) cancels it for that code as well.
+
+    Returns:
+      False if the Future was already done, True otherwise.
+    """
+    if self._done:
+      return False
+    if self._geninfo is None:
+      self.set_exception(CancelledError())
+      return True
+    self._cancelled = True
+    fut = self._next
+    if fut is None or fut._done:
+      # Not started yet, waiting for an RPC, or about to be resumed
+      # anyway; _help_tasklet_along() throws CancelledError then.
+      return True
+    # Stop waiting for fut, and resume the generator right away (but
+    # after whatever cancelling fut resumes, so that cleanup happens in
+    # the same order as before).
+    self._next = None
+    callback = self._on_future_completion
+    for item in fut._callbacks:
+      if item[0] == callback:
+        break
+    else:
+      raise RuntimeError('%s is not waiting for %s' % (self, fut))
+    fut._callbacks.remove(item)
+    _release_waiter(fut)
+    unused_fut, ns, ds_conn, gen = item[1]
+    eventloop.queue_call(None, self._help_tasklet_along, ns, ds_conn, gen)
+    return True
+
+  def cancelled(self):
+    """Return True if this Future is done with CancelledError."""
+    return self._done and isinstance(self._exception, CancelledError)
+
   @property
   def state(self):
     # This is just for compatibility with UserRPC and MultiRpc.
@@ -303,6 +444,8 @@ class Future(object):
     while not self._done:
       if not ev.run1():
         logging.info('Deadlock in %s', self)
+        if not utils.TRACK_FUTURES:
+          logging.info('Set ndb.utils.TRACK_FUTURES to list pending Futures')
         logging.info('All pending Futures:\n%s', _state.dump_all_pending())
         _logging_debug('All pending Futures (verbose):\n%s',
                       _state.dump_all_pending(verbose=True))
@@ -325,58 +468,186 @@ class Future(object):
     self.check_success()
     return self._result
 
+  def _remove_callback(self, callback):
+    """Remove the entries for callback added with add_callback()."""
+    if self._callbacks:
+      self._callbacks = [item for item in self._callbacks
+                         if item[0] is not callback]
+
+  # The two methods below don't scan their argument after each step of
+  # the event loop.  Instead, each Future adds a callback that puts it
+  # on a ready queue when it's done.  Only arguments that aren't Futures
+  # (i.e. RPCs) are still polled.  Regular callbacks are used so that
+  # callbacks added to a Future earlier run before it counts as done.
+  # See also as_completed(), which does this without blocking.
+
   # TODO: Have a tasklet that does this
   @classmethod
   def wait_any(cls, futures):
+    """Wait until one of the given Futures (or RPCs) is done.
+
+    Returns:
+      One of the Futures (or RPCs) that is done, or None if the
+      argument is empty.
+    """
     # TODO: Flatten MultiRpcs.
-    waiting_on = set(futures)
+    waiting_on = list(futures)
+    for f in waiting_on:
+      if f.state == cls.FINISHING:
+        return f
+    if not waiting_on:
+      return None
+    ready = collections.deque()
+    on_done = ready.append
+    rpcs = []
+    for f in waiting_on:
+      if isinstance(f, Future):
+        f.add_callback(on_done, f)
+      else:
+        rpcs.append(f)
     ev = eventloop.get_event_loop()
-    while waiting_on:
+    try:
+      while not ready:
+        ev.run1()
+        for rpc in rpcs:
+          if rpc.state == cls.FINISHING:
+            return rpc
+      return ready[0]
+    finally:
+      # Don't leave callbacks behind on the Futures that aren't done.
       for f in waiting_on:
-        if f.state == cls.FINISHING:
-          return f
-      ev.run1()
-    return None
+        if isinstance(f, Future) and not f._done:
+          f._remove_callback(on_done)
 
   # TODO: Have a tasklet that does this
   @classmethod
   def wait_all(cls, futures):
+    """Wait until all of the given Futures (and RPCs) are done."""
     # TODO: Flatten MultiRpcs.
-    waiting_on = set(futures)
+    ready = collections.deque()
+    count = 0
+    rpcs = []
+    for f in futures:
+      if f.state != cls.RUNNING:
+        continue
+      if isinstance(f, Future):
+        f.add_callback(ready.append, f)
+        count += 1
+      else:
+        rpcs.append(f)
     ev = eventloop.get_event_loop()
-    while waiting_on:
-      waiting_on = set(f for f in waiting_on if f.state == cls.RUNNING)
+    while len(ready) < count or rpcs:
       ev.run1()
+      if rpcs:
+        rpcs = [rpc for rpc in rpcs if rpc.state == cls.RUNNING]
 
   def _help_tasklet_along(self, ns, ds_conn, gen, val=None, exc=None, tb=None):
     # XXX Docstring
-    info = utils.gen_info(gen)
+    info = _GenInfo(gen)
     __ndb_debug__ = info
+    self._geninfo = None  # The generator is no longer suspended.
+    # The tasklet's own ambient state (context, namespace and datastore
+    # connection) is captured once, when it is created (see tasklet()),
+    # and passed along from step to step.  Here the caller's state is read
+    # once; after that each piece is only compared by identity, and set
+    # or restored when it differs.  The context is switched through
+    # _state directly (get_context() above made sure the os.environ
+    # marker is set), and the namespace is compared as returned by
+    # _current_namespace(), so set_namespace() is only called when the
+    # generator has actually changed it.  With _SNAPSHOT_STATE off, each
+    # step saves and restores the caller's state instead.
+    # When the generator yields a Future or RPC that is already done, we
+    # resume it right away without restoring anything in between, but at
+    # most _MAX_TAIL_CALLS times in a row so that a long chain of cache
+    # hits cannot starve other tasklets.  This is a loop rather than a
+    # recursive call, so the stack depth stays constant.
+    save_context = cur_context = get_context()
+    save_namespace = cur_namespace = _current_namespace()
+    save_ds_connection = cur_ds_connection = datastore._GetConnection()
+    state = _state
+    snapshot = _SNAPSHOT_STATE
+    tail_calls = 0
     try:
-      save_context = get_context()
-      save_namespace = namespace_manager.get_namespace()
-      save_ds_connection = datastore._GetConnection()
       try:
-        set_context(self._context)
-        if ns != save_namespace:
-          namespace_manager.set_namespace(ns)
-        if ds_conn is not save_ds_connection:
-          datastore._SetConnection(ds_conn)
-        if exc is not None:
-          _logging_debug('Throwing %s(%s) into %s',
-                        exc.__class__.__name__, exc, info)
-          value = gen.throw(exc.__class__, exc, tb)
-        else:
-          _logging_debug('Sending %r to %s', val, info)
-          value = gen.send(val)
-          self._context = get_context()
+        while True:
+          if self._cancelled:
+            # See cancel(); this replaces whatever we were going to send.
+            self._cancelled = False
+            exc = CancelledError()
+            tb = None
+          try:
+            if not snapshot:
+              save_context = get_context()
+              save_namespace = namespace_manager.get_namespace()
+              save_ds_connection = datastore._GetConnection()
+              set_context(self._context)
+              if ns != save_namespace:
+                namespace_manager.set_namespace(ns)
+              if ds_conn is not save_ds_connection:
+                datastore._SetConnection(ds_conn)
+            else:
+              if self._context is not cur_context:
+                state.current_context = self._context
+              if ns != cur_namespace:
+                namespace_manager.set_namespace(ns)
+                cur_namespace = ns
+              if ds_conn is not cur_ds_connection:
+                datastore._SetConnection(ds_conn)
+            if exc is not None:
+              _logging_debug('Throwing %s(%s) into %s',
+                            exc.__class__.__name__, exc, info)
+              value = gen.throw(exc.__class__, exc, tb)
+            else:
+              _logging_debug('Sending %r to %s', val, info)
+              value = gen.send(val)
+              self._context = state.current_context
+              if self._context is None:
+                self._context = get_context()
+          finally:
+            if not snapshot:
+              ns = namespace_manager.get_namespace()
+              ds_conn = datastore._GetConnection()
+              set_context(save_context)
+              if save_namespace != ns:
+                namespace_manager.set_namespace(save_namespace)
+              if save_ds_connection is not ds_conn:
+                datastore._SetConnection(save_ds_connection)
+              cur_context = save_context
+              cur_namespace = save_namespace
+              cur_ds_connection = save_ds_connection
+            else:
+              cur_context = state.current_context
+              ns = cur_namespace = _current_namespace()
+              ds_conn = cur_ds_connection = datastore._GetConnection()
+          if tail_calls >= _MAX_TAIL_CALLS:
+            break
+          if isinstance(value, Future):
+            if not value._done or self._next:
+              break
+            val = value._result
+            exc = value._exception
+            tb = value._traceback
+          elif isinstance(value, (apiproxy_stub_map.UserRPC,
+                                  datastore_rpc.MultiRpc)):
+            if value.state != self.FINISHING:
+              break
+            val = exc = tb = None
+            try:
+              val = value.get_result()
+            except GeneratorExit:
+              raise
+            except Exception, exc:
+              _, _, tb = sys.exc_info()
+          else:
+            break
+          tail_calls += 1
+          _logging_debug('%s yielded %r, which is done', info, value)
       finally:
-        ns = namespace_manager.get_namespace()
-        ds_conn = datastore._GetConnection()
-        set_context(save_context)
-        if save_namespace != ns:
+        if cur_context is not save_context:
+          state.current_context = save_context
+        if cur_namespace != save_namespace:
           namespace_manager.set_namespace(save_namespace)
-        if save_ds_connection is not ds_conn:
+        if cur_ds_connection is not save_ds_connection:
           datastore._SetConnection(save_ds_connection)
 
     except StopIteration, err:
@@ -414,24 +685,23 @@ class Future(object):
       _logging_debug('%s yielded %r', info, value)
       if isinstance(value, (apiproxy_stub_map.UserRPC,
                             datastore_rpc.MultiRpc)):
-        # TODO: Tail recursion if the RPC is already complete.
+        self._geninfo = gen
         eventloop.queue_rpc(value, self._on_rpc_completion,
                             value, ns, ds_conn, gen)
         return
       if isinstance(value, Future):
-        # TODO: Tail recursion if the Future is already done.
         if self._next:
           raise RuntimeError('Future has already completed yet next is %r' %
                              self._next)
         self._next = value
-        self._geninfo = utils.gen_info(gen)
+        self._geninfo = gen
+        value._waiters += 1
         _logging_debug('%s is now blocked waiting for %s', self, value)
         value.add_callback(self._on_future_completion, value, ns, ds_conn, gen)
         return
       if isinstance(value, (tuple, list)):
         # Arrange for yield to return a list of results (not Futures).
-        info = 'multi-yield from %s' % utils.gen_info(gen)
-        mfut = MultiFuture(info)
+        mfut = MultiFuture((_multi_yield_info, gen))
         try:
           for subfuture in value:
             mfut.add_dependent(subfuture)
@@ -441,6 +711,9 @@ class Future(object):
         except Exception, err:
           _, _, tb = sys.exc_info()
           mfut.set_exception(err, tb)
+        self._next = mfut
+        self._geninfo = gen
+        mfut._waiters += 1
         mfut.add_callback(self._on_future_completion, mfut, ns, ds_conn, gen)
         return
       if _is_generator(value):
@@ -473,6 +746,22 @@ class Future(object):
       val = future.get_result()  # This won't raise an exception.
       self._help_tasklet_along(ns, ds_conn, gen, val)
 
+class _GenInfo(object):
+  """Lazily formatted utils.gen_info(gen), for logging and __ndb_debug__."""
+
+  __slots__ = ('gen',)
+
+  def __init__(self, gen):
+    self.gen = gen
+
+  def __str__(self):
+    return str(utils.gen_info(self.gen))
+
+
+def _multi_yield_info(gen):
+  return 'multi-yield from %s' % utils.gen_info(gen)
+
+
 def sleep(dt):
   """Public function to sleep some time.
 
@@ -484,6 +773,217 @@ def sleep(dt):
   return fut
 
 
+def with_timeout(fut, seconds):
+  """Return a Future for the result of fut that fails after some time.
+
+  If fut is not done within the given number of seconds, the returned
+  Future fails with TimeoutError and fut is cancelled, so that a
+  tasklet behind it stops at its next yield.  Cancelling the returned
+  Future cancels fut as well.
+
+  Example:
+    ent = yield tasklets.with_timeout(key.get_async(), 0.5)
+  """
+  if not isinstance(fut, Future):
+    raise TypeError('Expected a Future, got %r' % (fut,))
+  result = Future('with_timeout(%.3f)' % seconds)
+  if fut.done():
+    _transfer_result(fut, result)
+    return result
+  handle = eventloop.queue_call(seconds, _time_out, fut, result, seconds)
+  fut.add_immediate_callback(_finish_with_timeout, fut, result, handle)
+  result.add_immediate_callback(_propagate_cancel, result, fut)
+  return result
+
+
+def as_completed(futures):
+  """Return an iterator over Futures that complete in order of completion.
+
+  The first Future it returns gets the result (or exception) of the
+  first of the given Futures to finish, the second that of the second
+  one to finish, and so on.  Yielding these from a tasklet doesn't block
+  the event loop, so fan-out code can handle results as they come in
+  without polling.
+
+  Example:
+    for fut in tasklets.as_completed([key.get_async() for key in keys]):
+      ent = yield fut
+      ...
+  """
+  futures = list(futures)
+  results = [Future('as_completed') for _ in futures]
+  unused = collections.deque(results)
+  for fut in futures:
+    fut.add_immediate_callback(_transfer_to_next, fut, unused)
+  return iter(results)
+
+
+def _transfer_to_next(fut, unused):
+  """Helper for as_completed(), called when fut is done."""
+  _transfer_result(fut, unused.popleft())
+
+
+def _time_out(fut, result, seconds):
+  """Helper for with_timeout(), called when the time is up."""
+  result.set_exception(
+    TimeoutError('Future not done after %.3f seconds: %s' % (seconds, fut)))
+  fut.cancel()
+
+
+def _finish_with_timeout(fut, result, handle):
+  """Helper for with_timeout(), called when fut is done."""
+  eventloop.cancel_call(handle)
+  if not result.done():
+    _transfer_result(fut, result)
+
+
+class _ThreadPoolJob(object):
+  """A function call submitted to a _ThreadPool.
+
+  This has the subset of the concurrent.futures.Future API that
+  run_in_executor() uses.
+  """
+
+  def __init__(self, func, args):
+    self._func = func
+    self._args = args
+    self._lock = threading.Lock()
+    self._done = False
+    self._result = None
+    self._exc_info = None
+    self._callbacks = []
+
+  def run(self):
+    try:
+      self._result = self._func(*self._args)
+    except Exception:
+      self._exc_info = sys.exc_info()
+    self._lock.acquire()
+    try:
+      self._done = True
+      callbacks, self._callbacks = self._callbacks, None
+    finally:
+      self._lock.release()
+    for callback in callbacks:
+      callback(self)
+
+  def add_done_callback(self, callback):
+    """Call callback(self) when done, in whichever thread runs the job."""
+    self._lock.acquire()
+    try:
+      if not self._done:
+        self._callbacks.append(callback)
+        return
+    finally:
+      self._lock.release()
+    callback(self)
+
+  def result(self):
+    """Return the result or raise the exception; only valid when done."""
+    if self._exc_info is not None:
+      raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+    return self._result
+
+
+class _ThreadPool(object):
+  """A minimal pool of daemon threads with a concurrent.futures-like API.
+
+  Threads are started on demand, up to max_workers.
+  """
+
+  def __init__(self, max_workers):
+    self._max_workers = max_workers
+    self._jobs = Queue.Queue()
+    self._lock = threading.Lock()
+    self._threads = []
+
+  def submit(self, func, *args):
+    job = _ThreadPoolJob(func, args)
+    self._jobs.put(job)
+    self._lock.acquire()
+    try:
+      if len(self._threads) < self._max_workers:
+        thread = threading.Thread(target=self._worker,
+                                  name='ndb-executor-%d' % len(self._threads))
+        thread.setDaemon(True)
+        thread.start()
+        self._threads.append(thread)
+    finally:
+      self._lock.release()
+    return job
+
+  def _worker(self):
+    while True:
+      job = self._jobs.get()
+      job.run()
+
+
+_DEFAULT_EXECUTOR_WORKERS = 4
+
+_executor = None  # See set_executor().
+_executor_lock = threading.Lock()
+
+
+def set_executor(executor):
+  """Set the executor used by run_in_executor().
+
+  Args:
+    executor: An object with a submit(func, *args) method that returns
+      an object with add_done_callback() and result() methods, e.g. a
+      concurrent.futures.ThreadPoolExecutor or ProcessPoolExecutor;
+      or None to use a default pool of worker threads.
+  """
+  global _executor
+  _executor = executor
+
+
+def _get_executor():
+  global _executor
+  executor = _executor
+  if executor is None:
+    _executor_lock.acquire()
+    try:
+      if _executor is None:
+        _executor = _ThreadPool(_DEFAULT_EXECUTOR_WORKERS)
+      executor = _executor
+    finally:
+      _executor_lock.release()
+  return executor
+
+
+def run_in_executor(func, *args):
+  """Call func(*args) in the executor; return a Future for the result.
+
+  Use this to keep CPU-heavy work from stalling the other tasklets:
+
+    result = yield tasklets.run_in_executor(func, arg1, arg2)
+
+  The Future is resolved by the calling thread's event loop, so the
+  usual tasklet semantics apply.  Since func runs in another thread (or
+  process, depending on the executor) it must not use the NDB context
+  or event loop.  See set_executor().
+  """
+  ev = eventloop.get_event_loop()
+  fut = Future('run_in_executor(%s)' % utils.func_info(func))
+  job = _get_executor().submit(func, *args)
+  ev.expect_threadsafe_call()
+  # The done callback runs in a worker thread; hand over to our loop.
+  job.add_done_callback(
+    lambda job: ev.queue_threadsafe_call(_transfer_job_result, job, fut))
+  return fut
+
+
+def _transfer_job_result(job, fut):
+  """Helper to transfer the result of an executor job to a Future."""
+  try:
+    result = job.result()
+  except Exception:
+    _, err, tb = sys.exc_info()
+    fut.set_exception(err, tb)
+  else:
+    fut.set_result(result)
+
+
 class MultiFuture(Future):
   """A Future that depends on multiple other Futures.
 
@@ -521,6 +1021,8 @@ class MultiFuture(Future):
   call mf.add_dependent() or mf.putq() any more.
   """
 
+  __slots__ = ('_full', '_dependents', '_results')
+
   def __init__(self, info=None):
     __ndb_debug__ = 'SKIP'  # Hide this frame from self._where
     self._full = False
@@ -537,10 +1039,19 @@ class MultiFuture(Future):
       lines.append(fut.dump_stack().replace('\n', '\n  '))
     return '\n waiting for '.join(lines)
 
+  def cancel(self):
+    if self._done:
+      return False
+    for fut in list(self._dependents):
+      _release_waiter(fut)
+    return super(MultiFuture, self).cancel()
+
   # TODO: Maybe rename this method, since completion of a Future/RPC
   # already means something else.  But to what?
   def complete(self):
     if self._full:
+      if self.cancelled():
+        return
       raise RuntimeError('MultiFuture cannot complete twice.')
     self._full = True
     if not self._dependents:
@@ -586,10 +1097,15 @@ class MultiFuture(Future):
     elif not isinstance(fut, Future):
       raise TypeError('Expected Future, received %s: %r' % (type(fut), fut))
     if self._full:
+      if self.cancelled():
+        if not fut._waiters:
+          fut.cancel()
+        return
       raise RuntimeError('MultiFuture cannot add a dependent once complete.')
     self._results.append(fut)
     if fut not in self._dependents:
       self._dependents.add(fut)
+      fut._waiters += 1
       fut.add_callback(self._signal_dependent_done, fut)
 
   def _signal_dependent_done(self, fut):
@@ -613,25 +1129,52 @@ class QueueFuture(Future):
   exception.  (I.e., q.getq() returns a Future as always, but yieding
   that Future raises EOFError.)
 
-  NOTE: Values can also be pushed directly via .putq(value).  However
-  there is no flow control -- if the producer is faster than the
-  consumer, the queue will grow unbounded.
+  NOTE: Values can also be pushed directly via .putq(value).  There is
+  no flow control unless a maxsize is passed to the constructor; then
+  putq() returns a Future that is done once fewer than maxsize results
+  are pending or waiting to be retrieved, and a producer that yields it
+  is held back until the consumer catches up.  (With several producers
+  the queue may exceed maxsize by one item per producer.)  Otherwise
+  putq() returns None and, if the producer is faster than the consumer,
+  the queue will grow unbounded.
+
+  Cancelling the queue cancels its pending dependents (unless something
+  else is waiting for them too; see Future.cancel()) and makes later
+  putq() and complete() calls no-ops, so producers can check
+  cancelled() to stop early.  (This holds for SerialQueueFuture too.)
   """
   # TODO: Refactor to share code with MultiFuture.
 
-  def __init__(self, info=None):
+  __slots__ = ('_full', '_dependents', '_completed', '_waiting', '_putters')
+
+  def __init__(self, info=None, maxsize=None):
     self._full = False
     self._dependents = set()
     self._completed = collections.deque()
     self._waiting = collections.deque()
+    self._putters = _make_putters(maxsize)
     # Invariant: at least one of _completed and _waiting is empty.
     # Also: _full and not _dependents <==> _done.
     super(QueueFuture, self).__init__(info=info)
 
   # TODO: __repr__
 
+  def cancel(self):
+    if self._done:
+      return False
+    for fut in list(self._dependents):
+      _release_waiter(fut)
+    if self._putters is not None:
+      self._putters.cancel_all()
+    return super(QueueFuture, self).cancel()
+
+  def _size(self):
+    return len(self._dependents) + len(self._completed)
+
   def complete(self):
     if self._full:
+      if self.cancelled():
+        return
       raise RuntimeError('MultiFuture cannot complete twice.')
     self._full = True
     if not self._dependents:
@@ -651,14 +1194,21 @@ class QueueFuture(Future):
       fut = Future()
       fut.set_result(value)
     self.add_dependent(fut)
+    if self._putters is not None:
+      return self._putters.wait(self, self._size())
 
   def add_dependent(self, fut):
     if not isinstance(fut, Future):
       raise TypeError('fut must be a Future instance; received %r' % fut)
     if self._full:
+      if self.cancelled():
+        if not fut._waiters:
+          fut.cancel()
+        return
       raise RuntimeError('QueueFuture add dependent once complete.')
     if fut not in self._dependents:
       self._dependents.add(fut)
+      fut._waiters += 1
       fut.add_callback(self._signal_dependent_done, fut)
 
   def _signal_dependent_done(self, fut):
@@ -670,9 +1220,13 @@ class QueueFuture(Future):
     val = None
     if exc is None:
       val = fut.get_result()
+    while self._waiting and self._waiting[0].done():
+      self._waiting.popleft()  # Cancelled by the consumer.
     if self._waiting:
       waiter = self._waiting.popleft()
       self._pass_result(waiter, exc, tb, val)
+      if self._putters is not None:
+        self._putters.release(self._size())
     else:
       self._completed.append((exc, tb, val))
     if self._full and not self._dependents and not self._done:
@@ -685,11 +1239,15 @@ class QueueFuture(Future):
     while self._waiting:
       waiter = self._waiting.popleft()
       self._pass_eof(waiter)
+    if self._putters is not None:
+      self._putters.release_all()
 
   def getq(self):
     fut = Future()
     if self._completed:
       exc, tb, val = self._completed.popleft()
+      if self._putters is not None:
+        self._putters.release(self._size())
       self._pass_result(fut, exc, tb, val)
     elif self._full and not self._dependents:
       self._pass_eof(fut)
@@ -767,23 +1325,43 @@ class SerialQueueFuture(Future):
 
   If, instead of complete(), set_exception() is called, the exception
   and traceback set there will be used instead of EOFError.
+
+  If maxsize is given, putq() returns a Future that is done once fewer
+  than maxsize Futures are in _queue, like for QueueFuture.
   """
 
-  def __init__(self, info=None):
+  __slots__ = ('_full', '_queue', '_waiting', '_putters')
+
+  def __init__(self, info=None, maxsize=None):
     self._full = False
     self._queue = collections.deque()
     self._waiting = collections.deque()
+    self._putters = _make_putters(maxsize)
     super(SerialQueueFuture, self).__init__(info=info)
 
   # TODO: __repr__
 
+  def cancel(self):
+    if self._done:
+      return False
+    for fut in self._queue:
+      _release_waiter(fut)
+    self._queue.clear()
+    if self._putters is not None:
+      self._putters.cancel_all()
+    return super(SerialQueueFuture, self).cancel()
+
   def complete(self):
     if self._full:
+      if self.cancelled():
+        return
       raise RuntimeError('SerialQueueFuture cannot complete twice.')
     self._full = True
     while self._waiting:
       waiter = self._waiting.popleft()
       waiter.set_exception(EOFError('Queue is empty'))
+    if self._putters is not None:
+      self._putters.release_all()
     if not self._queue:
       self.set_result(None)
 
@@ -793,34 +1371,53 @@ class SerialQueueFuture(Future):
     while self._waiting:
       waiter = self._waiting.popleft()
       waiter.set_exception(exc, tb)
+    if self._putters is not None:
+      self._putters.release_all()
 
   def putq(self, value):
     if isinstance(value, Future):
       fut = value
+      self.add_dependent(fut)
     else:
+      self._drop_cancelled_waiters()
       if self._waiting:
         waiter = self._waiting.popleft()
         waiter.set_result(value)
-        return
-      fut = Future()
-      fut.set_result(value)
-    self.add_dependent(fut)
+      else:
+        fut = Future()
+        fut.set_result(value)
+        self.add_dependent(fut)
+    if self._putters is not None:
+      return self._putters.wait(self, len(self._queue))
 
   def add_dependent(self, fut):
     if not isinstance(fut, Future):
       raise TypeError('fut must be a Future instance; received %r' % fut)
     if self._full:
+      if self.cancelled():
+        if not fut._waiters:
+          fut.cancel()
+        return
       raise RuntimeError('SerialQueueFuture cannot add dependent '
                          'once complete.')
+    self._drop_cancelled_waiters()
     if self._waiting:
       waiter = self._waiting.popleft()
       fut.add_callback(_transfer_result, fut, waiter)
     else:
+      fut._waiters += 1
       self._queue.append(fut)
 
+  def _drop_cancelled_waiters(self):
+    while self._waiting and self._waiting[0].done():
+      self._waiting.popleft()  # Cancelled by the consumer.
+
   def getq(self):
     if self._queue:
       fut = self._queue.popleft()
+      fut._waiters -= 1  # Now it's up to the consumer.
+      if self._putters is not None:
+        self._putters.release(len(self._queue))
       # TODO: Isn't it better to call self.set_result(None) in complete()?
       if not self._queue and self._full and not self._done:
         self.set_result(None)
@@ -841,6 +1438,75 @@ class SerialQueueFuture(Future):
     return fut
 
 
+class _Putters(object):
+  """Producers waiting for room in a bounded QueueFuture or SerialQueueFuture.
+
+  Each waiting producer is represented by a Future returned from putq().
+  """
+
+  __slots__ = ('_maxsize', '_waiting')
+
+  def __init__(self, maxsize):
+    self._maxsize = maxsize
+    self._waiting = collections.deque()
+
+  def wait(self, queue, size):
+    """Return a Future that is done when the queue's size is below maxsize.
+
+    If the queue was cancelled the Future fails with CancelledError, so
+    that a producer yielding it stops.
+    """
+    fut = Future('putq')
+    if queue.cancelled():
+      fut.set_exception(CancelledError())
+    elif size < self._maxsize or queue.done():
+      fut.set_result(None)
+    else:
+      self._waiting.append(fut)
+    return fut
+
+  def release(self, size):
+    """Let the next waiting producer continue if size is below maxsize."""
+    while self._waiting and size < self._maxsize:
+      fut = self._waiting.popleft()
+      if not fut.done():  # Skip producers that cancelled their wait.
+        fut.set_result(None)
+        return
+
+  def release_all(self):
+    while self._waiting:
+      fut = self._waiting.popleft()
+      if not fut.done():
+        fut.set_result(None)
+
+  def cancel_all(self):
+    while self._waiting:
+      self._waiting.popleft().cancel()
+
+
+def _make_putters(maxsize):
+  """Helper for the queue constructors; returns None if maxsize is None."""
+  if maxsize is None:
+    return None
+  if not isinstance(maxsize, (int, long)) or maxsize <= 0:
+    raise ValueError('maxsize must be a positive integer; received %r' %
+                     (maxsize,))
+  return _Putters(maxsize)
+
+
+def _release_waiter(fut):
+  """Helper to stop waiting for fut, and cancel it if nothing else is."""
+  fut._waiters -= 1
+  if fut._waiters <= 0:
+    fut.cancel()
+
+
+def _propagate_cancel(fut1, fut2):
+  """Helper to cancel fut2 if fut1 was cancelled, as a callback of fut1."""
+  if fut1.cancelled():
+    fut2.cancel()
+
+
 def _transfer_result(fut1, fut2):
   """Helper to transfer result or errors from one Future to another."""
   exc = fut1.get_exception()
@@ -866,6 +1532,9 @@ class ReducingFuture(Future):
   """
   # TODO: Refactor to reuse some code with MultiFuture.
 
+  __slots__ = ('_reducer', '_batch_size', '_full', '_dependents', '_completed',
+               '_queue')
+
   def __init__(self, reducer, info=None, batch_size=20):
     self._reducer = reducer
     self._batch_size = batch_size
@@ -877,8 +1546,17 @@ class ReducingFuture(Future):
 
   # TODO: __repr__
 
+  def cancel(self):
+    if self._done:
+      return False
+    for fut in list(self._dependents):
+      _release_waiter(fut)
+    return super(ReducingFuture, self).cancel()
+
   def complete(self):
     if self._full:
+      if self.cancelled():
+        return
       raise RuntimeError('ReducingFuture cannot complete twice.')
     self._full = True
     if not self._dependents:
@@ -899,6 +1577,10 @@ class ReducingFuture(Future):
 
   def add_dependent(self, fut):
     if self._full:
+      if self.cancelled():
+        if not fut._waiters:
+          fut.cancel()
+        return
       raise RuntimeError('ReducingFuture cannot add dependent once complete.')
     self._internal_add_dependent(fut)
 
@@ -907,6 +1589,7 @@ class ReducingFuture(Future):
       raise TypeError('fut must be a Future; received %r' % fut)
     if fut not in self._dependents:
       self._dependents.add(fut)
+      fut._waiters += 1
       fut.add_callback(self._signal_dependent_done, fut)
 
   def _signal_dependent_done(self, fut):
@@ -989,6 +1672,8 @@ def get_return_value(err):
 def tasklet(func):
   # XXX Docstring
 
+  info = 'tasklet %s' % utils.func_info(func)  # Computed once per function.
+
   @utils.wrapping(func)
   def tasklet_wrapper(*args, **kwds):
     # XXX Docstring
@@ -997,7 +1682,7 @@ def tasklet(func):
     # generator and turn it into a tasklet dynamically.  (Monocle has
     # this I believe.)
     # __ndb_debug__ = utils.func_info(func)
-    fut = Future('tasklet %s' % utils.func_info(func))
+    fut = Future(info)
     fut._context = get_context()
     try:
       result = func(*args, **kwds)
@@ -1006,8 +1691,9 @@ def tasklet(func):
       # the "raise Return(...)" idiom, we'll extract the return value.
       result = get_return_value(err)
     if _is_generator(result):
-      ns = namespace_manager.get_namespace()
+      ns = _current_namespace()
       ds_conn = datastore._GetConnection()
+      fut._geninfo = result  # So cancel() works before it has started.
       eventloop.queue_call(None, fut._help_tasklet_along, ns, ds_conn, result)
     else:
       fut.set_result(result)
@@ -1051,12 +1737,70 @@ def toplevel(func):
       set_context(None)
       ctx.flush().check_success()
       eventloop.run()  # Ensure writes are flushed, etc.
+      eventloop.report_stats()
   return add_context_wrapper
 
 
 _CONTEXT_KEY = '__CONTEXT__'
 
 
+def map_concurrent(tasklet_fn, iterable, concurrency=10, ordered=True):
+  """Call a tasklet for each item of an iterable, a few at a time.
+
+  At most concurrency calls are running at any time, and the next item
+  is only taken from the iterable when one of them is done, so the
+  iterable may be a long generator.
+
+  Args:
+    tasklet_fn: A tasklet (or other function returning a Future or a
+      value) taking one item.
+    iterable: The items.
+    concurrency: The maximum number of calls running at once.
+    ordered: If true, the results are in the order of the items;
+      otherwise they are in the order in which the calls finished.
+
+  Returns:
+    A Future whose result is the list of results.  If a call fails, no
+    more calls are started, those still running are cancelled, and the
+    Future fails with the same exception.  Cancelling the Future
+    cancels the calls still running as well.
+  """
+  if not isinstance(concurrency, (int, long)) or concurrency <= 0:
+    raise ValueError('concurrency must be a positive integer; received %r' %
+                     (concurrency,))
+  return _map_concurrent(tasklet_fn, iter(iterable), concurrency, ordered)
+
+
+@tasklet
+def _map_concurrent(tasklet_fn, items, concurrency, ordered):
+  # The bounded queue holds the calls that are running or whose results
+  # haven't been taken yet; its putq() tells us when it's full.
+  queue = QueueFuture('map_concurrent', maxsize=concurrency)
+  futs = []
+  results = []
+  try:
+    for item in items:
+      fut = tasklet_fn(item)
+      if ordered:
+        futs.append(fut)
+      if not queue.putq(fut).done():
+        # Taking the result of the first call to finish makes room.
+        results.append((yield queue.getq()))
+    queue.complete()
+    while True:
+      try:
+        results.append((yield queue.getq()))
+      except EOFError:
+        break
+  except Exception:
+    queue.cancel()
+    raise
+  if ordered:
+    results = [fut.get_result() if isinstance(fut, Future) else fut
+               for fut in futs]
+  raise Return(results)
+
+
 def get_context():
   # XXX Docstring
   ctx = None
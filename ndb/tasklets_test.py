@@ -60,12 +60,12 @@ class TaskletTests(test_utils.NDBTest):
     f = tasklets.Future()
     self.assertEqual(f._result, None)
     self.assertEqual(f._exception, None)
-    self.assertEqual(f._callbacks, [])
+    self.assertEqual(f._callbacks, None)  # Allocated on first use.
 
   def testFuture_Repr(self):
     f = tasklets.Future()
-    prefix = (r'<Future [\da-f]+ created by'
-              r'( testFuture_Repr\(tasklets_test.py:\d+\)|\?); ')
+    prefix = (r'<Future [\da-f]+ created by '
+              r'(testFuture_Repr\(tasklets_test.py:\d+\)|\?); ')
     self.assertTrue(re.match(prefix + r'pending>$', repr(f)), repr(f))
     f.set_result('abc')
     self.assertTrue(re.match(prefix + r'result \'abc\'>$', repr(f)), repr(f))
@@ -75,6 +75,41 @@ class TaskletTests(test_utils.NDBTest):
                              repr(f)),
                     repr(f))
 
+  def testFuture_LazyInfo(self):
+    calls = []
+    def info(arg):
+      calls.append(arg)
+      return 'lazy %s' % arg
+    f = tasklets.Future((info, 42))
+    self.assertEqual(calls, [])
+    r = repr(f)
+    self.assertTrue(r.endswith(' for lazy 42; pending>'), r)
+    self.assertEqual(calls, [42])
+
+  def testFuture_Slots(self):
+    f = tasklets.Future()
+    self.assertRaises(AttributeError, setattr, f, 'foo', 42)
+    for cls in (tasklets.MultiFuture, tasklets.QueueFuture,
+                tasklets.SerialQueueFuture):
+      self.assertFalse(hasattr(cls(), '__dict__'), cls)
+
+  def testFuture_TrackFutures(self):
+    self.assertFalse(utils.TRACK_FUTURES)
+    f = tasklets.Future()
+    self.assertEqual(f._where, ())
+    self.assertFalse(f in tasklets._state.all_pending)
+    self.assertTrue(repr(f).startswith('<Future '), repr(f))
+    f.set_result(42)
+    self.assertEqual(f.get_result(), 42)
+    utils.TRACK_FUTURES = True
+    try:
+      f = tasklets.Future()
+      self.assertTrue(f in tasklets._state.all_pending)
+      f.set_result(None)
+      self.assertFalse(f in tasklets._state.all_pending)
+    finally:
+      utils.TRACK_FUTURES = False
+
   def testFuture_Repr_TaskletWrapper(self):
     prefix = r'<Future [\da-f]+ created by '
     @tasklets.tasklet
@@ -87,14 +122,18 @@ class TaskletTests(test_utils.NDBTest):
                       repr(f1))
       f1.set_result(None)
       yield f1
-    f2 = foo()
-    self.assertTrue(
-      re.match(prefix +
-               r'testFuture_Repr_TaskletWrapper\(tasklets_test.py:\d+\) '
-               r'for tasklet foo\(tasklets_test.py:\d+\).*; pending>$',
-               repr(f2)),
-      repr(f2))
-    f2.check_success()
+    utils.TRACK_FUTURES = True
+    try:
+      f2 = foo()
+      self.assertTrue(
+        re.match(prefix +
+                 r'testFuture_Repr_TaskletWrapper\(tasklets_test.py:\d+\) '
+                 r'for tasklet foo\(tasklets_test.py:\d+\).*; pending>$',
+                 repr(f2)),
+        repr(f2))
+      f2.check_success()
+    finally:
+      utils.TRACK_FUTURES = False
 
   def testFuture_Done_State(self):
     f = tasklets.Future()
@@ -170,6 +209,45 @@ class TaskletTests(test_utils.NDBTest):
     tasklets.Future.wait_all(todo)
     self.assertEqual(self.log, [(f,) for f in self.futs])
 
+  def testFuture_WaitAnyRemovesCallbacks(self):
+    todo = self.create_futures()
+    f = tasklets.Future.wait_any(todo)
+    self.assertTrue(f is self.futs[0])
+    for fut in self.futs[1:]:
+      self.assertEqual(len(fut._callbacks), 1)  # Only universal_callback.
+    # A Future that is already done is returned right away.
+    self.assertTrue(tasklets.Future.wait_any(self.futs) is f)
+    eventloop.run()
+
+  def testAsCompleted(self):
+    futs = [tasklets.Future() for _ in range(4)]
+    results = list(tasklets.as_completed(futs))
+    self.assertEqual(len(results), 4)
+    futs[2].set_result(2)
+    futs[0].set_exception(ZeroDivisionError())
+    self.assertEqual(results[0].get_result(), 2)
+    self.assertRaises(ZeroDivisionError, results[1].get_result)
+    self.assertFalse(results[2].done())
+    futs[3].set_result(3)
+    futs[1].set_result(1)
+    self.assertEqual([f.get_result() for f in results[2:]], [3, 1])
+    self.assertEqual(list(tasklets.as_completed([])), [])
+
+  def testAsCompletedInTasklet(self):
+    @tasklets.tasklet
+    def delayed(dt):
+      yield tasklets.sleep(dt)
+      raise tasklets.Return(dt)
+    @tasklets.tasklet
+    def fan_out():
+      log = []
+      for fut in tasklets.as_completed([delayed(0.03), delayed(0.01),
+                                        delayed(0.02)]):
+        dt = yield fut
+        log.append(dt)
+      raise tasklets.Return(log)
+    self.assertEqual(fan_out().get_result(), [0.01, 0.02, 0.03])
+
   def testSleep(self):
     # Ensure that tasklets sleep for the specified amount of time.
     # NOTE: May sleep too long if processor usage is high.
@@ -433,6 +511,142 @@ class TaskletTests(test_utils.NDBTest):
     sqf.set_exception(KeyError())
     self.assertRaises(KeyError, g1.get_result)
 
+  def testQueueFuture_Cancel(self):
+    qf = tasklets.QueueFuture()
+    f1 = tasklets.Future()
+    qf.add_dependent(f1)
+    g1 = qf.getq()
+    self.assertTrue(qf.cancel())
+    self.assertTrue(qf.cancelled())
+    self.assertTrue(f1.cancelled())
+    self.assertRaises(tasklets.CancelledError, g1.get_result)
+    # Later puts and complete() are ignored.
+    qf.putq(42)
+    qf.complete()
+    self.assertRaises(tasklets.CancelledError, qf.getq().get_result)
+
+  def testQueueFuture_CancelGetQ(self):
+    qf = tasklets.QueueFuture()
+    g1 = qf.getq()
+    g2 = qf.getq()
+    g1.cancel()
+    qf.putq(42)
+    qf.complete()
+    self.assertEqual(g2.get_result(), 42)
+
+  def testSerialQueueFuture_Cancel(self):
+    sqf = tasklets.SerialQueueFuture()
+    f1 = tasklets.Future()
+    sqf.putq(f1)
+    self.assertTrue(sqf.cancel())
+    self.assertFalse(sqf.cancel())
+    self.assertTrue(f1.cancelled())
+    sqf.putq(42)
+    sqf.complete()
+    self.assertRaises(tasklets.CancelledError, sqf.getq().get_result)
+
+  def testSerialQueueFuture_CancelGetQ(self):
+    sqf = tasklets.SerialQueueFuture()
+    g1 = sqf.getq()
+    g2 = sqf.getq()
+    g1.cancel()
+    sqf.putq(1)
+    sqf.putq(tasklets.Future())  # A pending one, to exercise add_dependent.
+    g3 = sqf.getq()
+    self.assertEqual(g2.get_result(), 1)
+    self.assertFalse(g3.done())
+
+  def testQueueFuture_MaxSize(self):
+    q = tasklets.QueueFuture(maxsize=2)
+    self.assertTrue(q.putq(1).done())
+    room = q.putq(2)
+    self.assertFalse(room.done())
+    self.assertEqual(q.getq().get_result(), 1)
+    self.assertTrue(room.done())
+    # A pending dependent takes up room too.
+    f = tasklets.Future()
+    room = q.putq(f)
+    self.assertFalse(room.done())
+    self.assertEqual(q.getq().get_result(), 2)
+    self.assertTrue(room.done())
+    room = q.putq(3)
+    self.assertFalse(room.done())
+    q.cancel()
+    self.assertTrue(room.cancelled())
+    self.assertRaises(tasklets.CancelledError, q.putq(4).get_result)
+    self.assertRaises(ValueError, tasklets.QueueFuture, maxsize=0)
+    self.assertEqual(tasklets.QueueFuture().putq(1), None)
+
+  def testSerialQueueFuture_MaxSize(self):
+    q = tasklets.SerialQueueFuture(maxsize=1)
+    log = []
+    @tasklets.tasklet
+    def producer():
+      for i in range(4):
+        yield q.putq(i)
+        log.append(('put', i))
+      q.complete()
+    @tasklets.tasklet
+    def consumer():
+      while True:
+        try:
+          i = yield q.getq()
+        except EOFError:
+          break
+        log.append(('get', i))
+        yield tasklets.sleep(0.001)
+    consumer()
+    producer().check_success()
+    eventloop.run()
+    # The producer is never more than one item ahead of the consumer.
+    for i in range(2, 4):
+      self.assertTrue(log.index(('get', i - 2)) < log.index(('put', i)))
+    self.assertEqual([i for op, i in log if op == 'get'], range(4))
+    self.assertRaises(ValueError, tasklets.SerialQueueFuture, maxsize=-1)
+
+  def testMapConcurrent(self):
+    running = [0, 0]  # Current, maximum.
+    @tasklets.tasklet
+    def work(i):
+      running[0] += 1
+      running[1] = max(running)
+      yield tasklets.sleep(0.001 * (i % 3))
+      running[0] -= 1
+      raise tasklets.Return(i * 10)
+    taken = []
+    def items():
+      for i in range(10):
+        taken.append(i)
+        yield i
+    fut = tasklets.map_concurrent(work, items(), concurrency=3)
+    eventloop.run0()  # Start it.
+    self.assertEqual(taken, [0, 1, 2])  # Items are taken lazily.
+    self.assertEqual(fut.get_result(), [i * 10 for i in range(10)])
+    self.assertEqual(running[1], 3)
+    results = tasklets.map_concurrent(work, range(6), concurrency=2,
+                                      ordered=False).get_result()
+    self.assertEqual(sorted(results), [i * 10 for i in range(6)])
+    self.assertNotEqual(results, [i * 10 for i in range(6)])
+    self.assertEqual(tasklets.map_concurrent(work, []).get_result(), [])
+    self.assertRaises(ValueError, tasklets.map_concurrent, work, [], 0)
+
+  def testMapConcurrent_Error(self):
+    log = []
+    @tasklets.tasklet
+    def work(i):
+      try:
+        yield tasklets.sleep(0.001 * i)
+      except tasklets.CancelledError:
+        log.append(i)
+        raise
+      if i == 1:
+        raise ZeroDivisionError
+      raise tasklets.Return(i)
+    fut = tasklets.map_concurrent(work, range(10), concurrency=3)
+    self.assertRaises(ZeroDivisionError, fut.get_result)
+    eventloop.run()  # Let the cancelled calls finish.
+    self.assertEqual(sorted(log), [2, 3])  # Item 4 and up never started.
+
   def testSerialQueueFuture_ItemException(self):
     sqf = tasklets.SerialQueueFuture()
     g1 = sqf.getq()
@@ -621,6 +835,207 @@ class TaskletTests(test_utils.NDBTest):
     result = f.get_result()
     self.assertEqual(result, ([], []))
 
+  def testTasklet_YieldDoneFuture(self):
+    done = tasklets.Future()
+    done.set_result(42)
+    failed = tasklets.Future()
+    failed.set_exception(ZeroDivisionError())
+    log = []
+    @tasklets.tasklet
+    def foo(n):
+      for i in range(n):
+        val = yield done
+        log.append(val)
+      try:
+        yield failed
+      except ZeroDivisionError:
+        log.append('caught')
+    fut = foo(5)
+    ev = eventloop.get_event_loop()
+    ev.run0()  # Runs foo() up to its end, without going back to the loop.
+    self.assertTrue(fut.done())
+    self.assertEqual(log, [42] * 5 + ['caught'])
+
+  def testFuture_Cancel(self):
+    f = tasklets.Future()
+    self.assertFalse(f.cancelled())
+    self.assertTrue(f.cancel())
+    self.assertTrue(f.done())
+    self.assertTrue(f.cancelled())
+    self.assertFalse(f.cancel())
+    self.assertRaises(tasklets.CancelledError, f.check_success)
+    f.set_result(42)  # Ignored.
+    f.set_exception(KeyError())  # Ignored.
+    self.assertRaises(tasklets.CancelledError, f.check_success)
+    f = tasklets.Future()
+    f.set_result(42)
+    self.assertFalse(f.cancel())
+    self.assertFalse(f.cancelled())
+    self.assertEqual(f.get_result(), 42)
+
+  def testTasklet_Cancel(self):
+    log = []
+    inner = tasklets.Future()
+    @tasklets.tasklet
+    def foo():
+      try:
+        yield inner
+      finally:
+        log.append('cleanup')
+    fut = foo()
+    eventloop.run0()  # Start it.
+    self.assertTrue(fut.cancel())
+    self.assertTrue(inner.cancelled())
+    self.assertRaises(tasklets.CancelledError, fut.get_result)
+    self.assertTrue(fut.cancelled())
+    self.assertEqual(log, ['cleanup'])
+    # A tasklet cancelled before it starts never runs.
+    fut = foo()
+    self.assertTrue(fut.cancel())
+    self.assertRaises(tasklets.CancelledError, fut.get_result)
+    self.assertEqual(log, ['cleanup'])
+
+  def testTasklet_CancelCaught(self):
+    @tasklets.tasklet
+    def foo():
+      try:
+        yield tasklets.sleep(1)
+      except tasklets.CancelledError:
+        raise tasklets.Return('caught')
+    fut = foo()
+    eventloop.run0()  # Start it.
+    fut.cancel()
+    self.assertEqual(fut.get_result(), 'caught')
+    self.assertFalse(fut.cancelled())
+
+  def testTasklet_CancelNested(self):
+    log = []
+    @tasklets.tasklet
+    def inner(i):
+      try:
+        yield tasklets.sleep(1)
+      except tasklets.CancelledError:
+        log.append(i)
+        raise
+    @tasklets.tasklet
+    def outer():
+      yield inner(0)
+      log.append('not reached')
+    @tasklets.tasklet
+    def outer_multi():
+      yield inner(1), inner(2)
+      log.append('not reached')
+    fut1 = outer()
+    fut2 = outer_multi()
+    ev = eventloop.get_event_loop()
+    while ev.current:
+      ev.run0()  # Until they are all waiting for sleep().
+    fut1.cancel()
+    fut2.cancel()
+    self.assertRaises(tasklets.CancelledError, fut1.check_success)
+    self.assertRaises(tasklets.CancelledError, fut2.check_success)
+    self.assertEqual(sorted(log), [0, 1, 2])
+
+  def testTasklet_CancelSharedFuture(self):
+    # Cancelling one of two tasklets waiting for the same Future leaves
+    # that Future alone; the other tasklet still gets its result.
+    shared = tasklets.Future()
+    @tasklets.tasklet
+    def foo():
+      val = yield shared
+      raise tasklets.Return(val)
+    @tasklets.tasklet
+    def bar():
+      val1, val2 = yield shared, tasklets.sleep(0)
+      raise tasklets.Return(val1)
+    fut1 = foo()
+    fut2 = foo()
+    fut3 = bar()
+    ev = eventloop.get_event_loop()
+    while ev.current:
+      ev.run0()  # Until they are all waiting.
+    self.assertTrue(fut1.cancel())
+    self.assertTrue(fut3.cancel())
+    self.assertFalse(shared.done())
+    self.assertRaises(tasklets.CancelledError, fut1.get_result)
+    self.assertRaises(tasklets.CancelledError, fut3.get_result)
+    shared.set_result(42)
+    self.assertEqual(fut2.get_result(), 42)
+    # Once the last waiter is cancelled, so is the Future.
+    shared = tasklets.Future()
+    fut1 = foo()
+    fut2 = foo()
+    while ev.current:
+      ev.run0()
+    fut1.cancel()
+    self.assertFalse(shared.done())
+    fut2.cancel()
+    self.assertTrue(shared.cancelled())
+    self.assertRaises(tasklets.CancelledError, fut2.get_result)
+
+  def testTasklet_CancelWhileWaitingForRpc(self):
+    # The RPC can't be cancelled; the tasklet notices when it completes.
+    @tasklets.tasklet
+    def foo():
+      yield self.conn.async_get(None, [])
+      raise tasklets.Return('not reached')
+    fut = foo()
+    eventloop.run0()  # Start it.
+    self.assertTrue(fut.cancel())
+    self.assertFalse(fut.done())
+    self.assertRaises(tasklets.CancelledError, fut.get_result)
+
+  def testWithTimeout(self):
+    log = []
+    @tasklets.tasklet
+    def foo(dt):
+      try:
+        yield tasklets.sleep(dt)
+      except tasklets.CancelledError:
+        log.append(dt)
+        raise
+      raise tasklets.Return(dt)
+    # Done in time.
+    fut = tasklets.with_timeout(foo(0.01), 10)
+    self.assertEqual(fut.get_result(), 0.01)
+    # Timed out; the tasklet is cancelled.
+    inner = foo(10)
+    fut = tasklets.with_timeout(inner, 0.01)
+    self.assertRaises(tasklets.TimeoutError, fut.get_result)
+    self.assertRaises(tasklets.CancelledError, inner.get_result)
+    self.assertEqual(log, [10])
+    # Cancelling the returned Future cancels the tasklet.
+    inner = foo(20)
+    fut = tasklets.with_timeout(inner, 10)
+    eventloop.run0()  # Start it.
+    fut.cancel()
+    self.assertRaises(tasklets.CancelledError, inner.get_result)
+    self.assertTrue(fut.cancelled())
+    self.assertEqual(log, [10, 20])
+    # A Future that is already done needs no timer.
+    done = tasklets.Future()
+    done.set_result(42)
+    self.assertEqual(tasklets.with_timeout(done, 0).get_result(), 42)
+    self.assertRaises(TypeError, tasklets.with_timeout, 42, 1)
+
+  def testTasklet_YieldDoneFutureIsFair(self):
+    done = tasklets.Future()
+    done.set_result(None)
+    log = []
+    @tasklets.tasklet
+    def foo(n):
+      for i in range(n):
+        yield done
+        log.append(i)
+    limit = tasklets._MAX_TAIL_CALLS
+    fut = foo(limit * 2 + 1)
+    ev = eventloop.get_event_loop()
+    ev.run0()
+    self.assertEqual(len(log), limit)
+    self.assertFalse(fut.done())
+    fut.check_success()
+    self.assertEqual(len(log), limit * 2 + 1)
+
   def testTasklet_YieldTuple(self):
     @tasklets.tasklet
     def fib(n):
@@ -711,6 +1126,112 @@ class TaskletTests(test_utils.NDBTest):
     self.assertEqual(kwds, dict(foo='bar', baz='ding'))
     self.assertTrue(ctx is not old_ctx)
 
+  def testRunInExecutor(self):
+    def square(x):
+      time.sleep(0.01)
+      return x * x
+    def fail():
+      raise ZeroDivisionError
+    ticks = []
+    @tasklets.tasklet
+    def ticker():
+      for _ in range(3):
+        ticks.append(1)
+        yield tasklets.sleep(0)
+    @tasklets.tasklet
+    def foo():
+      tick = ticker()
+      results = yield [tasklets.run_in_executor(square, i) for i in range(6)]
+      self.assertEqual(results, [0, 1, 4, 9, 16, 25])
+      self.assertTrue(tick.done())  # It didn't have to wait for square().
+      yield tasklets.run_in_executor(fail)
+    self.assertRaises(ZeroDivisionError, foo().get_result)
+    self.assertEqual(ticks, [1, 1, 1])
+    self.assertFalse(eventloop.get_event_loop().expected)
+
+  def testSetExecutor(self):
+    calls = []
+    class SyncExecutor(object):
+      def submit(self, func, *args):
+        calls.append((func, args))
+        job = tasklets._ThreadPoolJob(func, args)
+        job.run()
+        return job
+    tasklets.set_executor(SyncExecutor())
+    try:
+      fut = tasklets.run_in_executor(max, 1, 2)
+      self.assertEqual(fut.get_result(), 2)
+      self.assertEqual(calls, [(max, (1, 2))])
+    finally:
+      tasklets.set_executor(None)
+    self.assertTrue(isinstance(tasklets._get_executor(), tasklets._ThreadPool))
+
+  def testAddContextDecoratorReportsStats(self):
+    @tasklets.toplevel
+    def view():
+      yield tasklets.sleep(0)
+    reports = []
+    eventloop.set_stats_hook(reports.append)
+    eventloop.enable_stats()
+    try:
+      view()
+    finally:
+      eventloop.enable_stats(False)
+      eventloop.set_stats_hook(None)
+    self.assertEqual(len(reports), 1)
+    self.assertTrue(reports[0]['calls']['timer']['count'] >= 1)
+
+  def testSwitchSkipsUnchangedState(self):
+    calls = []
+    @tasklets.tasklet
+    def foo():
+      yield tasklets.sleep(0)
+      yield tasklets.sleep(0)
+      namespace_manager.set_namespace('inner')
+      yield tasklets.sleep(0)
+    orig_set_namespace = namespace_manager.set_namespace
+    def set_namespace(namespace):
+      calls.append(namespace)
+      orig_set_namespace(namespace)
+    namespace_manager.set_namespace('outer')
+    namespace_manager.set_namespace = set_namespace
+    try:
+      foo().check_success()
+    finally:
+      namespace_manager.set_namespace = orig_set_namespace
+    # Only the switches after the tasklet changed its namespace set it.
+    self.assertEqual(calls, ['inner', 'outer', 'inner', 'outer'])
+    self.assertEqual(namespace_manager.get_namespace(), 'outer')
+
+  def testDefaultNamespace(self):
+    # Like the SDK's default namespace hook, get_namespace() resolves an
+    # unset namespace to the default and stores it.
+    orig_get_namespace = namespace_manager.get_namespace
+    def get_namespace():
+      namespace = orig_get_namespace()
+      if not namespace:
+        namespace = 'default'
+        namespace_manager.set_namespace(namespace)
+      return namespace
+    @tasklets.tasklet
+    def foo():
+      self.assertEqual(namespace_manager.get_namespace(), 'default')
+      namespace_manager.set_namespace('inner')
+      yield tasklets.sleep(0)
+      self.assertEqual(namespace_manager.get_namespace(), 'inner')
+    orig_key = tasklets._NAMESPACE_KEY
+    namespace_manager.get_namespace = get_namespace
+    try:
+      # None is for an SDK that doesn't say where it keeps the namespace.
+      for key in (orig_key, None):
+        tasklets._NAMESPACE_KEY = key
+        namespace_manager.set_namespace(None)
+        foo().check_success()
+        self.assertEqual(namespace_manager.get_namespace(), 'default')
+    finally:
+      namespace_manager.get_namespace = orig_get_namespace
+      tasklets._NAMESPACE_KEY = orig_key
+
   def testStickyDefaultNamespace(self):
     class Employee(model.Model):
       name = model.StringProperty()
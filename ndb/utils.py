@@ -13,6 +13,13 @@ __all__ = []
 
 DEBUG = True  # Set to False for some speedups
 
+# Set to True to record the stack that created each tasklets.Future and
+# to keep pending Futures in tasklets._state.all_pending, so that repr()
+# shows where a Future came from and a deadlock lists every pending
+# Future.  This costs a stack walk per Future, so it is off by default
+# (and the stack is only recorded if DEBUG is also set).
+TRACK_FUTURES = False
+
 
 def logging_debug(*args):
   # NOTE: If you want to see debug messages, set the logging level
@@ -0,0 +1,86 @@
+"""Benchmark for deserializing large repeated properties.
+
+Decodes an entity with a repeated IntegerProperty and a repeated
+FloatProperty of N elements each, then reads both properties, and
+reports the time taken and the approximate memory held by the
+entity's values.  This is compared to properties whose class has a
+(no-op) _from_base_type() method, whose values are still wrapped in a
+_BaseValue by _deserialize() and unwrapped on first access.
+
+Run this using 'make repeatedbench', optionally passing the number of
+elements, e.g. 'make repeatedbench FLAGS=100000'.  The default is one
+million.
+"""
+
+import gc
+import sys
+import time
+
+from ndb import model
+
+N = 1000000
+
+
+class WrappedIntegerProperty(model.IntegerProperty):
+
+  def _from_base_type(self, value):
+    return None  # No conversion, but this forces a _BaseValue wrapper.
+
+
+class WrappedFloatProperty(model.FloatProperty):
+
+  def _from_base_type(self, value):
+    return None
+
+
+class Plain(model.Model):
+  ints = model.IntegerProperty(repeated=True)
+  floats = model.FloatProperty(repeated=True)
+
+
+class Wrapped(model.Model):
+  ints = WrappedIntegerProperty(repeated=True)
+  floats = WrappedFloatProperty(repeated=True)
+
+
+def values_size(ent):
+  """Approximate number of bytes used by the entity's values."""
+  size = 0
+  for value in ent._values.itervalues():
+    size += sys.getsizeof(value)
+    for val in value:
+      size += sys.getsizeof(val)
+      if isinstance(val, model._BaseValue):
+        size += sys.getsizeof(val.b_val)
+  return size
+
+
+def bench(modelclass, pb):
+  gc.collect()
+  t0 = time.time()
+  ent = modelclass._from_pb(pb, set_key=False)
+  t1 = time.time()
+  size = values_size(ent)
+  t2 = time.time()
+  ent.ints
+  ent.floats
+  t3 = time.time()
+  print '  %-8s decode %7.3f sec, first access %7.3f sec, %6.1f MB' % (
+    modelclass.__name__, t1 - t0, t3 - t2, size / 1e6)
+  return ent
+
+
+def main():
+  try:
+    n = int(sys.argv[-1])
+  except Exception:
+    n = N
+  pb = Plain(ints=range(n), floats=[i / 2.0 for i in xrange(n)])._to_pb()
+  print 'Two repeated properties with %d elements each:' % n
+  plain = bench(Plain, pb)
+  wrapped = bench(Wrapped, pb)
+  assert plain.ints == wrapped.ints and plain.floats == wrapped.floats
+
+
+if __name__ == '__main__':
+  main()
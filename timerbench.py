@@ -0,0 +1,106 @@
+"""Benchmark for the event loop's timer queue.
+
+Schedules N delayed calls with random deadlines, optionally cancels
+some of them, and then drains the queue.  Run with one or more counts
+as arguments, e.g.:
+
+  python timerbench.py 10000 100000 1000000
+
+The old sorted-list implementation (bisect insert, pop(0)) is also
+timed for comparison, up to a size where it still finishes in
+reasonable time.
+"""
+
+import os
+import random
+import sys
+import time
+
+from ndb import eventloop
+from ndb import utils
+
+# See bench.py for why we do this.
+os.environ = dict(os.environ)
+
+OLD_LIMIT = 100000  # The sorted list is O(N**2); don't go beyond this.
+
+
+def noop():
+  pass
+
+
+def bench_heap(n, cancel_ratio):
+  ev = eventloop.EventLoop()
+  # Absolute deadlines in the past, so draining never sleeps.
+  now = time.time()
+  deadlines = [now - random.random() * 1000 for _ in xrange(n)]
+  t0 = time.time()
+  events = [ev.queue_call(when, noop) for when in deadlines]
+  t1 = time.time()
+  for event in events[:int(n * cancel_ratio)]:
+    ev.cancel_call(event)
+  t2 = time.time()
+  while ev.run0() is not None:
+    pass
+  t3 = time.time()
+  return t1 - t0, t2 - t1, t3 - t2
+
+
+def bench_sorted_list(n):
+  queue = []
+  now = time.time()
+  deadlines = [now - random.random() * 1000 for _ in xrange(n)]
+  t0 = time.time()
+  for when in deadlines:
+    # This is what EventLoop.insort_event_right() used to do.
+    lo, hi = 0, len(queue)
+    while lo < hi:
+      mid = (lo + hi) // 2
+      if when < queue[mid][0]: hi = mid
+      else: lo = mid + 1
+    queue.insert(lo, (when, noop, (), {}))
+  t1 = time.time()
+  while queue:
+    _, callback, args, kwds = queue.pop(0)
+    callback(*args, **kwds)
+  t2 = time.time()
+  return t1 - t0, t2 - t1
+
+
+def report(label, n, secs):
+  if secs > 0:
+    rate = '%10.0f/sec' % (n / secs)
+  else:
+    rate = '%14s' % 'inf'
+  print '  %-14s %8.3f sec %s' % (label, secs, rate)
+
+
+def main():
+  utils.tweak_logging()  # Interpret -v and -q flags.
+  sizes = []
+  cancel_ratio = 0.0
+  for arg in sys.argv[1:]:
+    if arg.startswith('--cancel='):
+      cancel_ratio = float(arg[len('--cancel='):])
+      continue
+    try:
+      sizes.append(int(arg))
+    except Exception:
+      pass
+  if not sizes:
+    sizes = [10000, 100000, 1000000]
+  for n in sizes:
+    print 'N = %d pending timers (cancel ratio %.2f)' % (n, cancel_ratio)
+    push, cancel, drain = bench_heap(n, cancel_ratio)
+    report('heap push', n, push)
+    if cancel_ratio:
+      report('heap cancel', int(n * cancel_ratio), cancel)
+    report('heap drain', n, drain)
+    if n <= OLD_LIMIT:
+      push, drain = bench_sorted_list(n)
+      report('list push', n, push)
+      report('list drain', n, drain)
+
+
+if __name__ == '__main__':
+  main()